@@ -0,0 +1,242 @@
+import argparse
+import glob
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from extraction_metrics import ExtractionMetrics
+from output_sink import ExtractOptions
+from ImageExtractor import (
+    EXTRACT_MODES,
+    addExtractArguments,
+    applyManifest,
+    createExtractOptions,
+    createPlan,
+    extractPlan,
+    getAnnotationPath,
+    prepareOutput,
+)
+
+# GUIで開ける動画と同じ拡張子
+VIDEO_EXTENSIONS = [".mp4", ".flv", ".ts", ".mts", ".avi", ".wmv"]
+
+
+def isVideo(path) -> bool:
+    return os.path.splitext(path)[1].lower() in VIDEO_EXTENSIONS
+
+
+def findVideos(inputs: list[str]) -> list[str]:
+    """
+    :param inputs: フォルダー、globパターン、動画、動画のパスを1行ずつ書いたファイルのいずれか
+    :return: 重複を除いた動画のパス
+    """
+    result = []
+    for input in inputs:
+        if os.path.isdir(input):
+            for root, _, files in os.walk(input):
+                result += [os.path.join(root, f) for f in sorted(files) if isVideo(f)]
+        elif os.path.isfile(input) and not isVideo(input):
+            with open(input, "r", encoding="utf-8") as f:
+                result += [line.strip() for line in f if line.strip()]
+        elif os.path.isfile(input):
+            result.append(input)
+        else:
+            result += [path for path in sorted(glob.glob(input, recursive=True)) if isVideo(path)]
+    return list(dict.fromkeys(os.path.normpath(path) for path in result))
+
+
+def getOutputNames(video_paths: list[str]) -> dict[str, str]:
+    """
+    動画ごとの出力先の名前を決める 通常は拡張子を除いたファイル名
+    ファイル名が同じ動画が複数あれば、それらの共通のフォルダーからの相対パスを"_"でつないだ名前にする
+    :return: 動画のパスから名前 それでも名前が重なる動画は含めない
+    """
+    groups: dict[str, list[str]] = {}
+    for video_path in video_paths:
+        name = os.path.splitext(os.path.basename(video_path))[0]
+        groups.setdefault(name, []).append(video_path)
+    candidates = {}
+    for name, paths in groups.items():
+        if len(paths) == 1:
+            candidates[paths[0]] = name
+            continue
+        directories = [os.path.dirname(os.path.abspath(path)) for path in paths]
+        try:
+            common = os.path.commonpath(directories)
+        except ValueError:
+            # ドライブが違う
+            common = ""
+        for path in paths:
+            relative = os.path.splitext(os.path.abspath(path))[0]
+            if common:
+                relative = os.path.relpath(relative, common)
+            parts = [part for part in relative.replace(":", "").split(os.sep) if part]
+            candidates[path] = "_".join(parts)
+    counts: dict[str, int] = {}
+    for name in candidates.values():
+        counts[name] = counts.get(name, 0) + 1
+    return {path: name for path, name in candidates.items() if counts[name] == 1}
+
+
+def getOutputPath(output_root, name):
+    return os.path.join(output_root, name)
+
+
+def _extractJob(video_path, output_path, plan, mode, options):
+    start = time.perf_counter()
+    metrics = ExtractionMetrics()
+    count = extractPlan(video_path, output_path, plan, mode, None, options, metrics=metrics)
+    return count, time.perf_counter() - start, metrics.stageTotals()
+
+
+def batchExtract(
+    video_paths,
+    output_root,
+    fps,
+    mode="folder",
+    jobs=1,
+    options=None,
+    incremental=True,
+    metrics: ExtractionMetrics | None = None,
+):
+    """
+    複数の動画をjobs個のプロセスで抽出する
+    フレーム数の多い動画から順に割り当てる
+    :param incremental: 前回の出力の記録があれば変わったフレームだけを出力する
+    :param metrics: 全ての動画の工程ごとの時間と処理したフレーム数を足し合わせる先
+    :return: (動画ごとの結果, アノテーションがなくスキップした動画, 失敗した動画)
+    """
+    if options == None:
+        options = ExtractOptions()
+    if metrics == None:
+        metrics = ExtractionMetrics()
+    skipped = []
+    failed = []
+    planned = []
+    output_names = getOutputNames(video_paths)
+    for video_path in video_paths:
+        if not os.path.exists(getAnnotationPath(video_path)):
+            skipped.append(video_path)
+            continue
+        if video_path not in output_names:
+            # 同じ出力先に書き込むと互いに上書きしてしまう
+            failed.append((video_path, "duplicate output name"))
+            continue
+        plan = createPlan(video_path, fps, metrics)
+        if plan == None:
+            failed.append((video_path, "failed to plan"))
+            continue
+        output_path = getOutputPath(output_root, output_names[video_path])
+        plan, manifest = applyManifest(
+            video_path, output_path, plan, mode, options, incremental
+        )
+        planned.append((video_path, output_path, plan, manifest))
+    # 大きいものから割り当てると最後に1本だけ残る時間が短くなる
+    planned.sort(key=lambda item: len(item[2]), reverse=True)
+    metrics.setPlannedFrames(sum(len(item[2]) for item in planned))
+
+    # memmapモードでは確保のたびにファイルの大きさが変わる
+    # 開いているmemmapのファイルは大きさを変えられない(Windows)ので、抽出を始める前に全て確保する
+    prepared = []
+    for video_path, output_path, plan, manifest in planned:
+        try:
+            prepareOutput(output_path, plan, mode, options)
+        except (OSError, ValueError) as e:
+            failed.append((video_path, repr(e)))
+            continue
+        prepared.append((video_path, output_path, plan, manifest))
+
+    results = []
+    # 数えるのは抽出を始めた動画だけ 始める前に失敗したものはfailedに入っている
+    total = len(prepared)
+    done = 0
+    with ProcessPoolExecutor(max_workers=max(1, jobs)) as executor:
+        futures = {}
+        for video_path, output_path, plan, manifest in prepared:
+            future = executor.submit(
+                _extractJob, video_path, output_path, plan, mode, options
+            )
+            futures[future] = (video_path, output_path, manifest)
+        for future in as_completed(futures):
+            video_path, output_path, manifest = futures[future]
+            done += 1
+            try:
+                count, elapsed, stages = future.result()
+            except Exception as e:
+                failed.append((video_path, repr(e)))
+                continue
+            if manifest != None:
+                manifest.save(output_path)
+            metrics.addFrames(count)
+            metrics.mergeStages(stages)
+            results.append((video_path, count, elapsed))
+            print(
+                f"[{done}/{total}] {video_path}: "
+                f"{count} frames {elapsed:.1f}s ({metrics.progressText()})"
+            )
+    return results, skipped, failed
+
+
+def printSummary(results, skipped, failed, elapsed):
+    print()
+    print(f"{'video':<40} {'frames':>8} {'sec':>8} {'fps':>8}")
+    for video_path, count, seconds in sorted(results):
+        fps = count / seconds if seconds > 0 else 0
+        print(f"{os.path.basename(video_path):<40} {count:>8} {seconds:>8.1f} {fps:>8.1f}")
+    total_frames = sum(count for _, count, _ in results)
+    total_fps = total_frames / elapsed if elapsed > 0 else 0
+    print(f"{'total':<40} {total_frames:>8} {elapsed:>8.1f} {total_fps:>8.1f}")
+    if skipped:
+        print(f"skipped (annotation file does not found): {len(skipped)}")
+        for video_path in skipped:
+            print(f"  {video_path}")
+    if failed:
+        print(f"failed: {len(failed)}")
+        for video_path, reason in failed:
+            print(f"  {video_path}: {reason}")
+
+
+if __name__ == "__main__":
+    usage = "usage: python BatchExtractor.py <input>... <output_path> <fps> [--mode name,folder,tar,memmap] [--jobs N] [--metrics PATH]"
+
+    parser = argparse.ArgumentParser(usage=usage)
+    parser.add_argument(
+        "inputs", nargs="+", help="フォルダー、globパターン、動画、動画の一覧のファイル"
+    )
+    parser.add_argument("output_path")
+    parser.add_argument("fps")
+    parser.add_argument("--mode", default="folder", choices=EXTRACT_MODES)
+    parser.add_argument(
+        "--jobs", type=int, default=os.cpu_count(), help="並列に処理する動画の数"
+    )
+    parser.add_argument(
+        "--full",
+        action="store_true",
+        help="前回の出力の記録(manifest.json)を使わず全てのフレームを出力し直す",
+    )
+    parser.add_argument(
+        "--metrics", help="全ての動画の工程ごとの時間と処理速度を保存するファイル(.jsonか.csv)"
+    )
+    addExtractArguments(parser)
+    args = parser.parse_args()
+
+    video_paths = findVideos(args.inputs)
+    if len(video_paths) == 0:
+        print("video does not found")
+        sys.exit(1)
+    start = time.perf_counter()
+    metrics = ExtractionMetrics()
+    results, skipped, failed = batchExtract(
+        video_paths,
+        args.output_path,
+        args.fps,
+        args.mode,
+        args.jobs,
+        createExtractOptions(args),
+        not args.full,
+        metrics,
+    )
+    printSummary(results, skipped, failed, time.perf_counter() - start)
+    if args.metrics:
+        metrics.dump(args.metrics)
@@ -1,15 +1,22 @@
 import sys
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from queue import Empty
 import cv2
 import os
 import json
-from enum import Enum
 import time
-
-
-class Condition(Enum):
-    INVALID = 0
-    SAFE = 1
-    DANGER = 2
+import numpy as np
+from label_index import Condition, LabelIndex
+from sampling_plan import SamplingPlan, planVideo
+from labeled_frames import LabeledFrameStream
+from image_writer import ImageEncoder
+from output_sink import ExtractOptions, createSink, datasetLocation
+from frame_dataset import FrameDataset
+from manifest import ExtractionManifest
+from frame_transform import INTERPOLATIONS, FrameTransform
+from extraction_metrics import ExtractionMetrics
 
 
 def getDepth(annotation: dict, time: float, depth=0):
@@ -53,119 +60,412 @@ def saveImage(frame, parent, name):
     cv2.imwrite(os.path.join(parent, name), frame)
 
 
-def print_progress_bar(current, total, bar_length=50):
+def print_progress_bar(current, total, bar_length=50, suffix=""):
     """
     ステータスバーを表示する関数
     :param current: 現在の進捗値
     :param total: 総進捗値
     :param bar_length: ステータスバーの長さ
+    :param suffix: バーの後ろに表示する文字列
     """
     progress = current / total
     block = int(bar_length * progress)
     bar = f"[{'#' * block}{'-' * (bar_length - block)}] {progress * 100:.2f}%"
+    if suffix:
+        bar += f" {suffix}"
     sys.stdout.write(f"\r{bar}")
     sys.stdout.flush()
 
 
-def extractImage(video_path, output_path, fps, name_mode=False):
-    if video_path != None and output_path != None and fps != None:
-        base = os.path.splitext(video_path)[0]  # 拡張子を除いた部分を取得
-        annotation_path = f"{base}.txt"  # 新しい拡張子を追加
-        if not name_mode:
-            danger_path = os.path.join(output_path, "danger")
-            safe_path = os.path.join(output_path, "safe")
-            os.makedirs(danger_path, exist_ok=True)
-            os.makedirs(safe_path, exist_ok=True)
-        try:
-            fps = int(fps)
-        except ValueError:
-            print("pfs must be int")
-            return
+# フレームを保存するモード
+EXTRACT_MODES = ["folder", "name", "tar", "memmap"]
+# 先読みしておくフレーム数
+PREFETCH = 8
+
+
+def getAnnotationPath(video_path):
+    base = os.path.splitext(video_path)[0]  # 拡張子を除いた部分を取得
+    return f"{base}.txt"  # 新しい拡張子を追加
+
+
+def createPlan(
+    video_path, fps, metrics: ExtractionMetrics | None = None
+) -> SamplingPlan | None:
+    """
+    抽出するフレームの一覧を作成する
+    :param fps: 抽出するfps(小数も可)
+    :param metrics: ラベル付けの時間を記録する先
+    :return: 失敗したらNone
+    """
+    try:
+        fps = float(fps)
+    except ValueError:
+        print("fps must be number")
+        return None
+
+    try:
+        label_index = LabelIndex.fromFile(getAnnotationPath(video_path))
+    except FileNotFoundError:
+        print("annotation file does not found")
+        return None
+
+    try:
+        return planVideo(video_path, label_index, fps, metrics)
+    except ValueError as e:
+        print(e)
+        return None
 
+
+def extractPlan(
+    video_path,
+    output_path,
+    plan: SamplingPlan,
+    mode="folder",
+    progress=None,
+    options: ExtractOptions | None = None,
+    part: int | None = None,
+    metrics: ExtractionMetrics | None = None,
+):
+    """
+    plan内のフレームをデコードして保存する
+    :param mode: folder, name, tar, memmapのいずれか
+    :param progress: 保存したフレーム数を受け取る関数 0.1秒おきに呼ばれる
+    :param part: 並列に抽出する場合の担当範囲の番号
+    :param metrics: 工程ごとの時間と処理したフレーム数を記録する先
+    :return: 保存したフレーム数
+    """
+    if options == None:
+        options = ExtractOptions()
+    last_time = time.time()
+    reported = 0
+    count = 0
+    # デコードは先読みスレッドで、変換とエンコードはsinkのスレッドで行う
+    with LabeledFrameStream(
+        video_path, plan, prefetch=PREFETCH, metrics=metrics
+    ) as stream:
+        sink = createSink(mode, output_path, options, part, plan.offset, metrics)
         try:
-            with open(annotation_path, "r") as f:
-                annotation = json.load(f)
-        except FileNotFoundError:
-            print("annotation file does not found")
-            return
-
-        video = cv2.VideoCapture(video_path)
-        original_fps = int(video.get(cv2.CAP_PROP_FPS))
-        frame_count = video.get(cv2.CAP_PROP_FRAME_COUNT)
-        step = int(original_fps / fps)
-
-        current_frame = 0
-        last_time = time.time()
-        current_video_time = 0
-        continuous = 0
-        created_contnuous = -1
-        while True:
-
-            if not isInValidArea(annotation, current_video_time):
-                nearest_valid_area_start_time = getNeraresValidAreaStartTime(
-                    annotation, current_video_time
+            for item in stream:
+                sink.write(
+                    item.frame,
+                    item.frame_index,
+                    item.timestamp,
+                    item.condition,
+                    item.segment,
                 )
-                if nearest_valid_area_start_time == None:
-                    print_progress_bar(frame_count, frame_count)
-                    return
-                else:
-                    current_frame = int(nearest_valid_area_start_time * original_fps)
-                    video.set(cv2.CAP_PROP_POS_FRAMES, current_frame)
-                    continuous += 1
-
-            for _ in range(step):
-                ret, frame = video.read()
-                current_frame += 1
-                if not ret:
-                    print_progress_bar(frame_count, frame_count)
-                    return
-            current_video_time = current_frame / original_fps
-            condition = getCondition(annotation, current_video_time)
-
-            if not name_mode:
-                if condition == Condition.SAFE:
-                    saveImage(frame, safe_path, f"{int(current_frame):05}.png")
-                elif condition == Condition.DANGER:
-                    saveImage(frame, danger_path, f"{int(current_frame):05}.png")
-            else:
-                parent_path = os.path.join(output_path, str(continuous))
-                if created_contnuous != continuous:
-                    created_contnuous = continuous
-                    os.makedirs(parent_path, exist_ok=True)
-                if condition == Condition.SAFE:
-                    saveImage(frame, parent_path, f"{int(current_frame):05}_safe.png")
-                elif condition == Condition.DANGER:
-                    saveImage(frame, parent_path, f"{int(current_frame):05}_danger.png")
+                count += 1
+                if metrics:
+                    metrics.addFrames(1)
+
+                current_time = time.time()
+                if progress and current_time - last_time > 0.1:
+                    last_time = current_time
+                    progress(count - reported)
+                    reported = count
+        finally:
+            sink.close()
+    if progress and count != reported:
+        progress(count - reported)
+    return count
+
+
+def applyManifest(
+    video_path, output_path, plan: SamplingPlan, mode, options: ExtractOptions, incremental
+) -> tuple[SamplingPlan, ExtractionManifest | None]:
+    """
+    folder, nameモードで前回の出力の記録があれば、出力をその記録から新しい計画に合わせる
+    :return: (実際にデコードが必要なフレームの計画, 抽出が終わった後に保存する記録)
+    """
+    if mode not in ["folder", "name"]:
+        return plan, None
+    manifest = ExtractionManifest.create(
+        video_path, getAnnotationPath(video_path), plan, mode, options
+    )
+    old_manifest = ExtractionManifest.load(output_path) if incremental else None
+    # 途中で失敗した場合に古い記録が残らないよう先に消しておく
+    ExtractionManifest.remove(output_path)
+    if old_manifest != None and old_manifest.isCompatible(manifest):
+        relabeled = old_manifest.relabeledFrames(manifest)
+        if relabeled:
+            print(f"annotation changed: relabeling {len(relabeled)} frames")
+        need_decode = old_manifest.apply(output_path, manifest)
+        plan = plan.select(np.isin(plan.frame_indices, list(need_decode)))
+    return plan, manifest
 
+
+def prepareOutput(output_path, plan: SamplingPlan, mode, options: ExtractOptions):
+    """
+    extractPlanを(並列に)呼ぶ前に一度だけ行う準備
+    """
+    if mode == "memmap":
+        # 各プロセスが書き込めるよう先に領域を確保しておく
+        dataset_path, video_name = datasetLocation(output_path)
+        FrameDataset.reserve(dataset_path, options.frame_shape, video_name, len(plan))
+
+
+def _extractPlanWorker(video_path, output_path, plan, mode, queue, options, part):
+    """
+    :return: 工程ごとの時間(親プロセスで足し合わせる)
+    """
+    metrics = ExtractionMetrics()
+    extractPlan(video_path, output_path, plan, mode, queue.put, options, part, metrics)
+    return metrics.stageTotals()
+
+
+def extractImage(
+    video_path,
+    output_path,
+    fps,
+    mode="folder",
+    workers=1,
+    options: ExtractOptions | None = None,
+    incremental=True,
+    metrics_path=None,
+    metrics_interval=10.0,
+) -> ExtractionMetrics | None:
+    """
+    :param mode: folder, name, tar, memmapのいずれか 旧版との互換のためboolならnameモードかどうか
+    :param workers: 並列に動かすプロセス数 1なら現在のプロセスで処理する
+    :param options: 保存方法の設定 Noneなら既定値
+    :param incremental: folder, nameモードで前回の出力の記録(manifest.json)があれば
+    ラベルが変わったフレームの移動と削除、新しく有効になったフレームの書き込みだけを行う
+    :param metrics_path: 工程ごとの時間を保存するファイル(.jsonか.csv) Noneなら保存しない
+    :param metrics_interval: metrics_pathに途中経過を書き出す間隔(秒)
+    :return: 工程ごとの時間と処理したフレーム数 失敗したらNone
+    """
+    if isinstance(mode, bool):
+        mode = "name" if mode else "folder"
+    if video_path != None and output_path != None and fps != None:
+        metrics = ExtractionMetrics()
+        plan = createPlan(video_path, fps, metrics)
+        if plan == None:
+            return None
+        if options == None:
+            options = ExtractOptions()
+
+        plan, manifest = applyManifest(
+            video_path, output_path, plan, mode, options, incremental
+        )
+
+        total = len(plan)
+        metrics.setPlannedFrames(total)
+        if total == 0:
+            if manifest != None:
+                manifest.save(output_path)
+            if metrics_path:
+                metrics.dump(metrics_path)
+            return metrics
+        prepareOutput(output_path, plan, mode, options)
+        last_record = time.time()
+
+        def report():
+            nonlocal last_record
+            print_progress_bar(metrics.frames, total, suffix=metrics.progressText())
             current_time = time.time()
-            if current_time - last_time > 0.1:
-                last_time = current_time
-                print_progress_bar(current_frame, frame_count)
+            if metrics_path and current_time - last_record >= metrics_interval:
+                last_record = current_time
+                metrics.record()
+                metrics.dump(metrics_path)
+
+        if workers <= 1:
+            extractPlan(
+                video_path,
+                output_path,
+                plan,
+                mode,
+                lambda count: report(),
+                options,
+                metrics=metrics,
+            )
+        else:
+            # 各プロセスが自分の範囲にシークして書き出す
+            # 領域の番号は分割前の計画に入っているので直列の場合と同じになる
+            with multiprocessing.Manager() as manager:
+                queue = manager.Queue()
+                with ProcessPoolExecutor(max_workers=workers) as executor:
+                    futures = [
+                        executor.submit(
+                            _extractPlanWorker,
+                            video_path,
+                            output_path,
+                            chunk,
+                            mode,
+                            queue,
+                            options,
+                            part,
+                        )
+                        for part, chunk in enumerate(plan.split(workers * 4))
+                    ]
+                    while not all(future.done() for future in futures) or not queue.empty():
+                        try:
+                            metrics.addFrames(queue.get(timeout=0.1))
+                        except Empty:
+                            continue
+                        report()
+                    for future in futures:
+                        # ワーカーで起きた例外をここで送出する
+                        metrics.mergeStages(future.result())
+        print_progress_bar(total, total, suffix=metrics.progressText())
+        print()
+        if manifest != None:
+            manifest.save(output_path)
+        if metrics_path:
+            metrics.dump(metrics_path)
+        return metrics
     else:
         print(usage)
 
 
+def exportFrameLabels(video_path, output_path):
+    """
+    動画の全フレームのラベル(Conditionの値)を.npyとして保存する
+    :param output_path: 保存先のファイルパス
+    :return: ラベルの配列 失敗したらNone
+    """
+    try:
+        label_index = LabelIndex.fromFile(getAnnotationPath(video_path))
+    except FileNotFoundError:
+        print("annotation file does not found")
+        return None
+
+    video = cv2.VideoCapture(video_path)
+    fps = video.get(cv2.CAP_PROP_FPS)
+    frame_count = int(video.get(cv2.CAP_PROP_FRAME_COUNT))
+    video.release()
+    if fps <= 0:
+        print("failed to read fps")
+        return None
+
+    labels = label_index.frameLabels(frame_count, fps)
+    parent = os.path.dirname(output_path)
+    if parent:
+        os.makedirs(parent, exist_ok=True)
+    np.save(output_path, labels)
+    return labels
+
+
+def addExtractArguments(parser: argparse.ArgumentParser):
+    """
+    保存方法に関するコマンドライン引数を追加する
+    """
+    parser.add_argument(
+        "--format", default="png", choices=["png", "jpg", "webp"], help="保存する画像の形式"
+    )
+    parser.add_argument("--png-compression", type=int, help="PNGの圧縮レベル(0-9)")
+    parser.add_argument("--quality", type=int, help="JPEG/WebPの品質(0-100)")
+    parser.add_argument(
+        "--write-threads", type=int, default=4, help="エンコードと書き込みを行うスレッド数"
+    )
+    parser.add_argument(
+        "--queue-size", type=int, default=32, help="書き込み待ちにできるフレーム数の上限"
+    )
+    parser.add_argument(
+        "--shard-size", type=int, default=1024, help="tarモードでの1つのtarの大きさの上限(MB)"
+    )
+    parser.add_argument(
+        "--frame-size",
+        help="memmapモードでの1フレームの大きさ(<幅>x<高さ>) 省略時は--resizeか224x224",
+    )
+    parser.add_argument("--resize", help="保存する前に縮小する大きさ(<幅>x<高さ>)")
+    parser.add_argument(
+        "--interpolation",
+        default="area",
+        choices=list(INTERPOLATIONS.keys()),
+        help="縮小の補間方法",
+    )
+    parser.add_argument(
+        "--crop", help="切り抜く範囲 centerなら--resizeと同じ縦横比で中央、または<x>,<y>,<幅>,<高さ>"
+    )
+    parser.add_argument(
+        "--letterbox", action="store_true", help="縦横比を保って縮小し、余白を黒で埋める"
+    )
+    parser.add_argument("--grayscale", action="store_true", help="グレースケールで保存する")
+
+
+def _parseSize(text) -> tuple[int, int]:
+    width, height = [int(x) for x in text.lower().split("x")]
+    return width, height
+
+
+def createExtractOptions(args) -> ExtractOptions:
+    size = _parseSize(args.resize) if args.resize else None
+    crop = args.crop
+    if crop and crop != "center":
+        crop = tuple(int(x) for x in crop.split(","))
+    transform = FrameTransform(size, args.interpolation, crop, args.grayscale, args.letterbox)
+    if args.frame_size:
+        frame_width, frame_height = _parseSize(args.frame_size)
+    else:
+        frame_width, frame_height = size if size else (224, 224)
+    return ExtractOptions(
+        ImageEncoder(args.format, args.png_compression, args.quality),
+        args.write_threads,
+        args.queue_size,
+        args.shard_size * 1024 * 1024,
+        (frame_height, frame_width, 1 if args.grayscale else 3),
+        None if transform.isIdentity() else transform,
+    )
+
+
 if __name__ == "__main__":
-    usage = "usage: python ImageExtractor.py <video_path> <output_path> <fps> [mode|name,folder]"
+    usage = "usage: python ImageExtractor.py <video_path> <output_path> <fps> [mode|name,folder,tar,memmap,label] [--plan-only] [--workers N] [--metrics PATH]"
 
-    args = sys.argv
-    if len(args) < 4:
-        print(usage)
-        exit()
+    parser = argparse.ArgumentParser(usage=usage)
+    parser.add_argument("video_path")
+    parser.add_argument("output_path")
+    parser.add_argument("fps")
+    parser.add_argument("mode", nargs="?", default="folder")
+    parser.add_argument(
+        "--plan-only",
+        action="store_true",
+        help="抽出は行わず、抽出するフレームの一覧をplan.jsonに出力する",
+    )
+    parser.add_argument(
+        "--workers", type=int, default=1, help="並列に抽出するプロセス数"
+    )
+    parser.add_argument(
+        "--full",
+        action="store_true",
+        help="前回の出力の記録(manifest.json)を使わず全てのフレームを出力し直す",
+    )
+    parser.add_argument(
+        "--metrics", help="工程ごとの時間と処理速度を保存するファイル(.jsonか.csv)"
+    )
+    parser.add_argument(
+        "--metrics-interval",
+        type=float,
+        default=10.0,
+        help="--metricsのファイルに途中経過を書き出す間隔(秒)",
+    )
+    addExtractArguments(parser)
+    args = parser.parse_args()
 
-    video_path = args[1]
-    output_path = args[2]
-    fps = args[3]
+    video_path = args.video_path
+    fps = args.fps
     file_name_with_extension = os.path.basename(video_path)
     file_name_without_extension = os.path.splitext(file_name_with_extension)[0]
-    output_path = os.path.join(output_path, file_name_without_extension)
-    if len(args) >= 5:
-        mode = args[4]
-        if mode.lower() == "name":
-            extractImage(video_path, output_path, fps, True)
-        elif mode.lower() == "folder":
-            extractImage(video_path, output_path, fps, False)
-        else:
-            print("invalid mode")
+    output_path = os.path.join(args.output_path, file_name_without_extension)
+    mode = args.mode
+    options = createExtractOptions(args)
+    if args.plan_only:
+        plan = createPlan(video_path, fps)
+        if plan != None:
+            os.makedirs(output_path, exist_ok=True)
+            plan.dump(os.path.join(output_path, "plan.json"))
+            print(json.dumps(plan.summary(), indent=2))
+    elif mode.lower() in EXTRACT_MODES:
+        extractImage(
+            video_path,
+            output_path,
+            fps,
+            mode.lower(),
+            args.workers,
+            options,
+            not args.full,
+            args.metrics,
+            args.metrics_interval,
+        )
+    elif mode.lower() == "label":
+        exportFrameLabels(video_path, f"{output_path}.npy")
     else:
-        extractImage(video_path, output_path, fps)
+        print("invalid mode")
@@ -4,17 +4,27 @@ import sys
 from PyQt5.QtCore import *
 from PyQt5.QtGui import *
 from PyQt5.QtWidgets import *
-from video_player import VideoPlayer
+from video_player import VideoData, VideoPlayer
+from proxy_media import ProxyTranscoder, loadProxyInfo, proxyPath
+from annotation_journal import AnnotationJournal
+from annotation_loader import AnnotationLoader, loadAnnotation, needsLazyLoad
 from gui_property import GUIProperty
 import cv2
-from utils import pixelToTime, timeToPixel
-from rect_selector import RectSelectWidget
+from utils import DEFAULT_SCALE, pixelToTime, timeToPixel
+from rect_selector import RectSelectWidget, TimelineOverview
 import json
 import os
 
+# ズーム中などにスライダーを追従させる間隔の下限(秒)
+SLIDER_SYNC_INTERVAL = 1 / 30
+
 
 class MainWindow(QMainWindow):
-    def __init__(self, parent=None):
+    def __init__(self, parent=None, listener_stats=False, cache_stats=False):
+        """
+        :param listener_stats: Trueなら、プロパティのリスナーごとの呼んだ回数と時間を計測し、閉じるときに表示する
+        :param cache_stats: Trueなら、再生に使ったフレームのキャッシュのヒット率を閉じるときに表示する
+        """
         super(MainWindow, self).__init__(parent)
 
         self.setGeometry(300, 50, 400, 350)
@@ -34,22 +44,54 @@ class MainWindow(QMainWindow):
         self._save_act.triggered.connect(self.save)
         filemenu.addAction(self._save_act)
 
+        editmenu = menubar.addMenu("&Edit")
+        self._undo_act = QAction("元に戻す")
+        self._undo_act.setShortcut("Ctrl+Z")
+        editmenu.addAction(self._undo_act)
+
+        self._redo_act = QAction("やり直す")
+        self._redo_act.setShortcut("Ctrl+Y")
+        editmenu.addAction(self._redo_act)
+        self._journal: AnnotationJournal | None = None
+        self._annotation_loader: AnnotationLoader | None = None
+
+        viewmenu = menubar.addMenu("&View")
+        self._proxy_act = QAction("プロキシで再生")
+        self._proxy_act.setCheckable(True)
+        self._proxy_act.setToolTip("縮小した動画を作ってそちらを再生する(時刻は元の動画と同じ)")
+        self._proxy_act.toggled.connect(self.onProxyToggled)
+        viewmenu.addAction(self._proxy_act)
+        self._proxy_transcoder: ProxyTranscoder | None = None
+
         # QSplitterの作成
         splitter = QSplitter(Qt.Vertical)  # 水平方向に分割
         splitter_palette = splitter.palette()
         splitter_palette.setColor(QPalette.ColorRole.Window, QColor("black"))
         splitter.setPalette(splitter_palette)
 
-        time = GUIProperty(0)
-        playing = GUIProperty(False)
+        # 値が変わらなければ通知しない
+        time = GUIProperty(0, skip_equal=True, name="time")
+        playing = GUIProperty(False, skip_equal=True, name="playing")
         playing.addListener(self, self.__onPlayStatusChanged)
-        self._x_offset = GUIProperty(0)
-        self._x_offset.addListener(self, self.onXOffsetChanged)
-        self.video_data = GUIProperty(None)
+        self._x_offset = GUIProperty(0, skip_equal=True, name="x_offset")
+        self._x_offset.addListener(self, self.onXOffsetChanged, SLIDER_SYNC_INTERVAL)
+        self._scale = GUIProperty(DEFAULT_SCALE, skip_equal=True, name="scale")
+        self.video_data = GUIProperty(None, name="video_data")
         self.video_data.addListener(self, self.onVideoDataChanged)
+        self._properties = [time, playing, self._x_offset, self._scale, self.video_data]
+        self._listener_stats = listener_stats
+        self._cache_stats = cache_stats
+        for prop in self._properties:
+            prop.setStatsEnabled(listener_stats)
         self.video_player = VideoPlayer(playing, time, self.video_data)
 
-        self.rect_selector = RectSelectWidget(time, self._x_offset, self.video_data)
+        self.rect_selector = RectSelectWidget(
+            time, self._x_offset, self.video_data, self._scale
+        )
+        self.timeline_overview = TimelineOverview(self.rect_selector)
+        self.rect_selector.edited.connect(self.__onAnnotationEdited)
+        self._undo_act.triggered.connect(self.rect_selector.undo)
+        self._redo_act.triggered.connect(self.rect_selector.redo)
 
         button_widget_layout = QHBoxLayout()
 
@@ -81,6 +123,7 @@ class MainWindow(QMainWindow):
         self._slider.valueChanged.connect(self.onSliderPositionChanged)
 
         bottom_widget_layout.addWidget(self.rect_selector)
+        bottom_widget_layout.addWidget(self.timeline_overview)
         bottom_widget_layout.addWidget(self._slider)
 
         splitter.addWidget(top_widget)
@@ -154,7 +197,13 @@ class MainWindow(QMainWindow):
             self.setVideoPath(fileName)
 
     def save(self):
-        if self._video_path != "":
+        if self._annotation_loader != None:
+            # 読み込み終わる前に保存すると、読み込んでいない領域が消えてしまう
+            return
+        if self._journal != None:
+            # 書き込み用のスレッドで.txtにまとめる
+            self._journal.compact()
+        elif self._video_path != "":
             base = os.path.splitext(self._video_path)[0]  # 拡張子を除いた部分を取得
             new_path = f"{base}.txt"  # 新しい拡張子を追加
             f = open(new_path, "w")
@@ -164,10 +213,194 @@ class MainWindow(QMainWindow):
             f.close()
 
     def setVideoPath(self, path):
+        self.__cancelProxy()
+        # 前の動画のアノテーションの読み込みは、終わっても使わない
+        self._annotation_loader = None
         self._video_path = path
-        video = cv2.VideoCapture(path)
-        length = self.video_player.setVideo(video)
-        self.rect_selector.onVideoChanged(length)
+        video, source_data, opened_path = self.__openVideo(path)
+        length = self.video_player.setVideo(video, source_data, video_path=opened_path)
+        # 前の動画で作成中だった領域は、setVideoでボタンが戻るときに確定して記録される
+        self.__closeJournal()
+        self.rect_selector.onVideoChanged(length, path)
+        if length:
+            self.__openAnnotation(path)
+
+    def __openAnnotation(self, path):
+        """
+        保存されているアノテーションを読み込み、前回まとめる前に終了していればジャーナルから編集を復元する
+        大きいファイルは別スレッドで読み込み、その間も動画は表示しておく
+        """
+        root = self.rect_selector.parentProcessor
+        fps = self.video_data.getValue().getFPS()
+        if needsLazyLoad(path):
+            # 読み込み終わるまで領域を作ったり保存したりできないようにする
+            self._annotation_loader = AnnotationLoader(path, root, fps)
+            self.setValidButtonEnabled(False)
+            self._save_act.setEnabled(False)
+            self.statusBar().showMessage("アノテーションを読み込み中")
+            self._annotation_loader.loaded.connect(self.__onAnnotationLoaded)
+            self._annotation_loader.start()
+        else:
+            try:
+                result = loadAnnotation(path, root, fps)
+            except (OSError, ValueError):
+                result = None
+            self.__onAnnotationLoaded(root, result)
+
+    def __onAnnotationLoaded(self, root, result):
+        """
+        読み込んだ領域を表示し、以降の編集をジャーナルに記録する
+        """
+        if root is not self.rect_selector.parentProcessor:
+            # 読み込み中に別の動画を開いたか閉じた
+            return
+        if self._annotation_loader != None:
+            self._annotation_loader = None
+            self.statusBar().clearMessage()
+            self.setValidButtonEnabled(True)
+            self._save_act.setEnabled(True)
+        if result == None:
+            self.statusBar().showMessage("アノテーションを読み込めないため、自動保存しません", 5000)
+            return
+        self.rect_selector.loadChildren(result.children)
+        if result.recovered > 0:
+            self.statusBar().showMessage(
+                f"保存されていなかった{result.recovered}件の編集を復元しました", 5000
+            )
+        elif result.converted:
+            self.statusBar().showMessage("古い形式のアノテーションの時刻を変換しました", 5000)
+        # 復元や変換をした場合は、すぐに.txtに書き出す
+        self._journal = AnnotationJournal(
+            self._video_path,
+            result.snapshot,
+            result.snapshot_hash,
+            dirty=result.recovered > 0 or result.converted,
+        )
+        self._journal.saved.connect(self.__onAnnotationSaved)
+
+    def __closeJournal(self):
+        if self._journal != None:
+            self._journal.close()
+            self._journal = None
+
+    def __onAnnotationEdited(self, remove, add):
+        if self._journal != None:
+            self._journal.record(remove, add)
+
+    def __onAnnotationSaved(self, success, path):
+        if success:
+            self.statusBar().showMessage(f"{os.path.basename(path)}に保存しました", 3000)
+        else:
+            self.statusBar().showMessage(f"{os.path.basename(path)}に保存できませんでした", 5000)
+
+    def __openVideo(self, path) -> tuple[cv2.VideoCapture, VideoData | None, str]:
+        """
+        プロキシを使う設定で、使えるプロキシがあればそれを開く
+        なければ元の動画を開き、裏でプロキシを作り始める
+        :return: (キャプチャ, プロキシなら元の動画のfpsとフレーム数, 開いたファイルのパス)
+        """
+        if self._proxy_act.isChecked():
+            info = loadProxyInfo(path)
+            if info != None:
+                self.statusBar().showMessage("プロキシで再生中", 3000)
+                return (
+                    cv2.VideoCapture(proxyPath(path)),
+                    VideoData(info["source_fps"], info["source_frame_count"]),
+                    proxyPath(path),
+                )
+            self.__startProxy(path)
+        return cv2.VideoCapture(path), None, path
+
+    def __startProxy(self, path):
+        if self._proxy_transcoder != None:
+            return
+        self._proxy_transcoder = ProxyTranscoder(path)
+        self._proxy_transcoder.progress.connect(self.__onProxyProgress)
+        self._proxy_transcoder.finished.connect(self.__onProxyFinished)
+        self._proxy_transcoder.start()
+
+    def __cancelProxy(self):
+        if self._proxy_transcoder != None:
+            self._proxy_transcoder.cancel()
+            self._proxy_transcoder = None
+            self.statusBar().clearMessage()
+
+    def __isCurrentProxy(self, path) -> bool:
+        """
+        キャンセルした後に届いた通知を無視するため
+        """
+        return self._proxy_transcoder != None and self._proxy_transcoder.video_path == path
+
+    def __onProxyProgress(self, percent):
+        if self._proxy_transcoder != None:
+            self.statusBar().showMessage(f"プロキシを作成中 {percent}%")
+
+    def __onProxyFinished(self, success, path):
+        if not self.__isCurrentProxy(path):
+            return
+        error = self._proxy_transcoder.error
+        self._proxy_transcoder = None
+        if not success:
+            message = "プロキシを作成できませんでした"
+            if error != None:
+                message += f": {error}"
+            self.statusBar().showMessage(message, 5000)
+            return
+        if path == self._video_path and self._proxy_act.isChecked():
+            self.__reopenVideo()
+
+    def __reopenVideo(self):
+        """
+        表示している時刻を保ったまま、設定に合わせて元の動画かプロキシを開き直す
+        アノテーションはそのまま残す
+        """
+        if self._video_path == "" or self.video_data.getValue() == None:
+            return
+        current_time = self.video_player.getCurrentTime()
+        video, source_data, opened_path = self.__openVideo(self._video_path)
+        self.video_player.setVideo(video, source_data, current_time, opened_path)
+
+    def onProxyToggled(self, checked):
+        if not checked:
+            self.__cancelProxy()
+            self.__reopenVideo()
+        elif self._video_path != "" and self.video_data.getValue() != None:
+            if loadProxyInfo(self._video_path) != None:
+                self.__reopenVideo()
+            else:
+                # できあがったら__onProxyFinishedで切り替える
+                self.__startProxy(self._video_path)
+
+    def closeEvent(self, event):
+        # 作りかけのプロキシを消し、デコードとサムネイルのスレッドを止める
+        self.__cancelProxy()
+        self.video_player.setVideo(None)
+        # 残っている編集を.txtにまとめる
+        self.__closeJournal()
+        self._annotation_loader = None
+        self.rect_selector.onVideoChanged(None)
+        if self._listener_stats:
+            self.__printListenerStats()
+        if self._cache_stats:
+            self.__printCacheStats()
+        super().closeEvent(event)
+
+    def __printListenerStats(self):
+        for prop in self._properties:
+            print(f"{prop.name}: 値が同じため通知しなかった回数 {prop.skipped}")
+            stats = prop.listenerStats()
+            for key, stat in sorted(stats.items(), key=lambda item: -item[1]["seconds"]):
+                print(
+                    f"    {type(key).__name__}: {stat['calls']}回 {stat['seconds'] * 1000:.1f}ms"
+                )
+
+    def __printCacheStats(self):
+        stats = self.video_player.cacheStats()
+        print(
+            f"フレームのキャッシュ: ヒット率 {stats['hit_rate'] * 100:.1f}% "
+            f"(ヒット {stats['hits']}回 ミス {stats['misses']}回) "
+            f"{stats['frames']}枚 {stats['mb']:.1f}MB"
+        )
 
     def onVideoDataChanged(self, source, value):
         if value == None:
@@ -178,26 +411,34 @@ class MainWindow(QMainWindow):
             self._slider.setMinimum(0)
             self._slider.setMaximum(value.getFrameCount())
             self._slider.setEnabled(True)
-            self.setValidButtonEnabled(True)
-            self._save_act.setEnabled(True)
+            # アノテーションを読み込み中なら、終わってから有効にする
+            self.setValidButtonEnabled(self._annotation_loader == None)
+            self._save_act.setEnabled(self._annotation_loader == None)
 
     def onSliderPositionChanged(self, frame):
         video_data = self.video_data.getValue()
         if video_data:
-            self._x_offset.setValue(self, -1 * timeToPixel(frame / video_data.getFPS()))
+            self._x_offset.setValue(
+                self, -1 * timeToPixel(frame / video_data.getFPS(), self._scale.getValue())
+            )
             self.update()
 
     def onXOffsetChanged(self, source, value):
         video_data = self.video_data.getValue()
         if source != self and video_data:
-            frame = int(pixelToTime(value) * video_data.getFPS())
+            frame = int(pixelToTime(-1 * value, self._scale.getValue()) * video_data.getFPS())
+            # 位置をフレーム単位に丸め直さないよう、スライダーからは通知させない
+            self._slider.blockSignals(True)
             self._slider.setValue(frame)
+            self._slider.blockSignals(False)
             self.update()
 
 
 def main():
     app = QApplication(sys.argv)
-    w = MainWindow()
+    w = MainWindow(
+        listener_stats="--listener-stats" in sys.argv, cache_stats="--cache-stats" in sys.argv
+    )
     w.show()
     w.raise_()
     app.exec_()
@@ -0,0 +1,245 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from bisect import bisect_left
+
+from PyQt5.QtCore import QObject, pyqtSignal
+
+# この数の編集を書き込むか、最後の保存からこの秒数が過ぎたら.txtにまとめる
+COMPACT_COMMANDS = 500
+COMPACT_INTERVAL = 60.0
+
+
+def annotationPath(video_path) -> str:
+    return os.path.splitext(video_path)[0] + ".txt"
+
+
+def journalPath(video_path) -> str:
+    return os.path.splitext(video_path)[0] + ".journal.jsonl"
+
+
+def hashText(data: bytes | None) -> str | None:
+    return hashlib.sha1(data).hexdigest() if data != None else None
+
+
+def readAnnotation(video_path) -> tuple[dict | None, str | None]:
+    """
+    :return: (保存されているアノテーション, ファイルのハッシュ) ファイルがなければ(None, None)
+    読めない形式ならValueError
+    """
+    try:
+        with open(annotationPath(video_path), "rb") as f:
+            data = f.read()
+    except FileNotFoundError:
+        return None, None
+    return json.loads(data), hashText(data)
+
+
+def recoverJournal(video_path, snapshot_hash: str | None) -> list[dict]:
+    """
+    前回.txtにまとめる前に終了した場合に残っている編集を読み出す
+    ジャーナルの先頭には元にした.txtのハッシュがあり、今の.txtと違えば(まとめ終わっていれば)使わない
+    書き込み途中で終わった最後の行は捨てる
+    :return: 古い順の編集 {"remove": [...], "add": [...]}
+    """
+    try:
+        with open(journalPath(video_path), "r") as f:
+            lines = f.readlines()
+    except FileNotFoundError:
+        return []
+    commands = []
+    for i, line in enumerate(lines):
+        try:
+            entry = json.loads(line)
+        except ValueError:
+            break
+        if i == 0:
+            if entry.get("snapshot") != snapshot_hash:
+                return []
+        else:
+            commands.append(entry)
+    return commands
+
+
+def applyCommand(children: list[dict], command: dict):
+    """
+    開始時刻の順に並んだ子の領域(toExportObjectの形)に編集を当てはめる
+    """
+    starts = [child["start"] for child in children]
+    for rect in command["remove"]:
+        i = bisect_left(starts, rect["start"])
+        while i < len(children) and starts[i] == rect["start"]:
+            if children[i]["end"] == rect["end"]:
+                del children[i]
+                del starts[i]
+                break
+            i += 1
+    for rect in command["add"]:
+        i = bisect_left(starts, rect["start"])
+        children.insert(i, rect)
+        starts.insert(i, rect["start"])
+
+
+class AnnotationJournal(QObject):
+    """
+    編集を1行ずつ追記するジャーナル 書き込みと.txtへのまとめは別スレッドで行う
+    スレッドは書き込んだ編集を手元の写しにも当てはめ、それを.txtに書き出してジャーナルを空にする
+    """
+
+    # (成功したか, 書き出した.txtのパス)
+    saved = pyqtSignal(bool, str)
+
+    def __init__(
+        self,
+        video_path,
+        annotation: dict,
+        snapshot_hash: str | None,
+        dirty=False,
+        parent=None,
+    ):
+        """
+        :param annotation: 今のアノテーション(toExportObjectの形)
+        :param snapshot_hash: annotationの元にした.txtのハッシュ
+        :param dirty: annotationが.txtと違う(ジャーナルから復元した)ならTrue すぐに.txtにまとめる
+        """
+        super().__init__(parent)
+        self.video_path = video_path
+        self.snapshot = annotation
+        self.snapshot_hash = snapshot_hash
+        self.condition = threading.Condition()
+        self.pending: list[dict] = []
+        self.dirty = dirty
+        self.compact_requested = False
+        self.stopped = False
+        self.file = None
+        self.written = 0  # 最後にまとめてから書き込んだ編集の数
+        self.compacted_at = time.monotonic()
+        self.thread = threading.Thread(target=self.__run, daemon=True)
+        self.thread.start()
+
+    def record(self, remove: list[dict], add: list[dict]):
+        """
+        :param remove: 取り除いた子の領域
+        :param add: 加えた子の領域
+        """
+        with self.condition:
+            self.pending.append({"remove": remove, "add": add})
+            self.condition.notify_all()
+
+    def compact(self):
+        """
+        書き込み待ちの編集を書いたあと、.txtにまとめる
+        """
+        with self.condition:
+            self.compact_requested = True
+            self.condition.notify_all()
+
+    def close(self):
+        """
+        残っている編集を.txtにまとめてから止める
+        """
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
+        self.thread.join()
+
+    def __openJournal(self):
+        """
+        今の.txtを元にした空のジャーナルを作る
+        """
+        if self.file:
+            self.file.close()
+        path = journalPath(self.video_path)
+        with open(path + ".tmp", "w") as f:
+            f.write(json.dumps({"snapshot": self.snapshot_hash}) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + ".tmp", path)
+        self.file = open(path, "a")
+
+    def __append(self, commands: list[dict]):
+        for command in commands:
+            self.file.write(json.dumps(command) + "\n")
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def __compact(self):
+        path = annotationPath(self.video_path)
+        data = json.dumps(self.snapshot).encode("utf-8")
+        with open(path + ".tmp", "wb") as f:
+            f.write(data)
+        os.replace(path + ".tmp", path)
+        self.snapshot_hash = hashText(data)
+        self.__openJournal()
+        self.written = 0
+        self.compacted_at = time.monotonic()
+
+    def __next(self) -> tuple[list[dict], bool, bool]:
+        """
+        :return: (書き込む編集, まとめるか, 終了するか)
+        """
+        with self.condition:
+            while not self.stopped and not self.pending and not self.compact_requested:
+                timeout = None
+                if self.written > 0:
+                    timeout = self.compacted_at + COMPACT_INTERVAL - time.monotonic()
+                    if timeout <= 0:
+                        break
+                self.condition.wait(timeout)
+            commands = self.pending
+            self.pending = []
+            due = self.written + len(commands) >= COMPACT_COMMANDS or (
+                self.written + len(commands) > 0
+                and time.monotonic() - self.compacted_at >= COMPACT_INTERVAL
+            )
+            compact = self.compact_requested or due or (
+                self.stopped and self.written + len(commands) > 0
+            )
+            self.compact_requested = False
+            return commands, compact, self.stopped
+
+    def __closeJournal(self, remove=False):
+        if self.file:
+            self.file.close()
+            self.file = None
+        if remove and os.path.exists(journalPath(self.video_path)):
+            os.remove(journalPath(self.video_path))
+
+    def __run(self):
+        try:
+            if self.dirty:
+                # 復元した編集は、.txtにまとめ終わるまで前回のジャーナルに残しておく
+                self.__compact()
+            else:
+                self.__openJournal()
+        except OSError:
+            self.__closeJournal()
+            if self.dirty:
+                # まだ.txtにまとめられていないので、あとでまとめ直す
+                self.written = 1
+        while True:
+            commands, compact, stopped = self.__next()
+            # 書き込めなくても.txtにまとめられるよう、先に写しに当てはめる
+            for command in commands:
+                applyCommand(self.snapshot["children"], command)
+            self.written += len(commands)
+            try:
+                if self.file:
+                    self.__append(commands)
+                elif commands:
+                    # ジャーナルを開けていないので、.txtに直接書く
+                    compact = True
+                if compact:
+                    self.__compact()
+                    self.saved.emit(True, annotationPath(self.video_path))
+            except OSError:
+                self.__closeJournal()
+                # 次にまとめるのはCOMPACT_INTERVAL後
+                self.compacted_at = time.monotonic()
+                self.saved.emit(False, annotationPath(self.video_path))
+            if stopped:
+                # 全て.txtにまとめられていればジャーナルは要らない
+                self.__closeJournal(remove=self.written == 0)
+                return
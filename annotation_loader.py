@@ -0,0 +1,84 @@
+import os
+import threading
+from typing import NamedTuple
+
+from PyQt5.QtCore import QObject, pyqtSignal
+
+from annotation_journal import annotationPath, applyCommand, readAnnotation, recoverJournal
+from label_index import convertLegacyAnnotation
+from rect_selector import IntervalSet, RectSelectProcessor, buildChildren, toExportObject
+
+# これより大きい.txtは別スレッドで読み込み、その間も動画は表示しておく
+LAZY_LOAD_BYTES = 1 << 20
+
+
+class LoadedAnnotation(NamedTuple):
+    children: IntervalSet  # 一番上の領域の子の並び
+    snapshot: dict  # ジャーナルの元にするアノテーション(toExportObjectの形)
+    snapshot_hash: str | None
+    recovered: int  # ジャーナルから復元した編集の数
+    converted: bool  # 古い形式(fpsを切り捨てた時刻)から変換したか
+
+
+def needsLazyLoad(video_path) -> bool:
+    try:
+        return os.path.getsize(annotationPath(video_path)) >= LAZY_LOAD_BYTES
+    except OSError:
+        return False
+
+
+def loadAnnotation(video_path, parent: RectSelectProcessor, fps: float) -> LoadedAnnotation:
+    """
+    保存されているアノテーションを読み、前回まとめる前に終了していればジャーナルの編集を当てはめて
+    parentの子の並びをまとめて作る parent自体は変えないので別スレッドから呼んでもよい
+    :param fps: 動画のfps 古い形式の時刻を直すのに使う
+    :raises OSError, ValueError: 読めない場合
+    """
+    annotation, snapshot_hash = readAnnotation(video_path)
+    converted = False
+    try:
+        if annotation != None and "fps" not in annotation:
+            annotation = convertLegacyAnnotation(annotation, fps)
+            converted = True
+        objs = sorted(annotation["children"], key=lambda c: c["start"]) if annotation else []
+        commands = recoverJournal(video_path, snapshot_hash)
+        # 領域を作る前に、辞書のままで編集を当てはめる
+        for command in commands:
+            applyCommand(objs, command)
+        children = buildChildren(objs, parent)
+    except (KeyError, TypeError) as e:
+        raise ValueError(f"invalid annotation: {e}")
+    rect = parent.videoRect()
+    snapshot = {
+        "start": rect.start,
+        "end": rect.end,
+        "fps": fps,
+        "children": [toExportObject(p) for p in children.processors()],
+    }
+    return LoadedAnnotation(children, snapshot, snapshot_hash, len(commands), converted)
+
+
+class AnnotationLoader(QObject):
+    """
+    別スレッドでloadAnnotationを行う
+    """
+
+    # (読み込み先の領域, 結果 読めなければNone)
+    loaded = pyqtSignal(object, object)
+
+    def __init__(self, video_path, parent_processor: RectSelectProcessor, fps: float, parent=None):
+        super().__init__(parent)
+        self.video_path = video_path
+        self.parent_processor = parent_processor
+        self.fps = fps
+        self.thread = threading.Thread(target=self.__run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def __run(self):
+        try:
+            result = loadAnnotation(self.video_path, self.parent_processor, self.fps)
+        except (OSError, ValueError):
+            result = None
+        self.loaded.emit(self.parent_processor, result)
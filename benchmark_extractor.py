@@ -0,0 +1,434 @@
+import argparse
+import itertools
+import json
+import multiprocessing
+import os
+import platform
+import random
+import shutil
+import statistics
+import sys
+import time
+
+import cv2
+import numpy as np
+
+from ImageExtractor import extractPlan, getCondition
+from extraction_metrics import ExtractionMetrics
+from label_index import LabelIndex, convertLegacyAnnotation
+from output_sink import ExtractOptions
+from sampling_plan import planVideo
+
+# 1秒あたりの有効な領域の数
+DENSITIES = {"sparse": 0.05, "medium": 0.3, "dense": 1.5}
+BENCHMARKS = ["folder", "name", "label"]
+# ラベル付けの計測を繰り返す最短の時間(秒)
+MIN_LOOKUP_SECONDS = 0.2
+# 合成する動画とアノテーションの乱数の種(毎回同じものを作るため固定)
+SEED = 1234
+
+
+def peakRss() -> int | None:
+    """
+    :return: このプロセスの最大使用メモリ(バイト) 取得できなければNone
+    """
+    try:
+        import resource
+    except ImportError:
+        resource = None
+    if resource != None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # macOSはバイト、Linuxはキロバイト単位
+        return peak if sys.platform == "darwin" else peak * 1024
+    if sys.platform == "win32":
+        import ctypes
+        from ctypes import wintypes
+
+        class PROCESS_MEMORY_COUNTERS(ctypes.Structure):
+            _fields_ = [
+                ("cb", wintypes.DWORD),
+                ("PageFaultCount", wintypes.DWORD),
+                ("PeakWorkingSetSize", ctypes.c_size_t),
+                ("WorkingSetSize", ctypes.c_size_t),
+                ("QuotaPeakPagedPoolUsage", ctypes.c_size_t),
+                ("QuotaPagedPoolUsage", ctypes.c_size_t),
+                ("QuotaPeakNonPagedPoolUsage", ctypes.c_size_t),
+                ("QuotaNonPagedPoolUsage", ctypes.c_size_t),
+                ("PagefileUsage", ctypes.c_size_t),
+                ("PeakPagefileUsage", ctypes.c_size_t),
+            ]
+
+        counters = PROCESS_MEMORY_COUNTERS()
+        counters.cb = ctypes.sizeof(counters)
+        process = ctypes.windll.kernel32.GetCurrentProcess()
+        if ctypes.windll.psapi.GetProcessMemoryInfo(
+            process, ctypes.byref(counters), counters.cb
+        ):
+            return counters.PeakWorkingSetSize
+    return None
+
+
+def syntheticFrame(index, width, height) -> np.ndarray:
+    """
+    フレーム番号ごとに異なる画像(動くグラデーションと四角形、番号の文字)を作る
+    """
+    x = np.arange(width, dtype=np.uint16)
+    y = np.arange(height, dtype=np.uint16)[:, None]
+    frame = np.empty((height, width, 3), dtype=np.uint8)
+    frame[:, :, 0] = (x + index * 3) % 256
+    frame[:, :, 1] = (y + index * 2) % 256
+    frame[:, :, 2] = ((x + y) // 2 + index) % 256
+    size = max(8, min(width, height) // 6)
+    left = (index * 7) % max(1, width - size)
+    top = (index * 5) % max(1, height - size)
+    cv2.rectangle(frame, (left, top), (left + size, top + size), (255, 255, 255), -1)
+    cv2.putText(
+        frame,
+        str(index),
+        (8, max(16, height // 8)),
+        cv2.FONT_HERSHEY_SIMPLEX,
+        max(0.4, height / 480),
+        (0, 0, 0),
+        2,
+    )
+    return frame
+
+
+def generateVideo(path, width, height, fps, seconds):
+    """
+    MJPGのaviとして合成した動画を書き出す(どの環境のopencvでも書ける)
+    """
+    frame_count = int(round(fps * seconds))
+    writer = cv2.VideoWriter(
+        path, cv2.VideoWriter_fourcc(*"MJPG"), fps, (width, height)
+    )
+    if not writer.isOpened():
+        raise RuntimeError(f"failed to create video: {path}")
+    try:
+        for index in range(frame_count):
+            writer.write(syntheticFrame(index, width, height))
+    finally:
+        writer.release()
+
+
+def generateAnnotation(seconds, density, fps, seed=SEED) -> dict:
+    """
+    動画全体をdensityに応じた数の区間に分け、各区間に有効な領域を1つ、
+    その中に危険な領域を0から3個置いたアノテーションの木を作る
+    :param density: DENSITIESのキー
+    :param fps: 時刻の基準として書き込む動画のfps
+    """
+    rng = random.Random(f"{seed}-{seconds}-{density}")
+    count = max(1, int(round(seconds * DENSITIES[density])))
+    slot = seconds / count
+    children = []
+    for i in range(count):
+        slot_start = i * slot
+        length = slot * rng.uniform(0.4, 0.9)
+        start = slot_start + rng.uniform(0, slot - length)
+        grandchildren = []
+        for _ in range(rng.randint(0, 3)):
+            danger_length = length * rng.uniform(0.05, 0.3)
+            danger_start = start + rng.uniform(0, length - danger_length)
+            grandchildren.append(
+                {
+                    "start": danger_start,
+                    "end": danger_start + danger_length,
+                    "children": [],
+                }
+            )
+        grandchildren.sort(key=lambda child: child["start"])
+        children.append(
+            {"start": start, "end": start + length, "children": grandchildren}
+        )
+    return {"start": 0, "end": seconds, "children": children, "fps": fps}
+
+
+def caseName(width, height, fps, seconds, density=None) -> str:
+    name = f"{width}x{height}_{fps:g}fps_{seconds:g}s"
+    return f"{name}_{density}" if density else name
+
+
+def prepareCase(work_dir, width, height, fps, seconds, density):
+    """
+    動画とアノテーションがなければ作る 同じ設定なら前回作ったものを使う
+    :return: (動画のパス, アノテーションのパス)
+    """
+    video_dir = os.path.join(work_dir, "videos")
+    os.makedirs(video_dir, exist_ok=True)
+    video_path = os.path.join(video_dir, caseName(width, height, fps, seconds) + ".avi")
+    if not os.path.exists(video_path):
+        print(f"generating {video_path}")
+        temp_path = video_path + ".tmp.avi"
+        generateVideo(temp_path, width, height, fps, seconds)
+        os.replace(temp_path, video_path)
+    annotation_path = os.path.join(
+        video_dir, caseName(width, height, fps, seconds, density) + ".txt"
+    )
+    if not os.path.exists(annotation_path):
+        with open(annotation_path, "w") as f:
+            json.dump(generateAnnotation(seconds, density, fps), f)
+    return video_path, annotation_path
+
+
+def _runExtraction(video_path, annotation_path, output_path, mode, extract_fps):
+    """
+    別プロセスで1回分の抽出を行う(最大使用メモリを他の計測と分けるため)
+    """
+    shutil.rmtree(output_path, ignore_errors=True)
+    metrics = ExtractionMetrics()
+    start = time.perf_counter()
+    label_index = LabelIndex.fromFile(annotation_path)
+    plan = planVideo(video_path, label_index, extract_fps, metrics)
+    metrics.setPlannedFrames(len(plan))
+    frames = extractPlan(
+        video_path, output_path, plan, mode, None, ExtractOptions(), metrics=metrics
+    )
+    seconds = time.perf_counter() - start
+    shutil.rmtree(output_path, ignore_errors=True)
+    return {
+        "frames": frames,
+        "seconds": seconds,
+        "peak_rss": peakRss(),
+        "stages": metrics.stageTotals(),
+    }
+
+
+def _runLabelLookup(video_path, annotation_path):
+    """
+    全フレームのラベル付けをLabelIndexと旧版のgetConditionで行う
+    """
+    video = cv2.VideoCapture(video_path)
+    fps = video.get(cv2.CAP_PROP_FPS)
+    frame_count = int(video.get(cv2.CAP_PROP_FRAME_COUNT))
+    video.release()
+    with open(annotation_path, "r") as f:
+        # 前の版で作った"fps"のないアノテーションも、LabelIndexと同じ時刻の基準に揃えて比べる
+        annotation = convertLegacyAnnotation(json.load(f), fps)
+    # 1回では短すぎて誤差が大きいので、MIN_LOOKUP_SECONDS以上繰り返した平均をとる
+    iterations = 0
+    start = time.perf_counter()
+    while True:
+        labels = LabelIndex(annotation).frameLabels(frame_count, fps)
+        iterations += 1
+        elapsed = time.perf_counter() - start
+        if elapsed >= MIN_LOOKUP_SECONDS:
+            break
+    seconds = elapsed / iterations
+    legacy_start = time.perf_counter()
+    legacy = [getCondition(annotation, i / fps).value for i in range(frame_count)]
+    legacy_seconds = time.perf_counter() - legacy_start
+    if not np.array_equal(labels, np.array(legacy, dtype=np.int8)):
+        raise RuntimeError(f"label mismatch: {annotation_path}")
+    return {
+        "frames": frame_count,
+        "seconds": seconds,
+        "legacy_seconds": legacy_seconds,
+        "peak_rss": peakRss(),
+    }
+
+
+def runBenchmark(benchmark, video_path, annotation_path, output_path, extract_fps, repeat):
+    """
+    repeat回計測し、時間は中央値、最大使用メモリは最大値をとる
+    :return: 結果の辞書
+    """
+    runs = []
+    # 計測ごとに新しいプロセスを使う(spawnならWindowsと同じ条件になる)
+    context = multiprocessing.get_context("spawn")
+    for _ in range(repeat):
+        with context.Pool(1) as pool:
+            if benchmark == "label":
+                runs.append(pool.apply(_runLabelLookup, (video_path, annotation_path)))
+            else:
+                runs.append(
+                    pool.apply(
+                        _runExtraction,
+                        (video_path, annotation_path, output_path, benchmark, extract_fps),
+                    )
+                )
+    seconds = statistics.median(run["seconds"] for run in runs)
+    peaks = [run["peak_rss"] for run in runs if run["peak_rss"] != None]
+    result = {
+        "frames": runs[0]["frames"],
+        "seconds": seconds,
+        "fps": runs[0]["frames"] / seconds if seconds > 0 else 0.0,
+        "peak_rss_mb": max(peaks) / (1024 * 1024) if peaks else None,
+        "runs": [run["seconds"] for run in runs],
+    }
+    if benchmark == "label":
+        result["legacy_seconds"] = statistics.median(run["legacy_seconds"] for run in runs)
+    else:
+        result["stages"] = runs[len(runs) // 2]["stages"]
+    return result
+
+
+def environment() -> dict:
+    return {
+        "python": platform.python_version(),
+        "opencv": cv2.__version__,
+        "numpy": np.__version__,
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+    }
+
+
+def resultKey(result) -> str:
+    return f"{result['case']}/{result['benchmark']}"
+
+
+def compareResults(results, baseline, threshold) -> list[dict]:
+    """
+    基準の結果と比べ、処理速度がthreshold以上下がったか最大使用メモリがthreshold以上増えたものを回帰とする
+    :param threshold: 割合(0.1なら10%)
+    """
+    baseline_results = {resultKey(result): result for result in baseline["results"]}
+    comparison = []
+    for result in results:
+        base = baseline_results.get(resultKey(result))
+        if base == None:
+            continue
+        entry = {"key": resultKey(result), "regressions": []}
+        if base["fps"] > 0:
+            entry["fps_change"] = result["fps"] / base["fps"] - 1
+            if entry["fps_change"] < -threshold:
+                entry["regressions"].append("fps")
+        if result["peak_rss_mb"] != None and base.get("peak_rss_mb"):
+            entry["peak_rss_change"] = result["peak_rss_mb"] / base["peak_rss_mb"] - 1
+            if entry["peak_rss_change"] > threshold:
+                entry["regressions"].append("peak_rss")
+        comparison.append(entry)
+    return comparison
+
+
+def printResults(results, comparison):
+    changes = {entry["key"]: entry for entry in comparison}
+    print()
+    print(f"{'case':<36} {'bench':<6} {'frames':>7} {'sec':>8} {'fps':>10} {'rss MB':>8} {'fps Δ':>8} {'rss Δ':>8}")
+    for result in results:
+        entry = changes.get(resultKey(result), {})
+        rss = result["peak_rss_mb"]
+        fps_change = entry.get("fps_change")
+        rss_change = entry.get("peak_rss_change")
+        line = (
+            f"{result['case']:<36} {result['benchmark']:<6} {result['frames']:>7} "
+            f"{result['seconds']:>8.3f} {result['fps']:>10.1f} "
+            f"{'-' if rss == None else f'{rss:.1f}':>8} "
+            f"{'-' if fps_change == None else f'{fps_change * 100:+.1f}%':>8} "
+            f"{'-' if rss_change == None else f'{rss_change * 100:+.1f}%':>8}"
+        )
+        if entry.get("regressions"):
+            line += "  REGRESSION(" + ",".join(entry["regressions"]) + ")"
+        print(line)
+
+
+def _parseList(text, convert):
+    return [convert(x) for x in text.split(",") if x]
+
+
+def _parseResolution(text) -> tuple[int, int]:
+    width, height = [int(x) for x in text.lower().split("x")]
+    return width, height
+
+
+if __name__ == "__main__":
+    usage = "usage: python benchmark_extractor.py [--output PATH] [--baseline PATH] [--save-baseline]"
+
+    parser = argparse.ArgumentParser(usage=usage)
+    parser.add_argument(
+        "--resolutions", default="320x240,1280x720", help="動画の解像度(<幅>x<高さ>のカンマ区切り)"
+    )
+    parser.add_argument("--fps", default="30,60", help="動画のfps(カンマ区切り)")
+    parser.add_argument("--lengths", default="10,60", help="動画の長さ(秒, カンマ区切り)")
+    parser.add_argument(
+        "--densities",
+        default=",".join(DENSITIES.keys()),
+        help="アノテーションの密度(" + ",".join(DENSITIES.keys()) + "のカンマ区切り)",
+    )
+    parser.add_argument(
+        "--benchmarks",
+        default=",".join(BENCHMARKS),
+        help="計測する処理(" + ",".join(BENCHMARKS) + "のカンマ区切り)",
+    )
+    parser.add_argument("--extract-fps", type=float, default=5.0, help="抽出するfps")
+    parser.add_argument("--repeat", type=int, default=3, help="1つの組み合わせを計測する回数")
+    parser.add_argument(
+        "--work-dir", default="benchmark_data", help="合成した動画と一時的な出力の置き場所"
+    )
+    parser.add_argument("--output", default="benchmark_results.json", help="結果を保存するファイル")
+    parser.add_argument(
+        "--baseline", default="benchmark_baseline.json", help="比較する基準の結果"
+    )
+    parser.add_argument(
+        "--save-baseline", action="store_true", help="今回の結果を基準として保存する"
+    )
+    parser.add_argument(
+        "--threshold", type=float, default=10.0, help="回帰とみなす変化の割合(%%)"
+    )
+    args = parser.parse_args()
+
+    resolutions = _parseList(args.resolutions, _parseResolution)
+    fps_list = _parseList(args.fps, float)
+    lengths = _parseList(args.lengths, float)
+    densities = _parseList(args.densities, str)
+    benchmarks = _parseList(args.benchmarks, str)
+    for density in densities:
+        if density not in DENSITIES:
+            print(f"invalid density: {density}")
+            sys.exit(1)
+    for benchmark in benchmarks:
+        if benchmark not in BENCHMARKS:
+            print(f"invalid benchmark: {benchmark}")
+            sys.exit(1)
+
+    results = []
+    output_path = os.path.join(args.work_dir, "output")
+    for (width, height), fps, seconds, density in itertools.product(
+        resolutions, fps_list, lengths, densities
+    ):
+        video_path, annotation_path = prepareCase(
+            args.work_dir, width, height, fps, seconds, density
+        )
+        case = caseName(width, height, fps, seconds, density)
+        for benchmark in benchmarks:
+            print(f"{case} {benchmark}")
+            result = runBenchmark(
+                benchmark, video_path, annotation_path, output_path, args.extract_fps, args.repeat
+            )
+            result.update(
+                {
+                    "case": case,
+                    "benchmark": benchmark,
+                    "width": width,
+                    "height": height,
+                    "video_fps": fps,
+                    "length": seconds,
+                    "density": density,
+                }
+            )
+            results.append(result)
+
+    comparison = []
+    if os.path.exists(args.baseline) and not args.save_baseline:
+        with open(args.baseline, "r") as f:
+            comparison = compareResults(results, json.load(f), args.threshold / 100)
+    printResults(results, comparison)
+
+    report = {
+        "environment": environment(),
+        "settings": {
+            "extract_fps": args.extract_fps,
+            "repeat": args.repeat,
+            "threshold": args.threshold,
+        },
+        "results": results,
+        "comparison": comparison,
+    }
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"saved baseline: {args.baseline}")
+    if any(entry["regressions"] for entry in comparison):
+        sys.exit(1)
@@ -0,0 +1,116 @@
+import csv
+import json
+import threading
+import time
+from contextlib import contextmanager
+
+STAGES = ["seek", "decode", "label", "transform", "encode", "write"]
+
+
+class ExtractionMetrics:
+    """
+    抽出の工程ごとの累計時間、回数、バイト数と、処理したフレーム数を記録する
+    複数のスレッドから記録してよい
+    """
+
+    def __init__(self, planned_frames=0):
+        self.lock = threading.Lock()
+        self.planned_frames = planned_frames
+        self.frames = 0
+        self.start_time = time.perf_counter()
+        self.stages = {stage: {"time": 0.0, "count": 0, "bytes": 0} for stage in STAGES}
+        self.history: list[dict] = []
+
+    def setPlannedFrames(self, planned_frames):
+        self.planned_frames = planned_frames
+
+    def add(self, stage, seconds, count=1, bytes=0):
+        with self.lock:
+            values = self.stages[stage]
+            values["time"] += seconds
+            values["count"] += count
+            values["bytes"] += bytes
+
+    @contextmanager
+    def measure(self, stage, bytes=0):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(stage, time.perf_counter() - start, 1, bytes)
+
+    def addFrames(self, count):
+        with self.lock:
+            self.frames += count
+
+    def mergeStages(self, stages: dict):
+        """
+        別のプロセスで記録した工程ごとの値を足し合わせる
+        """
+        with self.lock:
+            for stage, values in stages.items():
+                for key in ["time", "count", "bytes"]:
+                    self.stages[stage][key] += values[key]
+
+    def stageTotals(self) -> dict:
+        with self.lock:
+            return {stage: dict(values) for stage, values in self.stages.items()}
+
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.start_time
+
+    def framesPerSecond(self) -> float:
+        elapsed = self.elapsed()
+        return self.frames / elapsed if elapsed > 0 else 0.0
+
+    def eta(self) -> float | None:
+        """
+        :return: 計画したフレームを全て処理するまでの残り時間(秒)
+        """
+        fps = self.framesPerSecond()
+        if fps <= 0:
+            return None
+        return max(0, self.planned_frames - self.frames) / fps
+
+    def snapshot(self) -> dict:
+        return {
+            "elapsed": self.elapsed(),
+            "frames": self.frames,
+            "planned_frames": self.planned_frames,
+            "fps": self.framesPerSecond(),
+            "eta": self.eta(),
+            "stages": self.stageTotals(),
+        }
+
+    def record(self):
+        """
+        現時点の値を履歴に追加する(一定時間ごとの出力に使う)
+        """
+        self.history.append(self.snapshot())
+
+    def progressText(self) -> str:
+        eta = self.eta()
+        eta_text = "--:--:--" if eta == None else time.strftime("%H:%M:%S", time.gmtime(eta))
+        return f"{self.frames}/{self.planned_frames} {self.framesPerSecond():.1f} fps ETA {eta_text}"
+
+    def dump(self, path):
+        """
+        拡張子が.csvなら履歴と最終値を1行ずつ、それ以外はJSONで保存する
+        """
+        final = self.snapshot()
+        if path.lower().endswith(".csv"):
+            with open(path, "w", newline="") as f:
+                writer = csv.writer(f)
+                header = ["elapsed", "frames", "planned_frames", "fps", "eta"]
+                for stage in STAGES:
+                    header += [f"{stage}_time", f"{stage}_count", f"{stage}_bytes"]
+                writer.writerow(header)
+                for snapshot in self.history + [final]:
+                    row = [snapshot[key] for key in header[:5]]
+                    for stage in STAGES:
+                        values = snapshot["stages"][stage]
+                        row += [values["time"], values["count"], values["bytes"]]
+                    writer.writerow(row)
+        else:
+            with open(path, "w") as f:
+                json.dump({"final": final, "history": self.history}, f, indent=2)
@@ -0,0 +1,187 @@
+import json
+import os
+
+import cv2
+import numpy as np
+
+from extraction_metrics import ExtractionMetrics
+from frame_transform import FrameTransform
+from label_index import Condition
+
+HEADER_NAME = "header.json"
+FRAMES_NAME = "frames.u8"
+# フレームと並列に持つ配列 ファイル名は <名前>.bin
+ARRAYS = {
+    "labels": np.int8,
+    "timestamps": np.float64,
+    "frame_indices": np.int64,
+    "segments": np.int64,
+    "video_ids": np.int32,
+}
+
+
+def _readHeader(path) -> dict | None:
+    try:
+        with open(os.path.join(path, HEADER_NAME), "r") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def _writeHeader(path, header: dict):
+    # 書き込み途中で壊れないよう一時ファイルを置き換える
+    header_path = os.path.join(path, HEADER_NAME)
+    with open(f"{header_path}.tmp", "w") as f:
+        json.dump(header, f, indent=2)
+    os.replace(f"{header_path}.tmp", header_path)
+
+
+def _resizeFile(file_path, size):
+    with open(file_path, "ab") as f:
+        f.truncate(size)
+
+
+class FrameDataset:
+    """
+    固定サイズのフレームを1つのuint8のmemmapに並べたデータセット
+    ラベル、時刻、フレーム番号、領域番号、動画番号は同じ順の別の配列に入る
+    動画ごとに必要な数だけ領域を確保して追記していく
+    """
+
+    def __init__(self, path, mode="r"):
+        """
+        :param mode: 読み込みのみなら"r" 書き込むなら"r+"
+        """
+        header = _readHeader(path)
+        if header == None:
+            raise FileNotFoundError(f"dataset does not found: {path}")
+        self.path = path
+        self.shape = tuple(header["shape"])
+        self.videos: list[dict] = header["videos"]
+        self.count = header["count"]
+        self.frames = self.__open(FRAMES_NAME, np.uint8, mode, (self.count,) + self.shape)
+        for name, dtype in ARRAYS.items():
+            setattr(self, name, self.__open(f"{name}.bin", dtype, mode, (self.count,)))
+
+    def __open(self, file_name, dtype, mode, shape):
+        if shape[0] == 0:
+            # 空のファイルはmemmapできない
+            return np.zeros(shape, dtype=dtype)
+        return np.memmap(os.path.join(self.path, file_name), dtype, mode, shape=shape)
+
+    def __len__(self):
+        return self.count
+
+    def batch(self, start, size) -> dict[str, np.ndarray]:
+        """
+        start番目からsize個のフレームと付随する値を返す
+        memmapのスライスなのでコピーは発生しない
+        """
+        end = min(start + size, self.count)
+        result = {"frames": self.frames[start:end]}
+        for name in ARRAYS:
+            result[name] = getattr(self, name)[start:end]
+        return result
+
+    def flush(self):
+        for array in [self.frames] + [getattr(self, name) for name in ARRAYS]:
+            if isinstance(array, np.memmap):
+                array.flush()
+
+    @staticmethod
+    def reserve(path, shape, video_name, count) -> int:
+        """
+        動画1本分の領域を末尾に確保する データセットがなければ作成する
+        確保した領域は0(ラベルはINVALID)で埋められる(書き込まれなかったフレームの判別に使う)
+        :param shape: 1フレームの形(高さ, 幅, チャンネル数)
+        :return: 確保した領域の先頭の位置
+        """
+        os.makedirs(path, exist_ok=True)
+        header = _readHeader(path)
+        shape = [int(x) for x in shape]
+        if header == None:
+            header = {"shape": shape, "dtype": "uint8", "count": 0, "videos": []}
+        elif header["shape"] != shape:
+            raise ValueError(
+                f"frame shape {shape} does not match dataset shape {header['shape']}"
+            )
+        start = header["count"]
+        new_count = start + count
+        frame_bytes = int(np.prod(shape))
+        _resizeFile(os.path.join(path, FRAMES_NAME), new_count * frame_bytes)
+        for name, dtype in ARRAYS.items():
+            _resizeFile(
+                os.path.join(path, f"{name}.bin"), new_count * np.dtype(dtype).itemsize
+            )
+        header["count"] = new_count
+        header["videos"].append({"name": video_name, "start": start, "count": count})
+        _writeHeader(path, header)
+        return start
+
+    @staticmethod
+    def videoStart(path, video_name) -> tuple[int, int]:
+        """
+        :return: 最後に確保された動画の領域の(先頭の位置, 動画番号)
+        """
+        header = _readHeader(path)
+        for video_id in reversed(range(len(header["videos"]))):
+            if header["videos"][video_id]["name"] == video_name:
+                return header["videos"][video_id]["start"], video_id
+        raise KeyError(video_name)
+
+
+def fitFrame(frame, shape):
+    """
+    フレームをデータセットの形(高さ, 幅, チャンネル数)に合わせる
+    """
+    height, width, channels = shape
+    if frame.shape[0] != height or frame.shape[1] != width:
+        frame = cv2.resize(frame, (width, height), interpolation=cv2.INTER_AREA)
+    if channels == 1 and frame.ndim == 3:
+        frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+    if frame.ndim == 2:
+        frame = frame[:, :, None]
+    return frame
+
+
+class FrameDatasetSink:
+    """
+    reserveで確保済みの領域に、抽出したフレームを順に書き込む
+    """
+
+    def __init__(
+        self,
+        dataset_path,
+        video_name,
+        offset=0,
+        transform: FrameTransform | None = None,
+        metrics: ExtractionMetrics | None = None,
+    ):
+        """
+        :param offset: 動画の領域の先頭からの位置(並列に抽出する場合の担当範囲の先頭)
+        :param transform: データセットの形に合わせる前に行う変換
+        :param metrics: 変換と書き込みの時間を記録する先
+        """
+        self.transform = transform
+        self.metrics = metrics if metrics else ExtractionMetrics()
+        start, self.video_id = FrameDataset.videoStart(dataset_path, video_name)
+        self.dataset = FrameDataset(dataset_path, "r+")
+        self.position = start + offset
+
+    def write(self, frame, frame_index, timestamp, condition: Condition, segment):
+        position = self.position
+        with self.metrics.measure("transform"):
+            if self.transform:
+                frame = self.transform.apply(frame)
+            frame = fitFrame(frame, self.dataset.shape)
+        with self.metrics.measure("write", frame.nbytes):
+            self.dataset.frames[position] = frame
+        self.dataset.labels[position] = condition.value
+        self.dataset.timestamps[position] = timestamp
+        self.dataset.frame_indices[position] = frame_index
+        self.dataset.segments[position] = segment
+        self.dataset.video_ids[position] = self.video_id
+        self.position += 1
+
+    def close(self):
+        self.dataset.flush()
@@ -0,0 +1,159 @@
+import time
+
+import cv2
+
+from extraction_metrics import ExtractionMetrics
+
+# キーフレームの間隔を調べるときに読むパケット数の上限
+KEYFRAME_PROBE_PACKETS = 1000
+
+
+def measureKeyframeInterval(video_path, max_packets=KEYFRAME_PROBE_PACKETS) -> int | None:
+    """
+    デコードせずに先頭からパケットを読み、キーフレームの間隔(フレーム数)の中央値を求める
+    キーフレームが1つしかなければ読んだパケット数を返す(間隔はそれ以上)
+    FFmpeg以外のバックエンドなどで調べられなければNone
+    """
+    has_key_frame = getattr(cv2, "CAP_PROP_LRF_HAS_KEY_FRAME", None)
+    if has_key_frame == None:
+        return None
+    video = cv2.VideoCapture(video_path)
+    try:
+        # -1にするとgrabがデコードせずにパケットを読む
+        if not video.isOpened() or not video.set(cv2.CAP_PROP_FORMAT, -1):
+            return None
+        keyframes = []
+        count = 0
+        while count < max_packets and video.grab():
+            if video.get(has_key_frame):
+                keyframes.append(count)
+            count += 1
+    finally:
+        video.release()
+    if len(keyframes) == 0:
+        return None
+    if len(keyframes) == 1:
+        return max(1, count)
+    gaps = sorted(b - a for a, b in zip(keyframes[:-1], keyframes[1:]))
+    return gaps[len(gaps) // 2]
+
+
+class SparseDecoder:
+    """
+    指定されたフレームだけをretrieveで画像に変換し、それ以外はgrabで読み飛ばす
+    間が空いているときは、計測したシークと読み飛ばしのコストを比べて速い方を選ぶ
+    """
+
+    # 指数移動平均の重み
+    SMOOTHING = 0.2
+    # シーク自体のオーバーヘッドの初期値(秒)
+    SEEK_OVERHEAD = 0.002
+
+    def __init__(
+        self,
+        video: cv2.VideoCapture,
+        keyframe_interval: int | None = None,
+        metrics: ExtractionMetrics | None = None,
+    ):
+        """
+        :param keyframe_interval: キーフレームの間隔(フレーム数) measureKeyframeIntervalで調べたもの
+            不明ならNone
+        :param metrics: シークとデコードの時間を記録する先
+        """
+        self.video = video
+        self.metrics = metrics
+        self.position = int(video.get(cv2.CAP_PROP_POS_FRAMES))  # 次にgrabされるフレーム番号
+        # 調べられなかった場合はx264の既定値(keyint=250)と同程度を仮定する
+        self.keyframe_interval = 250
+        self.setKeyframeInterval(keyframe_interval)
+        self.grab_cost: float | None = None  # 1フレームをgrabする時間(秒)
+        self.seek_cost: float | None = None  # シークして1フレームgrabする時間(秒)
+        self.grab_count = 0
+        self.seek_count = 0
+        self.retrieve_count = 0
+
+    def setKeyframeInterval(self, keyframe_interval: int | None):
+        """
+        :param keyframe_interval: Noneなら変えない
+        """
+        if keyframe_interval != None:
+            self.keyframe_interval = keyframe_interval
+
+    def __smooth(self, current: float | None, value: float) -> float:
+        if current == None:
+            return value
+        return current + self.SMOOTHING * (value - current)
+
+    def estimatedGrabCost(self) -> float:
+        return self.grab_cost if self.grab_cost != None else 0.001
+
+    def estimatedSeekCost(self) -> float:
+        if self.seek_cost != None:
+            return self.seek_cost
+        # シーク先の直前のキーフレームから平均して間隔の半分をデコードする
+        return (
+            self.SEEK_OVERHEAD
+            + self.keyframe_interval / 2 * self.estimatedGrabCost()
+        )
+
+    def shouldSeek(self, frame_index: int) -> bool:
+        gap = frame_index - self.position
+        if gap < 0:
+            # 後ろには戻れないのでシークするしかない
+            return True
+        return gap * self.estimatedGrabCost() > self.estimatedSeekCost()
+
+    def __grab(self) -> bool:
+        start = time.perf_counter()
+        ret = self.video.grab()
+        elapsed = time.perf_counter() - start
+        self.grab_cost = self.__smooth(self.grab_cost, elapsed)
+        if self.metrics:
+            self.metrics.add("decode", elapsed)
+        self.grab_count += 1
+        self.position += 1
+        return ret
+
+    def __seek(self, frame_index: int) -> bool:
+        start = time.perf_counter()
+        self.video.set(cv2.CAP_PROP_POS_FRAMES, frame_index)
+        ret = self.video.grab()
+        elapsed = time.perf_counter() - start
+        self.seek_cost = self.__smooth(self.seek_cost, elapsed)
+        if self.metrics:
+            self.metrics.add("seek", elapsed)
+        self.seek_count += 1
+        self.position = frame_index + 1
+        return ret
+
+    def read(self, frame_index: int):
+        """
+        :return: 指定したフレームの画像 読めなかったらNone
+        """
+        if frame_index != self.position and self.shouldSeek(frame_index):
+            ret = self.__seek(frame_index)
+        else:
+            ret = False
+            while self.position <= frame_index:
+                ret = self.__grab()
+                if not ret:
+                    return None
+        if not ret:
+            return None
+        start = time.perf_counter()
+        ret, frame = self.video.retrieve()
+        self.retrieve_count += 1
+        if self.metrics and ret:
+            self.metrics.add("decode", time.perf_counter() - start, 1, frame.nbytes)
+        return frame if ret else None
+
+    def frames(self, frame_indices):
+        """
+        昇順のフレーム番号を順に読み、(番号, 画像)を返す
+        読めなくなったら終了する
+        """
+        for frame_index in frame_indices:
+            frame = self.read(int(frame_index))
+            if frame is None:
+                return
+            yield int(frame_index), frame
@@ -0,0 +1,144 @@
+import cv2
+import numpy as np
+
+INTERPOLATIONS = {
+    "nearest": cv2.INTER_NEAREST,
+    "linear": cv2.INTER_LINEAR,
+    "area": cv2.INTER_AREA,
+    "cubic": cv2.INTER_CUBIC,
+    "lanczos": cv2.INTER_LANCZOS4,
+}
+
+
+class FrameTransform:
+    """
+    デコードしたフレームをエンコードする前に変換する
+    切り抜き → 縮小(またはレターボックス) → グレースケール の順に行う
+    """
+
+    def __init__(
+        self,
+        size: tuple[int, int] | None = None,
+        interpolation="area",
+        crop: str | tuple[int, int, int, int] | None = None,
+        grayscale=False,
+        letterbox=False,
+    ):
+        """
+        :param size: 出力の(幅, 高さ) Noneなら大きさを変えない
+        :param interpolation: nearest, linear, area, cubic, lanczosのいずれか
+        :param crop: "center"なら出力と同じ縦横比で中央を切り抜く
+        (x, y, 幅, 高さ)ならその範囲を切り抜く
+        :param letterbox: 縦横比を保って縮小し、余白を黒で埋める
+        """
+        if interpolation not in INTERPOLATIONS:
+            raise ValueError(f"unsupported interpolation: {interpolation}")
+        if crop == "center" and size == None:
+            raise ValueError("center crop requires size")
+        self.size = tuple(size) if size else None
+        self.interpolation = interpolation
+        self.crop = crop if crop == None or crop == "center" else tuple(crop)
+        self.grayscale = grayscale
+        self.letterbox = letterbox
+
+    def isIdentity(self) -> bool:
+        return self.size == None and self.crop == None and not self.grayscale
+
+    def describe(self) -> dict:
+        """
+        出力に影響する設定(出力の記録に使う)
+        """
+        return {
+            "size": list(self.size) if self.size else None,
+            "interpolation": self.interpolation,
+            "crop": self.crop if self.crop == None or self.crop == "center" else list(self.crop),
+            "grayscale": self.grayscale,
+            "letterbox": self.letterbox,
+        }
+
+    def cropRect(self, height, width) -> tuple[int, int, int, int] | None:
+        """
+        :return: 元のフレームでの切り抜く範囲(x, y, 幅, 高さ)
+        """
+        if self.crop == None:
+            return None
+        if self.crop == "center":
+            target_width, target_height = self.size
+            scale = min(width / target_width, height / target_height)
+            crop_width = int(round(target_width * scale))
+            crop_height = int(round(target_height * scale))
+            return (
+                (width - crop_width) // 2,
+                (height - crop_height) // 2,
+                crop_width,
+                crop_height,
+            )
+        x, y, crop_width, crop_height = self.crop
+        x = min(max(0, x), width)
+        y = min(max(0, y), height)
+        return x, y, min(crop_width, width - x), min(crop_height, height - y)
+
+    def __resize(self, frame, out=None):
+        target_width, target_height = self.size
+        interpolation = INTERPOLATIONS[self.interpolation]
+        if not self.letterbox:
+            return cv2.resize(
+                frame, (target_width, target_height), dst=out, interpolation=interpolation
+            )
+        height, width = frame.shape[:2]
+        scale = min(target_width / width, target_height / height)
+        scaled_width = max(1, int(round(width * scale)))
+        scaled_height = max(1, int(round(height * scale)))
+        if out is None:
+            out = np.zeros((target_height, target_width) + frame.shape[2:], frame.dtype)
+        else:
+            out[...] = 0
+        left = (target_width - scaled_width) // 2
+        top = (target_height - scaled_height) // 2
+        out[top : top + scaled_height, left : left + scaled_width] = cv2.resize(
+            frame, (scaled_width, scaled_height), interpolation=interpolation
+        )
+        return out
+
+    def apply(self, frame):
+        """
+        1フレームを変換する
+        """
+        if self.isIdentity():
+            return frame
+        return self.applyBatch(frame[None])[0]
+
+    def applyBatch(self, frames):
+        """
+        同じ大きさのフレームをまとめて変換する
+        :param frames: (枚数, 高さ, 幅, チャンネル数)の配列
+        """
+        frames = np.asarray(frames)
+        rect = self.cropRect(frames.shape[1], frames.shape[2])
+        if rect != None:
+            # 切り抜きは全フレームのスライスで済む
+            x, y, width, height = rect
+            frames = frames[:, y : y + height, x : x + width]
+        if self.size != None:
+            target_width, target_height = self.size
+            resized = np.empty(
+                (len(frames), target_height, target_width) + frames.shape[3:], np.uint8
+            )
+            for i in range(len(frames)):
+                self.__resize(frames[i], resized[i])
+            frames = resized
+        if self.grayscale and frames.ndim == 4:
+            frames = toGrayscale(frames)
+        return frames
+
+
+def toGrayscale(frames):
+    """
+    BGRのフレームをまとめてグレースケールにする
+    cv2.cvtColorと同じ固定小数点の係数を使う
+    """
+    frames = frames.astype(np.uint32)
+    gray = (
+        frames[..., 0] * 1868 + frames[..., 1] * 9617 + frames[..., 2] * 4899 + 8192
+    ) >> 14
+    return gray.astype(np.uint8)
@@ -1,27 +1,140 @@
+import time
 from typing import Callable
 
+from PyQt5.QtCore import QTimer
+
+
+class _Listener:
+    def __init__(self, callback: Callable[[any, any], None], min_interval: float | None):
+        self.callback = callback
+        self.min_interval = min_interval
+        self.last_called: float | None = None
+        self.pending: tuple[any, any] | None = None  # 間隔が空くのを待っている(source, value)
+
 
 class GUIProperty:
-    def __init__(self, default_value: any):
+    def __init__(self, default_value: any, skip_equal=False, batch=False, name=None):
+        """
+        :param skip_equal: Trueなら、変換後の値が今の値と等しいときは通知しない
+        :param batch: Trueなら、setValueをすぐには通知せず、イベントループに戻ってから最後の値を1回だけ通知する
+        :param name: 計測結果に表示する名前
+        """
         self._value = default_value
-        self.listeners: dict[any, Callable[[any], None]] = {}
+        self.listeners: dict[any, _Listener] = {}
         self.converter = None
+        self.skip_equal = skip_equal
+        self.batch = batch
+        self.name = name
+        self.notified_value = default_value  # 最後に通知した値
+        self.batch_source = None
+        self.batch_scheduled = False
+        self.batch_force = False
+        # キーから[呼んだ回数, 合計時間(秒)] Noneなら計測しない
+        self.stats: dict[any, list] | None = None
+        self.skipped = 0  # 値が等しいため通知しなかった回数
 
-    def setValue(self, source, value):
+    def setValue(self, source, value, force=False):
+        """
+        :param force: Trueなら、skip_equalでも値が等しいときに通知する
+        """
         if self.converter:
             value = self.converter(value)
+        if self.skip_equal and not force and value == self._value:
+            self.skipped += 1
+            return
         self._value = value
-        for listener in self.listeners.values():
-            listener(source, value)
+        if self.batch:
+            self.batch_source = source
+            self.batch_force = self.batch_force or force
+            if not self.batch_scheduled:
+                self.batch_scheduled = True
+                QTimer.singleShot(0, self.__flushBatch)
+        else:
+            self.__notify(source, value)
 
     def getValue(self):
         return self._value
 
-    def addListener(self, key: any, listener: Callable[[any, any], None]):
-        self.listeners[key] = listener
+    def addListener(
+        self, key: any, listener: Callable[[any, any], None], min_interval: float | None = None
+    ):
+        """
+        :param min_interval: 指定すれば、この秒数より短い間隔では呼ばない
+            間に変わった値は、間隔が空いてから最後の値で1回だけ呼ぶ
+        """
+        self.listeners[key] = _Listener(listener, min_interval)
 
     def removeListener(self, key: any):
         del self.listeners[key]
 
     def setValueConverter(self, converter: Callable[[any], any]):
         self.converter = converter
+
+    def setStatsEnabled(self, enabled: bool):
+        """
+        リスナーごとの呼んだ回数と時間を計測するか 有効にするたびに計測結果を消す
+        """
+        self.stats = {} if enabled else None
+        self.skipped = 0
+
+    def listenerStats(self) -> dict[any, dict]:
+        """
+        :return: キーから{"calls": 呼んだ回数, "seconds": 合計時間(秒)}
+        時間には、リスナーの中で値を変えたほかのプロパティのリスナーの時間も含まれる
+        """
+        if self.stats == None:
+            return {}
+        return {
+            key: {"calls": calls, "seconds": seconds}
+            for key, (calls, seconds) in self.stats.items()
+        }
+
+    def __flushBatch(self):
+        self.batch_scheduled = False
+        force = self.batch_force
+        self.batch_force = False
+        if self.skip_equal and not force and self._value == self.notified_value:
+            self.skipped += 1
+            return
+        self.__notify(self.batch_source, self._value)
+
+    def __notify(self, source, value):
+        self.notified_value = value
+        # 呼んでいる間にリスナーが増減してもよいように写しを使う
+        for key, listener in list(self.listeners.items()):
+            if listener.min_interval == None:
+                self.__call(key, listener, source, value)
+            else:
+                self.__throttle(key, listener, source, value)
+
+    def __throttle(self, key, listener: _Listener, source, value):
+        wait = 0.0
+        if listener.last_called != None:
+            wait = listener.last_called + listener.min_interval - time.perf_counter()
+        if wait <= 0 and listener.pending == None:
+            self.__call(key, listener, source, value)
+            return
+        scheduled = listener.pending != None
+        listener.pending = (source, value)
+        if not scheduled:
+            QTimer.singleShot(
+                max(0, int(wait * 1000)), lambda: self.__flushListener(key, listener)
+            )
+
+    def __flushListener(self, key, listener: _Listener):
+        pending = listener.pending
+        listener.pending = None
+        if pending != None and self.listeners.get(key) is listener:
+            self.__call(key, listener, *pending)
+
+    def __call(self, key, listener: _Listener, source, value):
+        listener.last_called = time.perf_counter()
+        if self.stats == None:
+            listener.callback(source, value)
+            return
+        try:
+            listener.callback(source, value)
+        finally:
+            entry = self.stats.setdefault(key, [0, 0.0])
+            entry[0] += 1
+            entry[1] += time.perf_counter() - listener.last_called
@@ -0,0 +1,132 @@
+import os
+import threading
+import time
+from queue import Queue
+
+import cv2
+
+from extraction_metrics import ExtractionMetrics
+from frame_transform import FrameTransform
+
+
+class ImageEncoder:
+    """
+    保存する画像の形式と圧縮の設定
+    """
+
+    EXTENSIONS = {"png": ".png", "jpg": ".jpg", "webp": ".webp"}
+
+    def __init__(self, format="png", png_compression=None, quality=None):
+        """
+        :param format: png, jpg, webpのいずれか
+        :param png_compression: PNGの圧縮レベル(0-9) Noneならopencvの既定値
+        :param quality: JPEG/WebPの品質(0-100) Noneならopencvの既定値
+        """
+        format = format.lower()
+        if format == "jpeg":
+            format = "jpg"
+        if format not in self.EXTENSIONS:
+            raise ValueError(f"unsupported format: {format}")
+        self.format = format
+        self.png_compression = png_compression
+        self.quality = quality
+
+    def extension(self) -> str:
+        return self.EXTENSIONS[self.format]
+
+    def params(self) -> list[int]:
+        if self.format == "png" and self.png_compression != None:
+            return [cv2.IMWRITE_PNG_COMPRESSION, int(self.png_compression)]
+        elif self.format == "jpg" and self.quality != None:
+            return [cv2.IMWRITE_JPEG_QUALITY, int(self.quality)]
+        elif self.format == "webp" and self.quality != None:
+            return [cv2.IMWRITE_WEBP_QUALITY, int(self.quality)]
+        return []
+
+    def encode(self, frame) -> bytes:
+        ret, buffer = cv2.imencode(self.extension(), frame, self.params())
+        if not ret:
+            raise RuntimeError(f"failed to encode {self.format}")
+        return buffer.tobytes()
+
+
+class AsyncImageWriter:
+    """
+    変換、エンコード、書き込みを別スレッドで行う
+    キューが一杯のときはsubmitが待つので、メモリに溜まるフレーム数は上限を超えない
+    """
+
+    def __init__(
+        self,
+        encoder: ImageEncoder | None = None,
+        threads=4,
+        queue_size=32,
+        transform: FrameTransform | None = None,
+        metrics: ExtractionMetrics | None = None,
+    ):
+        """
+        :param threads: 変換、エンコード、書き込みを行うスレッド数
+        :param queue_size: 書き込み待ちにできるフレーム数の上限
+        :param transform: エンコードの前に行う変換
+        :param metrics: 変換、エンコード、書き込みの時間を記録する先
+        """
+        self.encoder = encoder if encoder else ImageEncoder()
+        self.transform = transform
+        self.metrics = metrics if metrics else ExtractionMetrics()
+        self.queue: Queue = Queue(maxsize=max(1, queue_size))
+        self.error: BaseException | None = None
+        self.threads = [
+            threading.Thread(target=self.__run, daemon=True)
+            for _ in range(max(1, threads))
+        ]
+        for thread in self.threads:
+            thread.start()
+
+    def __run(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item == None:
+                    return
+                frame, path = item
+                if self.transform:
+                    with self.metrics.measure("transform"):
+                        frame = self.transform.apply(frame)
+                start = time.perf_counter()
+                data = self.encoder.encode(frame)
+                self.metrics.add("encode", time.perf_counter() - start, 1, len(data))
+                with self.metrics.measure("write", len(data)):
+                    with open(path, "wb") as f:
+                        f.write(data)
+            except BaseException as e:
+                if self.error == None:
+                    self.error = e
+            finally:
+                self.queue.task_done()
+
+    def __raiseError(self):
+        if self.error != None:
+            raise self.error
+
+    def submit(self, frame, parent, name):
+        """
+        :param name: 拡張子を含まないファイル名
+        """
+        self.__raiseError()
+        self.queue.put((frame, os.path.join(parent, name + self.encoder.extension())))
+
+    def close(self):
+        """
+        全ての書き込みが終わるまで待つ
+        """
+        for _ in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.__raiseError()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -0,0 +1,175 @@
+import copy
+import json
+from enum import Enum
+
+import numpy as np
+
+
+class Condition(Enum):
+    INVALID = 0
+    SAFE = 1
+    DANGER = 2
+
+
+def _mergeIntervals(intervals: list[tuple[float, float]]) -> tuple[np.ndarray, np.ndarray]:
+    """
+    閉区間のリストをソートし、重なっている(接している)区間を結合する
+    :return: (開始時刻の配列, 終了時刻の配列) どちらも昇順
+    """
+    intervals = sorted((s, e) for s, e in intervals if s <= e)
+    starts = []
+    ends = []
+    for start, end in intervals:
+        if ends and start <= ends[-1]:
+            ends[-1] = max(ends[-1], end)
+        else:
+            starts.append(start)
+            ends.append(end)
+    return np.array(starts, dtype=np.float64), np.array(ends, dtype=np.float64)
+
+
+def convertLegacyTime(times, video_fps: float):
+    """
+    "fps"のない古い形式の.txtは、fpsを整数に切り捨てて(フレーム番号/int(fps)で)時刻を計算したGUIで保存されている
+    その時刻をフレーム番号/video_fpsの時刻に直す
+    :param times: 古い形式の時刻(秒) 配列も可
+    """
+    if video_fps <= 0 or int(video_fps) <= 0:
+        return times
+    frames = np.asarray(times, dtype=np.float64) * int(video_fps)
+    # フレーム番号から計算した時刻は、浮動小数の誤差を除いてフレーム番号に戻す
+    rounded = np.round(frames)
+    frames = np.where(np.abs(frames - rounded) < 1e-6, rounded, frames)
+    result = frames / video_fps
+    return result if np.ndim(times) else float(result)
+
+
+def convertLegacyAnnotation(annotation: dict, video_fps: float) -> dict:
+    """
+    "fps"のない古い形式のアノテーションの時刻を直し、"fps"を書き込んだものを返す
+    "fps"があればそのまま返す
+    """
+    if "fps" in annotation:
+        return annotation
+
+    def convert(obj: dict) -> dict:
+        return {
+            "start": convertLegacyTime(obj["start"], video_fps),
+            "end": convertLegacyTime(obj["end"], video_fps),
+            "children": [convert(child) for child in obj["children"]],
+        }
+
+    result = convert(annotation)
+    result["fps"] = video_fps
+    return result
+
+
+def _contains(starts: np.ndarray, ends: np.ndarray, times: np.ndarray) -> np.ndarray:
+    """
+    各時刻がいずれかの閉区間に含まれているかをまとめて判定する
+    """
+    i = np.searchsorted(starts, times, side="right") - 1
+    inside = i >= 0
+    inside[inside] = times[inside] <= ends[i[inside]]
+    return inside
+
+
+class LabelIndex:
+    """
+    アノテーションの木を一度だけ区間配列に変換し、
+    時刻からラベルを二分探索(O(log n))で求める
+
+    深さ1の領域(有効)がSAFE、その子(深さ2)がDANGER、それ以外がINVALID
+    境界は両端を含む(getConditionと同じ)
+    """
+
+    def __init__(self, annotation: dict):
+        # 時刻の基準にしたfps 古い形式ではNone(forVideoFpsで直す)
+        self.fps = annotation.get("fps")
+        self.start = annotation["start"]
+        self.end = annotation["end"]
+        valid = []
+        danger = []
+        for child in annotation["children"]:
+            # 親の範囲外は無効なので切り取っておく
+            child_start = max(child["start"], self.start)
+            child_end = min(child["end"], self.end)
+            valid.append((child_start, child_end))
+            for grandchild in child["children"]:
+                danger.append(
+                    (
+                        max(grandchild["start"], child_start),
+                        min(grandchild["end"], child_end),
+                    )
+                )
+        self.valid_starts, self.valid_ends = _mergeIntervals(valid)
+        self.danger_starts, self.danger_ends = _mergeIntervals(danger)
+
+    @classmethod
+    def fromFile(cls, annotation_path: str) -> "LabelIndex":
+        with open(annotation_path, "r") as f:
+            return cls(json.load(f))
+
+    def forVideoFps(self, video_fps: float) -> "LabelIndex":
+        """
+        古い形式なら時刻をフレーム番号/video_fpsの時刻に直したものを返す そうでなければself
+        """
+        if self.fps != None:
+            return self
+        result = copy.copy(self)
+        result.fps = video_fps
+        result.start = convertLegacyTime(self.start, video_fps)
+        result.end = convertLegacyTime(self.end, video_fps)
+        result.valid_starts = convertLegacyTime(self.valid_starts, video_fps)
+        result.valid_ends = convertLegacyTime(self.valid_ends, video_fps)
+        result.danger_starts = convertLegacyTime(self.danger_starts, video_fps)
+        result.danger_ends = convertLegacyTime(self.danger_ends, video_fps)
+        return result
+
+    def validIntervals(self) -> tuple[np.ndarray, np.ndarray]:
+        """
+        :return: 有効な領域の(開始時刻, 終了時刻) 昇順で重なりなし
+        """
+        return self.valid_starts, self.valid_ends
+
+    def labels(self, times) -> np.ndarray:
+        """
+        時刻の配列をまとめてラベル付けする
+        :param times: 時刻(秒)の配列
+        :return: Conditionの値(int8)の配列
+        """
+        times = np.asarray(times, dtype=np.float64)
+        result = np.full(times.shape, Condition.INVALID.value, dtype=np.int8)
+        flat_times = times.reshape(-1)
+        flat_result = result.reshape(-1)
+        flat_result[_contains(self.valid_starts, self.valid_ends, flat_times)] = (
+            Condition.SAFE.value
+        )
+        flat_result[_contains(self.danger_starts, self.danger_ends, flat_times)] = (
+            Condition.DANGER.value
+        )
+        return result
+
+    def getCondition(self, time: float) -> Condition:
+        return Condition(int(self.labels(np.array([time]))[0]))
+
+    def isInValidArea(self, time: float) -> bool:
+        return bool(_contains(self.valid_starts, self.valid_ends, np.array([time]))[0])
+
+    def nextValidStart(self, time: float) -> float | None:
+        """
+        :return: time以降で最も近い有効な領域の開始時刻 なければNone
+        """
+        i = np.searchsorted(self.valid_starts, time, side="left")
+        if i < len(self.valid_starts):
+            return float(self.valid_starts[i])
+        return None
+
+    def frameLabels(self, frame_count: int, fps: float) -> np.ndarray:
+        """
+        動画の全フレームのラベルを求める
+        :param frame_count: フレーム数
+        :param fps: 動画のfps(小数も可)
+        :return: フレーム番号をインデックスとするConditionの値(int8)の配列
+        """
+        return self.forVideoFps(fps).labels(np.arange(frame_count, dtype=np.float64) / fps)
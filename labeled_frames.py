@@ -0,0 +1,207 @@
+import threading
+from queue import Empty, Full, Queue
+from typing import NamedTuple
+
+import cv2
+import numpy as np
+
+from extraction_metrics import ExtractionMetrics
+from frame_decoder import SparseDecoder
+from frame_transform import FrameTransform
+from label_index import Condition, LabelIndex
+from sampling_plan import SamplingPlan, planVideo
+
+
+class LabeledFrame(NamedTuple):
+    frame: np.ndarray
+    condition: Condition
+    timestamp: float
+    segment: int
+    frame_index: int
+
+
+class LabeledBatch(NamedTuple):
+    """
+    batch_size枚のフレームをまとめたもの 最後のバッチだけは少ないことがある
+    """
+
+    frames: np.ndarray  # (枚数, 高さ, 幅, チャンネル数)
+    labels: np.ndarray  # Conditionの値
+    timestamps: np.ndarray
+    segments: np.ndarray
+    frame_indices: np.ndarray
+
+
+# 先読みスレッドが終わったことを表す
+_END = object()
+
+
+class LabeledFrameStream:
+    """
+    計画に従ってフレームをデコードし、ラベル付きで1枚ずつ(またはバッチで)返す
+    ディスクには何も書き込まない
+    prefetchが1以上なら別スレッドでデコードを先に進めておく
+    途中でやめる場合はcloseを呼ぶ(withでも使える)とキャプチャが解放される
+    """
+
+    def __init__(
+        self,
+        video_path,
+        plan: SamplingPlan,
+        batch_size: int | None = None,
+        prefetch=0,
+        transform: FrameTransform | None = None,
+        metrics: ExtractionMetrics | None = None,
+    ):
+        """
+        :param batch_size: Noneなら1枚ずつLabeledFrameを、指定すればLabeledBatchを返す
+        :param prefetch: 先読みしておく要素(フレームまたはバッチ)の数 0なら先読みしない
+        :param transform: 返す前に行う変換 バッチの場合はまとめて変換する
+        :param metrics: シーク、デコード、変換の時間を記録する先
+        """
+        self.metrics = metrics
+        self.video = cv2.VideoCapture(video_path)
+        if not self.video.isOpened():
+            raise FileNotFoundError(f"failed to open video: {video_path}")
+        self.plan = plan
+        self.batch_size = batch_size
+        self.transform = transform
+        self.closed = False
+        self.__items = self.__generate()
+        self.queue: Queue | None = None
+        self.thread: threading.Thread | None = None
+        if prefetch > 0:
+            self.queue = Queue(maxsize=prefetch)
+            self.stop_event = threading.Event()
+            self.thread = threading.Thread(target=self.__readAhead, daemon=True)
+            self.thread.start()
+
+    def __generate(self):
+        plan = self.plan
+        # キーフレームの間隔は計画を作るときに1回だけ調べてある
+        decoder = SparseDecoder(self.video, plan.keyframe_interval, metrics=self.metrics)
+        batch = []
+        for i, (frame_index, frame) in enumerate(decoder.frames(plan.frame_indices)):
+            if self.batch_size == None:
+                if self.transform:
+                    frame = self.__transform(self.transform.apply, frame)
+                yield LabeledFrame(
+                    frame,
+                    Condition(int(plan.labels[i])),
+                    float(plan.timestamps[i]),
+                    int(plan.segments[i]),
+                    frame_index,
+                )
+            else:
+                batch.append((i, frame))
+                if len(batch) == self.batch_size:
+                    yield self.__createBatch(batch)
+                    batch = []
+        if batch:
+            yield self.__createBatch(batch)
+
+    def __transform(self, function, frames):
+        if self.metrics == None:
+            return function(frames)
+        with self.metrics.measure("transform"):
+            return function(frames)
+
+    def __createBatch(self, batch) -> LabeledBatch:
+        indices = np.array([i for i, _ in batch])
+        frames = np.stack([frame for _, frame in batch])
+        if self.transform:
+            frames = self.__transform(self.transform.applyBatch, frames)
+        return LabeledBatch(
+            frames,
+            self.plan.labels[indices],
+            self.plan.timestamps[indices],
+            self.plan.segments[indices],
+            self.plan.frame_indices[indices],
+        )
+
+    def __put(self, item) -> bool:
+        """
+        :return: closeされたらFalse
+        """
+        while not self.stop_event.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return True
+            except Full:
+                continue
+        return False
+
+    def __readAhead(self):
+        try:
+            for item in self.__items:
+                if not self.__put(item):
+                    return
+            self.__put(_END)
+        except BaseException as e:
+            self.__put(e)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.closed:
+            raise StopIteration
+        if self.thread == None:
+            try:
+                return next(self.__items)
+            except StopIteration:
+                self.close()
+                raise
+        item = self.queue.get()
+        if item is _END:
+            self.close()
+            raise StopIteration
+        if isinstance(item, BaseException):
+            self.close()
+            raise item
+        return item
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        if self.thread != None:
+            self.stop_event.set()
+            # 先読みスレッドがputで待っていれば抜けられるよう空にする
+            while True:
+                try:
+                    self.queue.get_nowait()
+                except Empty:
+                    break
+            self.thread.join()
+        self.__items.close()
+        self.video.release()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def iterLabeledFrames(
+    video_path,
+    annotation: dict | LabelIndex | str,
+    fps: float,
+    batch_size: int | None = None,
+    prefetch=0,
+    transform: FrameTransform | None = None,
+) -> LabeledFrameStream:
+    """
+    有効な領域からfpsで選んだフレームを、ラベル、時刻、領域番号と一緒に返す
+    :param annotation: アノテーションの辞書、LabelIndex、アノテーションファイルのパスのいずれか
+    :param fps: 抽出するfps(小数も可)
+    """
+    if isinstance(annotation, str):
+        label_index = LabelIndex.fromFile(annotation)
+    elif isinstance(annotation, LabelIndex):
+        label_index = annotation
+    else:
+        label_index = LabelIndex(annotation)
+    plan = planVideo(video_path, label_index, fps)
+    return LabeledFrameStream(video_path, plan, batch_size, prefetch, transform)
@@ -0,0 +1,174 @@
+import hashlib
+import json
+import os
+
+from label_index import Condition
+from output_sink import ExtractOptions, imageFileName
+from sampling_plan import SamplingPlan
+
+MANIFEST_NAME = "manifest.json"
+# 動画の先頭と末尾からハッシュを取る大きさ(バイト)
+VIDEO_HASH_SAMPLE = 1 << 20
+
+
+def hashFile(path) -> str:
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def hashVideo(path) -> str:
+    """
+    数GBの動画を全部読まないよう、大きさと先頭と末尾だけからハッシュを取る
+    """
+    size = os.path.getsize(path)
+    h = hashlib.sha1(str(size).encode("utf-8"))
+    with open(path, "rb") as f:
+        h.update(f.read(VIDEO_HASH_SAMPLE))
+        if size > VIDEO_HASH_SAMPLE:
+            f.seek(max(VIDEO_HASH_SAMPLE, size - VIDEO_HASH_SAMPLE))
+            h.update(f.read())
+    return h.hexdigest()
+
+
+class ExtractionManifest:
+    """
+    1フレーム1ファイルのモードで出力した内容の記録
+    再実行時に前回の記録と比べ、変わったフレームだけを書き直すのに使う
+    """
+
+    def __init__(self, video_hash, annotation_hash, settings: dict, frames: dict):
+        """
+        :param settings: 出力に影響する設定 これが違う場合は全て出力し直す
+        :param frames: フレーム番号から(ラベル, 出力フォルダーからの相対パス)への辞書
+        """
+        self.video_hash = video_hash
+        self.annotation_hash = annotation_hash
+        self.settings = settings
+        self.frames = frames
+
+    @classmethod
+    def create(
+        cls,
+        video_path,
+        annotation_path,
+        plan: SamplingPlan,
+        mode,
+        options: ExtractOptions,
+    ) -> "ExtractionManifest":
+        name_mode = mode == "name"
+        extension = options.encoder.extension()
+        frames = {}
+        for frame_index, label, segment in zip(
+            plan.frame_indices, plan.labels, plan.segments
+        ):
+            condition = Condition(int(label))
+            file_name = imageFileName(int(frame_index), condition, int(segment), name_mode)
+            if file_name != None:
+                path = os.path.join(file_name[0], file_name[1] + extension)
+                frames[int(frame_index)] = (condition.value, path)
+        settings = {
+            "mode": mode,
+            "target_fps": plan.target_fps,
+            "format": options.encoder.format,
+            "params": options.encoder.params(),
+            "transform": options.transform.describe() if options.transform else None,
+        }
+        return cls(hashVideo(video_path), hashFile(annotation_path), settings, frames)
+
+    @classmethod
+    def load(cls, output_path) -> "ExtractionManifest | None":
+        try:
+            with open(os.path.join(output_path, MANIFEST_NAME), "r") as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return None
+        frames = {
+            frame_index: (label, path) for frame_index, label, path in data["frames"]
+        }
+        return cls(data["video_hash"], data["annotation_hash"], data["settings"], frames)
+
+    def save(self, output_path):
+        data = {
+            "video_hash": self.video_hash,
+            "annotation_hash": self.annotation_hash,
+            "settings": self.settings,
+            "frames": [
+                [frame_index, label, path]
+                for frame_index, (label, path) in sorted(self.frames.items())
+            ],
+        }
+        os.makedirs(output_path, exist_ok=True)
+        manifest_path = os.path.join(output_path, MANIFEST_NAME)
+        with open(f"{manifest_path}.tmp", "w") as f:
+            json.dump(data, f)
+        os.replace(f"{manifest_path}.tmp", manifest_path)
+
+    @staticmethod
+    def remove(output_path):
+        try:
+            os.remove(os.path.join(output_path, MANIFEST_NAME))
+        except FileNotFoundError:
+            pass
+
+    def isCompatible(self, other: "ExtractionManifest") -> bool:
+        """
+        同じ動画を同じ設定で出力したものかどうか
+        アノテーションが違っても互換とし、applyでラベルが変わったフレームだけを付け直す
+        """
+        return self.video_hash == other.video_hash and self.settings == other.settings
+
+    def relabeledFrames(self, new: "ExtractionManifest") -> set[int]:
+        """
+        :return: 両方の記録にあり、アノテーションの変更でラベルが変わったフレーム番号
+        """
+        if self.annotation_hash == new.annotation_hash:
+            return set()
+        return {
+            frame_index
+            for frame_index, (label, _) in new.frames.items()
+            if frame_index in self.frames and self.frames[frame_index][0] != label
+        }
+
+    def apply(self, output_path, new: "ExtractionManifest") -> set[int]:
+        """
+        前回の出力(self)を新しい記録に合わせる
+        ラベルが変わったフレームは移動し、不要になったフレームは削除する
+        :return: 新たにデコードして書き込む必要があるフレーム番号
+        """
+        need_decode = set()
+        changed_folders = set()
+        relabeled = self.relabeledFrames(new)
+        for frame_index, (_, new_path) in new.frames.items():
+            new_file = os.path.join(output_path, new_path)
+            if frame_index not in self.frames:
+                need_decode.add(frame_index)
+                continue
+            old_file = os.path.join(output_path, self.frames[frame_index][1])
+            if old_file == new_file:
+                # ラベルが変わったのに保存先が同じなら、前の出力は使わず書き直す
+                if frame_index in relabeled or not os.path.exists(new_file):
+                    need_decode.add(frame_index)
+            elif os.path.exists(old_file):
+                os.makedirs(os.path.dirname(new_file), exist_ok=True)
+                os.replace(old_file, new_file)
+                changed_folders.add(os.path.dirname(old_file))
+            else:
+                need_decode.add(frame_index)
+
+        for frame_index, (_, old_path) in self.frames.items():
+            if frame_index not in new.frames:
+                old_file = os.path.join(output_path, old_path)
+                try:
+                    os.remove(old_file)
+                except FileNotFoundError:
+                    pass
+                changed_folders.add(os.path.dirname(old_file))
+
+        # nameモードで空になった領域のフォルダーを消す
+        for folder in changed_folders if new.settings["mode"] == "name" else []:
+            if os.path.isdir(folder) and len(os.listdir(folder)) == 0:
+                os.rmdir(folder)
+        return need_decode
@@ -0,0 +1,149 @@
+import os
+
+from extraction_metrics import ExtractionMetrics
+from frame_dataset import FrameDatasetSink
+from frame_transform import FrameTransform
+from image_writer import AsyncImageWriter, ImageEncoder
+from label_index import Condition
+from shard_writer import ShardWriter
+
+
+class ExtractOptions:
+    """
+    抽出したフレームの保存方法の設定
+    プロセスをまたいで渡すのでpickleできる値だけを持つ
+    """
+
+    def __init__(
+        self,
+        encoder: ImageEncoder | None = None,
+        write_threads=4,
+        queue_size=32,
+        shard_size=1 << 30,
+        frame_shape=(224, 224, 3),
+        transform: FrameTransform | None = None,
+    ):
+        """
+        :param encoder: 保存する画像の形式 NoneならPNG
+        :param write_threads: エンコードと書き込みを行うスレッド数
+        :param queue_size: 書き込み待ちにできるフレーム数の上限
+        :param shard_size: tarモードでの1つのtarの大きさの上限(バイト)
+        :param frame_shape: memmapモードでの1フレームの形(高さ, 幅, チャンネル数)
+        :param transform: エンコードの前に書き込み用のスレッドで行う変換 Noneなら変換しない
+        """
+        self.encoder = encoder if encoder else ImageEncoder()
+        self.write_threads = write_threads
+        self.queue_size = queue_size
+        self.shard_size = shard_size
+        self.frame_shape = tuple(frame_shape)
+        self.transform = transform
+
+
+def imageFileName(frame_index, condition: Condition, segment, name_mode):
+    """
+    1フレーム1ファイルで保存する場合の保存先
+    :return: (出力フォルダーからの相対的なフォルダー, 拡張子を除いたファイル名) 保存しないならNone
+    """
+    if condition == Condition.INVALID:
+        return None
+    if not name_mode:
+        if condition == Condition.SAFE:
+            return "safe", f"{frame_index:05}"
+        else:
+            return "danger", f"{frame_index:05}"
+    else:
+        if condition == Condition.SAFE:
+            return str(segment), f"{frame_index:05}_safe"
+        else:
+            return str(segment), f"{frame_index:05}_danger"
+
+
+class ImageFileSink:
+    """
+    1フレームを1ファイルとして保存する
+    folderモード:danger/とsafe/に分ける
+    nameモード:連続した領域ごとのフォルダーに入れ、ラベルはファイル名で分ける
+    """
+
+    def __init__(
+        self,
+        output_path,
+        name_mode,
+        options: ExtractOptions,
+        metrics: ExtractionMetrics | None = None,
+    ):
+        self.output_path = output_path
+        self.name_mode = name_mode
+        self.created_contnuous = -1
+        self.writer = AsyncImageWriter(
+            options.encoder,
+            options.write_threads,
+            options.queue_size,
+            options.transform,
+            metrics,
+        )
+        if not name_mode:
+            os.makedirs(os.path.join(output_path, "danger"), exist_ok=True)
+            os.makedirs(os.path.join(output_path, "safe"), exist_ok=True)
+
+    def write(self, frame, frame_index, timestamp, condition: Condition, segment):
+        file_name = imageFileName(frame_index, condition, segment, self.name_mode)
+        if file_name == None:
+            return
+        parent_path = os.path.join(self.output_path, file_name[0])
+        if self.name_mode and self.created_contnuous != segment:
+            self.created_contnuous = segment
+            os.makedirs(parent_path, exist_ok=True)
+        self.writer.submit(frame, parent_path, file_name[1])
+
+    def close(self):
+        self.writer.close()
+
+
+def createSink(
+    mode,
+    output_path,
+    options: ExtractOptions,
+    part: int | None = None,
+    offset=0,
+    metrics: ExtractionMetrics | None = None,
+):
+    """
+    :param mode: folder, name, tar, memmapのいずれか
+    memmapモードではoutput_pathの親フォルダーがデータセットになり、動画の領域は確保済みとする
+    :param part: 並列に抽出する場合の担当範囲の番号 tarのファイル名を分けるのに使う
+    :param offset: 並列に抽出する場合の担当範囲の先頭の位置 memmapモードで使う
+    :param metrics: 変換、エンコード、書き込みの時間を記録する先
+    """
+    if mode == "folder":
+        return ImageFileSink(output_path, False, options, metrics)
+    elif mode == "name":
+        return ImageFileSink(output_path, True, options, metrics)
+    elif mode == "tar":
+        shard_prefix = "shard-" if part == None else f"shard-{part:03d}-"
+        return ShardWriter(
+            output_path,
+            os.path.basename(os.path.normpath(output_path)),
+            options.encoder,
+            options.shard_size,
+            options.write_threads,
+            options.queue_size,
+            shard_prefix,
+            options.transform,
+            metrics,
+        )
+    elif mode == "memmap":
+        dataset_path, video_name = datasetLocation(output_path)
+        return FrameDatasetSink(
+            dataset_path, video_name, offset, options.transform, metrics
+        )
+    else:
+        raise ValueError(f"invalid mode: {mode}")
+
+
+def datasetLocation(output_path) -> tuple[str, str]:
+    """
+    :return: memmapモードでの(データセットのフォルダー, 動画名)
+    """
+    output_path = os.path.normpath(output_path)
+    return os.path.dirname(output_path), os.path.basename(output_path)
@@ -0,0 +1,324 @@
+import threading
+import time
+from collections import OrderedDict, deque
+from typing import NamedTuple
+
+import cv2
+import numpy as np
+from PyQt5.QtCore import QObject, pyqtSignal
+from PyQt5.QtGui import QImage
+
+from frame_decoder import SparseDecoder, measureKeyframeInterval
+
+
+class DecodedFrame(NamedTuple):
+    frame_index: int
+    image: QImage
+    buffer: np.ndarray  # imageが参照している画素(imageより先に解放されないよう保持する)
+
+
+def fitSize(width, height, target: tuple[int, int] | None) -> tuple[int, int]:
+    """
+    縦横比を保ってtargetに収まる大きさ 拡大はしない
+    :param target: (幅, 高さ) Noneなら元の大きさ
+    """
+    if target == None or width <= 0 or height <= 0:
+        return width, height
+    ratio = min(1.0, target[0] / width, target[1] / height)
+    return max(1, int(width * ratio)), max(1, int(height * ratio))
+
+
+def toDisplayImage(
+    frame: np.ndarray, target: tuple[int, int] | None = None
+) -> tuple[QImage, np.ndarray]:
+    """
+    表示する大きさに縮小し、BGRのままQImageにする(色の変換とコピーをしない)
+    :param target: 表示先の大きさ(デバイスピクセル) Noneなら縮小しない
+    :return: (QImage, QImageが参照している画素)
+    """
+    height, width = frame.shape[:2]
+    size = fitSize(width, height, target)
+    if size != (width, height):
+        frame = cv2.resize(frame, size, interpolation=cv2.INTER_AREA)
+    frame = np.ascontiguousarray(frame)
+    image = QImage(frame.data, size[0], size[1], frame.strides[0], QImage.Format_BGR888)
+    return image, frame
+
+
+class FrameCache:
+    """
+    デコード済みのフレームをフレーム番号で引けるようにしておく
+    合計の大きさがmax_bytesを超えたら最も長く使われていないものから捨てる
+    UIとデコード用のスレッドの両方から使う
+    """
+
+    def __init__(self, max_mb=512):
+        self.max_bytes = max_mb * 1024 * 1024
+        self.frames: OrderedDict[int, DecodedFrame] = OrderedDict()
+        self.bytes = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, frame_index, size: tuple[int, int] | None = None) -> DecodedFrame | None:
+        """
+        ヒット、ミスを数える
+        :param size: 指定すれば、この大きさ(幅, 高さ)で覚えているものだけを返す
+        """
+        with self.lock:
+            decoded = self.frames.get(frame_index)
+            if decoded != None and size != None:
+                if (decoded.image.width(), decoded.image.height()) != size:
+                    decoded = None
+            if decoded == None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.frames.move_to_end(frame_index)
+            return decoded
+
+    def peek(self, frame_index) -> DecodedFrame | None:
+        """
+        ヒット、ミスを数えずに探す
+        """
+        with self.lock:
+            decoded = self.frames.get(frame_index)
+            if decoded != None:
+                self.frames.move_to_end(frame_index)
+            return decoded
+
+    def put(self, decoded: DecodedFrame):
+        with self.lock:
+            old = self.frames.pop(decoded.frame_index, None)
+            if old != None:
+                self.bytes -= old.buffer.nbytes
+            self.frames[decoded.frame_index] = decoded
+            self.bytes += decoded.buffer.nbytes
+            while self.bytes > self.max_bytes and len(self.frames) > 1:
+                _, evicted = self.frames.popitem(last=False)
+                self.bytes -= evicted.buffer.nbytes
+
+    def clear(self):
+        with self.lock:
+            self.frames.clear()
+            self.bytes = 0
+
+    def stats(self) -> dict:
+        with self.lock:
+            total = self.hits + self.misses
+            return {
+                "frames": len(self.frames),
+                "mb": self.bytes / (1024 * 1024),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total > 0 else 0.0,
+            }
+
+
+class PresentationClock:
+    """
+    再生を始めた時刻からの経過時間で、今表示すべきフレーム番号を決める
+    UIの処理が遅れても再生速度は実時間に従う
+    """
+
+    def __init__(self):
+        # デコード用のスレッドからも読むので、値はまとめて置き換える
+        # (開始フレーム, 開始時刻 止まっていればNone, fps, 速度)
+        self.state: tuple[int, float | None, float, float] = (0, None, 30.0, 1.0)
+
+    def start(self, frame_index, fps, speed=1.0):
+        self.state = (frame_index, time.perf_counter(), fps, speed)
+
+    def stop(self):
+        start_frame, _, fps, speed = self.state
+        self.state = (start_frame, None, fps, speed)
+
+    def isRunning(self) -> bool:
+        return self.state[1] != None
+
+    def speed(self) -> float:
+        return self.state[3]
+
+    def frameAt(self, now: float | None = None) -> int:
+        start_frame, start_time, fps, speed = self.state
+        if start_time == None:
+            return start_frame
+        if now == None:
+            now = time.perf_counter()
+        return start_frame + int((now - start_time) * fps * speed)
+
+
+class PlaybackDecoder(QObject):
+    """
+    別スレッドで現在位置より先のフレームをデコードし、表示できる形にして
+    上限のあるリングバッファに溜めておく
+    キャプチャはこのスレッドだけが触るので、シークもseekで依頼する
+
+    早送り中は表示するフレームだけをデコードし、間はSparseDecoderがgrabかシークで飛ばす
+    それでも時計に遅れた場合は、時計の位置まで飛ばして追いつく
+    """
+
+    # シーク後の最初のフレームと、停止中にデコードしたフレームが用意できたときに
+    # フレーム番号を送る(停止中の表示に使う) 読めなかった場合は-1
+    frameDecoded = pyqtSignal(int)
+
+    def __init__(
+        self,
+        video: cv2.VideoCapture,
+        buffer_size=8,
+        clock: PresentationClock | None = None,
+        cache: FrameCache | None = None,
+        video_path=None,
+        parent=None,
+    ):
+        """
+        :param buffer_size: 先読みしておくフレーム数の上限
+        :param clock: 再生中の位置を知るための時計 早送りで飛ばす量を決めるのに使う
+        :param cache: デコードしたフレームを入れておき、次からはデコードせずに使う
+        :param video_path: videoのパス 指定すれば、シークと読み飛ばしを選ぶためにキーフレームの間隔を調べる
+        """
+        super().__init__(parent)
+        self.video = video
+        self.decoder = SparseDecoder(video)
+        self.video_path = video_path
+        self.clock = clock if clock else PresentationClock()
+        self.cache = cache if cache else FrameCache()
+        self.source_size = (
+            int(video.get(cv2.CAP_PROP_FRAME_WIDTH)),
+            int(video.get(cv2.CAP_PROP_FRAME_HEIGHT)),
+        )
+        self.target_size: tuple[int, int] | None = None
+        self.buffer: deque[DecodedFrame] = deque()
+        self.buffer_size = max(1, buffer_size)
+        self.condition = threading.Condition()
+        self.seek_request: int | None = None
+        self.generation = 0  # シークのたびに増やし、古い位置のフレームを捨てる
+        self.position = 0  # 次にデコードするフレーム番号
+        self.ended = False
+        self.stopped = False
+        self.decoded_count = 0
+        self.dropped_count = 0  # 表示する前に時刻を過ぎて捨てたフレーム数
+        self.skipped_count = 0  # 早送りでデコードせずに飛ばしたフレーム数
+        self.thread = threading.Thread(target=self.__run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
+        self.thread.join()
+
+    def setTargetSize(self, size: tuple[int, int] | None):
+        """
+        以降デコードするフレームをこの大きさ(デバイスピクセル)に収まるよう縮小する
+        """
+        self.target_size = size
+
+    def displaySize(self) -> tuple[int, int]:
+        """
+        :return: 今の設定でデコードしたフレームの大きさ
+        """
+        return fitSize(*self.source_size, self.target_size)
+
+    def seek(self, frame_index: int):
+        """
+        先読みしたフレームを捨ててframe_indexからデコードし直す
+        """
+        with self.condition:
+            self.seek_request = frame_index
+            self.position = frame_index
+            self.generation += 1
+            self.buffer.clear()
+            self.ended = False
+            self.condition.notify_all()
+
+    def isEnded(self) -> bool:
+        """
+        :return: 最後までデコードし、バッファも空になっていたらTrue
+        """
+        with self.condition:
+            return self.ended and len(self.buffer) == 0
+
+    def take(self, frame_index: int) -> DecodedFrame | None:
+        """
+        frame_index以前のフレームをバッファから取り出し、最も新しいものを返す
+        それより前のものは表示が間に合わなかったとして捨てる
+        :return: まだデコードされていなければNone
+        """
+        with self.condition:
+            result = None
+            while self.buffer and self.buffer[0].frame_index <= frame_index:
+                if result != None:
+                    self.dropped_count += 1
+                result = self.buffer.popleft()
+            self.condition.notify_all()
+            return result
+
+    def __nextIndex(self, frame_index) -> int:
+        """
+        :return: frame_indexの次にデコードするフレーム番号
+        """
+        if not self.clock.isRunning():
+            return frame_index + 1
+        step = max(1, int(round(self.clock.speed())))
+        next_index = frame_index + step
+        target = self.clock.frameAt()
+        if next_index < target:
+            # 時計に遅れているので、今の時計の位置より1つ先まで飛ばす
+            caught_up = target + step
+            self.skipped_count += caught_up - next_index
+            next_index = caught_up
+        self.skipped_count += step - 1
+        return next_index
+
+    def __waitForWork(self) -> tuple[int, bool, int] | None:
+        """
+        :return: (デコードするフレーム番号, シークされたか, 世代) 終了するならNone
+        """
+        with self.condition:
+            while not self.stopped and self.seek_request == None and (
+                self.ended or len(self.buffer) >= self.buffer_size
+            ):
+                self.condition.wait()
+            if self.stopped:
+                return None
+            seeked = self.seek_request != None
+            self.seek_request = None
+            return self.position, seeked, self.generation
+
+    def __run(self):
+        if self.video_path != None:
+            # UIを止めないよう、このスレッドで調べる
+            self.decoder.setKeyframeInterval(measureKeyframeInterval(self.video_path))
+        first_after_seek = False
+        while True:
+            work = self.__waitForWork()
+            if work == None:
+                return
+            frame_index, seeked, generation = work
+            if seeked:
+                first_after_seek = True
+            target_size = self.target_size
+            decoded = self.cache.get(frame_index, fitSize(*self.source_size, target_size))
+            if decoded == None:
+                frame = self.decoder.read(frame_index)
+                if frame is not None:
+                    image, pixels = toDisplayImage(frame, target_size)
+                    decoded = DecodedFrame(frame_index, image, pixels)
+                    self.cache.put(decoded)
+            with self.condition:
+                if generation != self.generation:
+                    # デコード中に別の位置へシークされた
+                    continue
+                if decoded == None:
+                    self.ended = True
+                else:
+                    self.buffer.append(decoded)
+                    self.decoded_count += 1
+                    self.position = self.__nextIndex(frame_index)
+            if first_after_seek or not self.clock.isRunning():
+                # 最後より後ろにシークした場合も、表示を消せるよう通知する
+                first_after_seek = False
+                self.frameDecoded.emit(frame_index if decoded else -1)
@@ -0,0 +1,167 @@
+import json
+import os
+import shutil
+import threading
+
+import cv2
+from PyQt5.QtCore import QObject, pyqtSignal
+
+# プロキシの高さ(px)
+PROXY_HEIGHT = 360
+# OpenCVだけで書ける圧縮形式 キーフレームは12フレームごとなので、どの位置にもすぐシークできる
+# (MJPGは全フレームがキーフレームで、数時間の動画では元の動画より大きくなることがある)
+PROXY_FOURCC = "mp4v"
+# OpenCVがmp4vに指定するビットレート(1画素1フレームあたりのビット数) プロキシの大きさの見積もりに使う
+PROXY_BITS_PER_PIXEL = 1
+
+
+def proxyPath(video_path) -> str:
+    return os.path.splitext(video_path)[0] + ".proxy.avi"
+
+
+def proxyInfoPath(video_path) -> str:
+    return os.path.splitext(video_path)[0] + ".proxy.json"
+
+
+def estimateProxySize(frame_count, width, height) -> int:
+    """
+    :return: プロキシの大きさの見積もり(バイト) 360pの30fpsでは1時間あたり約3GB
+    """
+    return frame_count * width * height * PROXY_BITS_PER_PIXEL // 8
+
+
+def loadProxyInfo(video_path) -> dict | None:
+    """
+    使えるプロキシの情報を返す
+    元の動画より古いか、元の動画の大きさが変わっているか、作成が終わっていなければNone
+    元の動画のfpsとフレーム数を記録していない前の版のプロキシと、形式が違うプロキシも作り直すためNone
+    :return: {"source_fps", "source_frame_count", "fps", "frame_count", "width", "height", ...}
+        タイムラインはプロキシの有無で長さが変わらないよう、元の動画のsource_fpsとsource_frame_countで作る
+        frame_countは実際に書き出したフレーム数
+    """
+    path = proxyPath(video_path)
+    try:
+        with open(proxyInfoPath(video_path), "r") as f:
+            info = json.load(f)
+        source_stat = os.stat(video_path)
+        proxy_stat = os.stat(path)
+    except (OSError, ValueError):
+        return None
+    if info.get("source_size") != source_stat.st_size:
+        return None
+    if "source_frame_count" not in info or info.get("fourcc") != PROXY_FOURCC:
+        return None
+    if proxy_stat.st_mtime < source_stat.st_mtime:
+        return None
+    return info
+
+
+class ProxyTranscoder(QObject):
+    """
+    別スレッドで元の動画の全フレームを縮小してプロキシに書き出す
+    フレームを間引かずfpsも同じにするので、プロキシのフレーム番号は元の動画と一致する
+    書き出す前に、見積もった大きさ(estimateProxySize)の空き容量があるか確かめる
+    """
+
+    # 進捗(%)
+    progress = pyqtSignal(int)
+    # (成功したか, 元の動画のパス)
+    finished = pyqtSignal(bool, str)
+
+    def __init__(self, video_path, height=PROXY_HEIGHT, parent=None):
+        super().__init__(parent)
+        self.video_path = video_path
+        self.height = height
+        self.cancelled = False
+        self.error: str | None = None  # 作成できなかった理由 わからなければNone
+        self.thread = threading.Thread(target=self.__run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def cancel(self):
+        self.cancelled = True
+        self.thread.join()
+
+    def __transcode(self, temp_path) -> dict | None:
+        video = cv2.VideoCapture(self.video_path)
+        writer = None
+        try:
+            fps = video.get(cv2.CAP_PROP_FPS)
+            frame_count = int(video.get(cv2.CAP_PROP_FRAME_COUNT))
+            width = int(video.get(cv2.CAP_PROP_FRAME_WIDTH))
+            height = int(video.get(cv2.CAP_PROP_FRAME_HEIGHT))
+            if fps <= 0 or width <= 0 or height <= 0:
+                return None
+            proxy_height = min(self.height, height)
+            # 幅は偶数にそろえる
+            proxy_width = max(2, int(width * proxy_height / height) // 2 * 2)
+            estimated = estimateProxySize(frame_count, proxy_width, proxy_height)
+            free = shutil.disk_usage(os.path.dirname(os.path.abspath(temp_path))).free
+            if free < estimated:
+                self.error = f"空き容量が足りません(約{estimated / 2**20:.0f}MB必要)"
+                return None
+            writer = cv2.VideoWriter(
+                temp_path,
+                cv2.VideoWriter_fourcc(*PROXY_FOURCC),
+                fps,
+                (proxy_width, proxy_height),
+            )
+            if not writer.isOpened():
+                return None
+            written = 0
+            reported = -1
+            while not self.cancelled:
+                ret, frame = video.read()
+                if not ret:
+                    break
+                frame = cv2.resize(
+                    frame, (proxy_width, proxy_height), interpolation=cv2.INTER_AREA
+                )
+                writer.write(frame)
+                written += 1
+                if frame_count > 0:
+                    percent = min(99, written * 100 // frame_count)
+                    if percent != reported:
+                        reported = percent
+                        self.progress.emit(percent)
+            if self.cancelled or written == 0:
+                return None
+            return {
+                "source_fps": fps,
+                # 数えられない形式ならプロキシに書き出したフレーム数を使う
+                "source_frame_count": frame_count if frame_count > 0 else written,
+                "fps": fps,
+                "frame_count": written,
+                "width": proxy_width,
+                "height": proxy_height,
+                "fourcc": PROXY_FOURCC,
+                "source_width": width,
+                "source_height": height,
+            }
+        finally:
+            video.release()
+            if writer:
+                writer.release()
+
+    def __run(self):
+        path = proxyPath(self.video_path)
+        # 拡張子で形式が決まるので、一時ファイルも.aviで終える
+        temp_path = path + ".tmp.avi"
+        info = None
+        try:
+            info = self.__transcode(temp_path)
+            if info != None:
+                info["source_size"] = os.stat(self.video_path).st_size
+                os.replace(temp_path, path)
+                with open(proxyInfoPath(self.video_path), "w") as f:
+                    json.dump(info, f, indent=2)
+        except OSError:
+            info = None
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+        if not self.cancelled:
+            if info != None:
+                self.progress.emit(100)
+            self.finished.emit(info != None, self.video_path)
@@ -4,9 +4,19 @@ from PyQt5.QtCore import *
 from PyQt5.QtGui import *
 from PyQt5.QtWidgets import *
 from enum import Enum
+from bisect import bisect_left, bisect_right
 from typing import Callable
 from gui_property import GUIProperty
-from utils import pixelToTime, timeToPixel
+from utils import DEFAULT_SCALE, pixelToTime, timeToPixel
+from thumbnail_strip import (
+    THUMBNAIL_HEIGHT,
+    THUMBNAIL_PREFETCH_SCREENS,
+    ThumbnailCache,
+    ThumbnailWorker,
+    prefetchOrder,
+    thumbnailSpacing,
+)
+import math
 
 
 class DragAction(Enum):
@@ -16,6 +26,239 @@ class DragAction(Enum):
 
 
 hoverOffset = 3
+# 拡大率(1秒あたりのピクセル数)の上限
+MAX_SCALE = 2000
+# ホイール1段での拡大率の倍率
+ZOOM_STEP = 1.25
+# 目盛りの間隔の候補(秒) 拡大率に応じて線がMIN_TICK_SPACINGより詰まらない最小のものを使う
+TICK_STEPS = [0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1, 2, 5, 10, 15, 30, 60, 120, 300, 600, 1800, 3600]
+MIN_TICK_SPACING = 10
+# 画面内の領域の数がこの幅(px)あたり1つを超えたら、領域を1つずつ描かず密度の棒にまとめる
+LOD_SPAN_PIXELS = 4
+# 密度の棒の幅(px)
+DENSITY_BAR_WIDTH = 2
+# 概観の高さ(px)
+OVERVIEW_HEIGHT = 24
+
+
+def tickSpacing(pixels_per_second: float) -> float:
+    """
+    :return: 目盛りの間隔(秒)
+    """
+    for step in TICK_STEPS:
+        if step * pixels_per_second >= MIN_TICK_SPACING:
+            return step
+    return TICK_STEPS[-1]
+
+
+class IntervalSet:
+    """
+    確定した子の領域を、重ならないよう結合して開始時刻の順に持つ(終了時刻の順にもなる)
+    ある時間の範囲と重なる領域は、開始時刻と終了時刻の二分探索で連続した範囲として取り出せる
+    作成中や編集中で範囲が変わる領域は並びの外(loose)に置き、確定したときに戻す
+    """
+
+    def __init__(self):
+        self.items: list[RectSelectProcessor] = []
+        self.starts: list[float] = []
+        self.ends: list[float] = []
+        self.loose: list[RectSelectProcessor] = []
+
+    @classmethod
+    def fromSorted(cls, processors: list[RectSelectProcessor]) -> IntervalSet:
+        """
+        開始時刻の順に並び、重ならず接してもいない領域から結合せずに作る
+        """
+        result = cls()
+        result.items = list(processors)
+        result.starts = [p.videoRect().start for p in processors]
+        result.ends = [p.videoRect().end for p in processors]
+        return result
+
+    def __len__(self):
+        return len(self.items) + len(self.loose)
+
+    def processors(self) -> list[RectSelectProcessor]:
+        """
+        :return: 全ての領域 開始時刻の順
+        """
+        if not self.loose:
+            return list(self.items)
+        return sorted(self.items + self.loose, key=lambda p: p.videoRect().start)
+
+    def overlapping(self, start: float, end: float) -> list[RectSelectProcessor]:
+        """
+        :return: [start, end]と重なるか接する確定した領域 開始時刻の順
+        """
+        return self.items[bisect_left(self.ends, start) : bisect_right(self.starts, end)]
+
+    def countOverlapping(self, start: float, end: float) -> int:
+        """
+        :return: [start, end]と重なる領域の数 確定した領域は並びを取り出さずに二分探索だけで数える
+        """
+        count = max(0, bisect_right(self.starts, end) - bisect_left(self.ends, start))
+        for p in self.loose:
+            if p.videoRect().end >= start and p.videoRect().start <= end:
+                count += 1
+        return count
+
+    def query(self, start: float, end: float) -> list[RectSelectProcessor]:
+        """
+        :return: [start, end]と重なる領域 開始時刻の順
+        """
+        result = self.overlapping(start, end)
+        loose = [p for p in self.loose if p.videoRect().end >= start and p.videoRect().start <= end]
+        if loose:
+            result = sorted(result + loose, key=lambda p: p.videoRect().start)
+        return result
+
+    def insert(self, processor: RectSelectProcessor):
+        """
+        どれとも重ならない領域を並びに加える
+        """
+        rect = processor.videoRect()
+        i = bisect_left(self.starts, rect.start)
+        self.items.insert(i, processor)
+        self.starts.insert(i, rect.start)
+        self.ends.insert(i, rect.end)
+
+    def addLoose(self, processor: RectSelectProcessor):
+        self.loose.append(processor)
+
+    def __indexOf(self, processor: RectSelectProcessor) -> int | None:
+        i = bisect_left(self.starts, processor.videoRect().start)
+        while i < len(self.items) and self.starts[i] == processor.videoRect().start:
+            if self.items[i] is processor:
+                return i
+            i += 1
+        return None
+
+    def detach(self, processor: RectSelectProcessor):
+        """
+        範囲を変える前に並びの外に出す
+        """
+        i = self.__indexOf(processor)
+        if i != None:
+            self.__removeAt(i, i + 1)
+            self.loose.append(processor)
+
+    def discard(self, processor: RectSelectProcessor):
+        if processor in self.loose:
+            self.loose.remove(processor)
+        else:
+            i = self.__indexOf(processor)
+            if i != None:
+                self.__removeAt(i, i + 1)
+
+    def discardRange(self, start: float, end: float):
+        """
+        範囲が[start, end]の確定した領域を取り除く
+        """
+        i = bisect_left(self.starts, start)
+        while i < len(self.items) and self.starts[i] == start:
+            if self.ends[i] == end:
+                self.__removeAt(i, i + 1)
+                return
+            i += 1
+
+    def takeOverlapping(self, start: float, end: float) -> list[RectSelectProcessor]:
+        """
+        [start, end]と重なるか接する確定した領域を並びから取り除いて返す
+        """
+        lo = bisect_left(self.ends, start)
+        hi = bisect_right(self.starts, end)
+        result = self.items[lo:hi]
+        self.__removeAt(lo, hi)
+        return result
+
+    def __removeAt(self, lo: int, hi: int):
+        del self.items[lo:hi]
+        del self.starts[lo:hi]
+        del self.ends[lo:hi]
+
+    def clip(self, start: float, end: float):
+        """
+        領域を[start, end]に収め、長さがなくなったものを取り除く
+        外にはみ出しうるのは両端の領域だけなので、範囲外を切り落として端を詰める
+        """
+        self.__removeAt(bisect_left(self.starts, end), len(self.items))
+        self.__removeAt(0, bisect_right(self.ends, start))
+        if self.items:
+            for i in sorted({0, len(self.items) - 1}, reverse=True):
+                rect = self.items[i].videoRect()
+                rect.start = self.starts[i] = max(rect.start, start)
+                rect.end = self.ends[i] = min(rect.end, end)
+                if rect.start >= rect.end:
+                    # 親の長さがないと、端の領域も長さがなくなる
+                    self.__removeAt(i, i + 1)
+        kept = []
+        for processor in self.loose:
+            rect = processor.videoRect()
+            rect.start = max(rect.start, start)
+            rect.end = min(rect.end, end)
+            if rect.start < rect.end:
+                kept.append(processor)
+        self.loose = kept
+
+
+class CoverageIndex:
+    """
+    領域の和集合を開始時刻の順に持ち、ある時間の範囲のうち領域に含まれる長さを二分探索で求める
+    縮小したときに、多数の領域を1つずつ描かず密度の棒にまとめるのに使う
+    """
+
+    def __init__(self, rects: list[VideoRect]):
+        rects = sorted(rects, key=lambda r: r.start)
+        # 重なりをまとめた領域と、それより前にある領域の長さの合計
+        self.starts: list[float] = []
+        self.ends: list[float] = []
+        self.covered_before: list[float] = []
+        total = 0.0
+        for rect in rects:
+            if self.ends and rect.start <= self.ends[-1]:
+                if rect.end > self.ends[-1]:
+                    total += rect.end - self.ends[-1]
+                    self.ends[-1] = rect.end
+            else:
+                self.starts.append(rect.start)
+                self.ends.append(rect.end)
+                self.covered_before.append(total)
+                total += rect.end - rect.start
+
+    def __coveredUntil(self, time: float) -> float:
+        i = bisect_right(self.starts, time) - 1
+        if i < 0:
+            return 0.0
+        return self.covered_before[i] + min(time, self.ends[i]) - self.starts[i]
+
+    def density(self, start: float, end: float) -> float:
+        """
+        :return: [start, end]のうち領域に含まれる割合
+        """
+        if end <= start:
+            return 0.0
+        return (self.__coveredUntil(end) - self.__coveredUntil(start)) / (end - start)
+
+
+def drawDensity(
+    painter: QPainter,
+    coverage: CoverageIndex,
+    color: QColor,
+    toTime: Callable[[int], float],
+    left: int,
+    right: int,
+    height: int,
+    bar_width: int = DENSITY_BAR_WIDTH,
+):
+    """
+    画面上の[left, right)をbar_widthごとに区切り、領域に含まれる割合を下からの棒の高さで描く
+    描く回数は画面の幅だけで決まり、領域の数によらない
+    :param toTime: 画面上の座標から時刻への変換
+    """
+    for x in range(left, right, bar_width):
+        bar_height = int(round(coverage.density(toTime(x), toTime(x + bar_width)) * height))
+        if bar_height > 0:
+            painter.fillRect(x, height - bar_height, bar_width, bar_height, color)
 
 
 class VideoRect:
@@ -25,6 +268,8 @@ class VideoRect:
 
 
 class RectSelectProcessor:
+    # 木のどこかの領域が変わるたびに増やし、描き直したときに概観に知らせる目安にする
+    generation = 0
 
     def __init__(
         self,
@@ -33,15 +278,20 @@ class RectSelectProcessor:
         depth,
         update: Callable[[],],
         xOffset: Callable[[], int],
+        scale: Callable[[], float],
         setTime: Callable[[float],],
         setCursor: Callable[[any],],
     ):
         self.isPressed = False
         self._videoRect = VideoRect(startTime, endTime)
-        self.childProcessors: list[RectSelectProcessor] = []
+        self._children = IntervalSet()
+        # 深さから確定した子孫の領域のCoverageIndex 子孫の領域を確定するたびに消す
+        self._coverage: dict[int, CoverageIndex] = {}
+        self.parent: RectSelectProcessor | None = None
         self.depth = depth
         self.update = update
         self.xOffset = xOffset
+        self.scale = scale
         self.setTime = setTime
         self.setCursor = setCursor
         self.dragAction = None
@@ -50,6 +300,163 @@ class RectSelectProcessor:
         self.can_touch_right = True
         self.targetProcessor = None
         self.seek_bar_pos = 0
+        # 子の領域を確定するたびに(取り除いた領域, 加えた領域)を受け取る 一番上の領域だけに設定する
+        self.edit_listener: Callable[[list[dict], list[dict]],] | None = None
+        self.edit_before: list[dict] = []  # 編集を始める前の子の領域
+
+    @property
+    def childProcessors(self) -> list[RectSelectProcessor]:
+        """
+        :return: 子の領域 開始時刻の順
+        """
+        return self._children.processors()
+
+    @childProcessors.setter
+    def childProcessors(self, processors: list[RectSelectProcessor]):
+        """
+        子の領域をまとめて置き換える 重なるか接する領域は結合する
+        """
+        self._children = IntervalSet()
+        for processor in sorted(processors, key=lambda p: p.videoRect().start):
+            self.mergeChild(processor)
+        RectSelectProcessor.generation += 1
+
+    def childrenIn(self, start: float, end: float) -> list[RectSelectProcessor]:
+        """
+        :return: 時刻の範囲[start, end]と重なる子の領域
+        """
+        return self._children.query(start, end)
+
+    def mergeChild(self, processor: RectSelectProcessor):
+        """
+        子の領域を確定し、重なるか接する確定した子と結合する
+        結合相手は作り直さず、その子(孫の領域)ごとprocessorにまとめる
+        結合した領域の子は範囲に収め、深さ1以上では長さのない領域は捨てる
+        """
+        self._children.discard(processor)
+        processor.parent = self
+        rect = processor.videoRect()
+        neighbours = self._children.takeOverlapping(rect.start, rect.end)
+        if neighbours:
+            rect.start = min(rect.start, neighbours[0].videoRect().start)
+            rect.end = max(rect.end, neighbours[-1].videoRect().end)
+            for neighbour in neighbours:
+                for child in neighbour.childProcessors:
+                    processor.mergeChild(child)
+        if processor.targetProcessor:
+            # 作成中の子があれば、そこで確定する
+            target = processor.targetProcessor
+            target.can_touch_left = True
+            target.can_touch_right = True
+            processor.targetProcessor = None
+            processor.mergeChild(target)
+        processor.clipChildren()
+        if self.depth == 0 or rect.start < rect.end:
+            self._children.insert(processor)
+        self.__invalidateCoverage()
+        RectSelectProcessor.generation += 1
+
+    def __commitChild(self, processor: RectSelectProcessor, before: list[dict]):
+        """
+        子の領域を確定して隣と結合し、edit_listenerに知らせる
+        :param before: 編集を始める前のprocessorの内容 新しく作った領域なら空
+        """
+        if self.edit_listener:
+            rect = processor.videoRect()
+            before = before + [
+                toExportObject(p) for p in self._children.overlapping(rect.start, rect.end)
+            ]
+        self.mergeChild(processor)
+        if self.edit_listener:
+            self.__notifyEdit(before, [toExportObject(processor)])
+
+    def __notifyEdit(self, before: list[dict], after: list[dict]):
+        if self.edit_listener and before != after:
+            self.edit_listener(before, after)
+
+    def applyEdit(self, remove: list[dict], add: list[dict]):
+        """
+        記録した編集を子の領域に当てはめる(元に戻す、やり直す、ジャーナルの再生に使う)
+        :param remove: 取り除く子の領域(toExportObjectの形)
+        :param add: 加える子の領域 他の領域と重ならないこと
+        """
+        for rect in remove:
+            self._children.discardRange(rect["start"], rect["end"])
+        for rect in add:
+            self._children.insert(fromExportObject(rect, self))
+        self.__invalidateCoverage()
+        RectSelectProcessor.generation += 1
+        self.update()
+
+    def replaceChildren(self, children: IntervalSet):
+        """
+        buildChildrenで作った子の並びに置き換える
+        """
+        self._children = children
+        self.__invalidateCoverage()
+        RectSelectProcessor.generation += 1
+
+    def clipChildren(self):
+        """
+        子の領域を自分の範囲に収める
+        """
+        self._children.clip(self._videoRect.start, self._videoRect.end)
+        self.__invalidateCoverage()
+        RectSelectProcessor.generation += 1
+
+    def __invalidateCoverage(self):
+        """
+        確定した子孫の領域が変わったので、自分と先祖のCoverageIndexを捨てる
+        """
+        processor = self
+        while processor != None:
+            processor._coverage.clear()
+            processor = processor.parent
+
+    def coverageIndex(self, depth: int) -> CoverageIndex:
+        """
+        作成中や編集中で並びの外にある領域は範囲が変わり続けるので含めず、editingChildrenとして別に描く
+        :param depth: 1なら子、2なら孫の領域をまとめる
+        """
+        coverage = self._coverage.get(depth)
+        if coverage != None:
+            return coverage
+        processors = self._children.items
+        for _ in range(depth - 1):
+            processors = [p for parent in processors for p in parent._children.items]
+        coverage = CoverageIndex([p.videoRect() for p in processors])
+        self._coverage[depth] = coverage
+        return coverage
+
+    def editingChildren(self) -> list[RectSelectProcessor]:
+        """
+        :return: 作成中や編集中で並びの外にある子と、孫の領域を編集中の子
+        """
+        editing = list(self._children.loose)
+        if self.dragAction == DragAction.EDIT_CHILD_RECT and self.isPressed:
+            editing.append(self.mouse_target_processor)
+        return editing
+
+    def countSpansIn(self, start: float, end: float, limit: int) -> int:
+        """
+        :return: [start, end]と重なる子と孫の領域の数 limitを超えたらそこで数えるのをやめる
+        """
+        count = self._children.countOverlapping(start, end)
+        if count > limit:
+            return count
+        for child in self._children.query(start, end):
+            count += child._children.countOverlapping(start, end)
+            if count > limit:
+                break
+        return count
+
+    def __childrenNear(self, point: QPoint) -> list[RectSelectProcessor]:
+        """
+        :return: カーソルの位置からhoverOffsetの数倍以内にある子の領域(判定はこの中だけで行う)
+        """
+        time = self.pixelToTime(self.relToAbs(point.x()))
+        tolerance = self.pixelToTime(hoverOffset * 2 + 1)
+        return self.childrenIn(time - tolerance, time + tolerance)
 
     def canTouchLeft(self) -> bool:
         return self.can_touch_left
@@ -62,6 +469,7 @@ class RectSelectProcessor:
 
     def setVideoRect(self, videoRect: VideoRect):
         self._videoRect = videoRect
+        RectSelectProcessor.generation += 1
         self.update()
 
     # TODO クリックの開始と終了を一致させる
@@ -75,6 +483,14 @@ class RectSelectProcessor:
                     # 子の領域の端にかぶっていた場合、端の編集を行う
                     childProcesser = clickedEdge[0]
                     self.mouse_target_processor = childProcesser
+                    self.edit_before = (
+                        [toExportObject(childProcesser)]
+                        if childProcesser != self.targetProcessor
+                        else []
+                    )
+                    # 編集中は範囲が変わるので並びの外に出しておく
+                    self._children.detach(childProcesser)
+                    self.__invalidateCoverage()
                     if clickedEdge[1] == True:
                         self.mouse_first_time = childProcesser.videoRect().end
                     else:
@@ -85,11 +501,12 @@ class RectSelectProcessor:
                     rect = self.onRect(self.point)
                     self.dragAction = DragAction.EDIT_CHILD_RECT
                     self.mouse_target_processor = rect
+                    self.edit_before = [toExportObject(rect)]
                     rect.onClick(point, button)
                 else:
                     # そうでない(何もない場所をクリック)ときシークバーの移動
                     self.dragAction = DragAction.MOVE
-                    self.setTime(pixelToTime(self.relToAbs(point.x())))
+                    self.setTime(self.pixelToTime(self.relToAbs(point.x())))
         self.update()
 
     def mouseMoveEvent(self, point: QPoint):
@@ -97,17 +514,17 @@ class RectSelectProcessor:
         self.point = point
         if self.dragAction == DragAction.MOVE:
             # ドラッグでシークバーを移動
-            self.setTime(pixelToTime(self.relToAbs(point.x())))
+            self.setTime(self.pixelToTime(self.relToAbs(point.x())))
         elif self.dragAction == DragAction.EDIT_RECT:
             # 領域を編集
-            mouse_x = min(self.absToRel(timeToPixel(self._videoRect.end)), point.x())
+            mouse_x = min(self.absToRel(self.timeToPixel(self._videoRect.end)), point.x())
             mouse_x = max(mouse_x, self.absToRel(self._videoRect.start))
             absX = self.relToAbs(mouse_x)
-            start = min(pixelToTime(absX), self.mouse_first_time)
-            end = max(pixelToTime(absX), self.mouse_first_time)
+            start = min(self.pixelToTime(absX), self.mouse_first_time)
+            end = max(self.pixelToTime(absX), self.mouse_first_time)
             self.mouse_target_processor.setVideoRect(VideoRect(start, end))
             if self.mouse_target_processor == self.targetProcessor:
-                self.first_time = pixelToTime(absX)
+                self.first_time = self.pixelToTime(absX)
         elif self.dragAction == DragAction.EDIT_CHILD_RECT:
             # 子に移譲
             self.mouse_target_processor.mouseMoveEvent(point)
@@ -128,12 +545,20 @@ class RectSelectProcessor:
     def mouseReleaseEvent(self, point: QPoint):
         if self.isPressed:
             self.isPressed = False
+            # 作成中の領域はまだ結合しない
             if self.dragAction == DragAction.EDIT_CHILD_RECT:
                 self.mouse_target_processor.mouseReleaseEvent(point)
+                if self.mouse_target_processor != self.targetProcessor:
+                    # 子の中で編集された孫の領域を子の範囲に収める
+                    self.mouse_target_processor.clipChildren()
+                    self.__notifyEdit(
+                        self.edit_before, [toExportObject(self.mouse_target_processor)]
+                    )
+            elif self.dragAction == DragAction.EDIT_RECT:
+                if self.mouse_target_processor != self.targetProcessor:
+                    # 編集した領域だけを隣と結合する
+                    self.__commitChild(self.mouse_target_processor, self.edit_before)
             self.dragAction = None
-            self.childProcessors = mergeClipRect(
-                self.childProcessors, [self.targetProcessor]
-            )
             self.update()
 
     def onClipEdge(self, point: QPoint) -> tuple[RectSelectProcessor, bool] | None:
@@ -142,10 +567,10 @@ class RectSelectProcessor:
         右ならTrue,左ならFalse
         TODO 定数割り当てたほうがいいかも
         """
-        for childProcessor in self.childProcessors:
+        for childProcessor in self.__childrenNear(point):
             childRect = childProcessor.videoRect()
-            start = self.absToRel(timeToPixel(childRect.start))
-            end = self.absToRel(timeToPixel(childRect.end))
+            start = self.absToRel(self.timeToPixel(childRect.start))
+            end = self.absToRel(self.timeToPixel(childRect.end))
             x = point.x()
             if abs(x - start) < hoverOffset and childProcessor.canTouchLeft():
                 return (childProcessor, True)
@@ -164,21 +589,34 @@ class RectSelectProcessor:
                     self.depth + 1,
                     self.update,
                     self.xOffset,
+                    self.scale,
                     self.setTime,
                     self.setCursor,
                 )
                 newProcessor.can_touch_right = False
-                self.childProcessors.append(newProcessor)
+                newProcessor.seek_bar_pos = self.seek_bar_pos
+                newProcessor.parent = self
+                self.__finishTarget()
+                # 作成中は範囲が変わるので並びの外に置く
+                self._children.addLoose(newProcessor)
+                RectSelectProcessor.generation += 1
                 self.targetProcessor = newProcessor
             else:
-                if self.targetProcessor:
-                    self.targetProcessor.can_touch_right = True
-                    self.targetProcessor.can_touch_left = True
-                    self.targetProcessor = None
-                self.childProcessors = mergeClipRect(self.childProcessors)
+                self.__finishTarget()
         elif self.targetProcessor:
             self.targetProcessor.onButtonStateChanged(pressed, button_depth - 1)
 
+    def __finishTarget(self):
+        """
+        作成中の領域を確定し、隣と結合する
+        """
+        if self.targetProcessor:
+            target = self.targetProcessor
+            target.can_touch_right = True
+            target.can_touch_left = True
+            self.targetProcessor = None
+            self.__commitChild(target, [])
+
     def onSeekbarChanged(self, pos):
         """
         :param pos: time
@@ -194,19 +632,24 @@ class RectSelectProcessor:
                 self.targetProcessor.can_touch_left = False
                 self.targetProcessor.can_touch_right = False
             self.targetProcessor.setVideoRect(VideoRect(start, end))
-
-        for child in self.childProcessors:
-            child.onSeekbarChanged(pos)
+            # 新しく領域を作るのは作成中の領域の中だけなので、そこにだけ伝える
+            self.targetProcessor.onSeekbarChanged(pos)
 
     def onRect(self, point: QPoint) -> RectSelectProcessor | None:
-        for childProcessor in self.childProcessors:
+        for childProcessor in self.__childrenNear(point):
             rect = childProcessor.videoRect()
-            start = self.absToRel(timeToPixel(rect.start))
-            end = self.absToRel(timeToPixel(rect.end))
+            start = self.absToRel(self.timeToPixel(rect.start))
+            end = self.absToRel(self.timeToPixel(rect.end))
             if start + hoverOffset <= point.x() <= end + hoverOffset:
                 return childProcessor
         return None
 
+    def pixelToTime(self, pixel: int) -> float:
+        return pixelToTime(pixel, self.scale())
+
+    def timeToPixel(self, time: float) -> int:
+        return timeToPixel(time, self.scale())
+
     # 絶対座標から現在のオフセットを勘案した画面上の座標に変換
     def absToRel(self, x: int):
         return x + self.xOffset()
@@ -217,26 +660,44 @@ class RectSelectProcessor:
 
     def isInParentRect(self, x: int):
         return self.absToRel(
-            timeToPixel(self._videoRect.start)
-        ) <= x and x <= self.absToRel(timeToPixel(self._videoRect.end))
+            self.timeToPixel(self._videoRect.start)
+        ) <= x and x <= self.absToRel(self.timeToPixel(self._videoRect.end))
 
 
 class RectSelectWidget(QWidget):
+    # 領域が変わったあとに描画したとき
+    spansChanged = pyqtSignal()
+    # 子の領域を編集したとき(元に戻す、やり直すを含む) (取り除いた領域, 加えた領域)
+    edited = pyqtSignal(object, object)
+
     def __init__(
         self,
         time: GUIProperty,
         x_offset: GUIProperty,
         video_data: GUIProperty,
+        scale: GUIProperty | None = None,
         parent=None,
     ):
+        """
+        :param scale: 拡大率(1秒あたりのピクセル数) x_offsetはこの拡大率での座標
+        """
         super(RectSelectWidget, self).__init__(parent)
         self.x_offset = x_offset
+        self.scale = scale if scale else GUIProperty(DEFAULT_SCALE)
+        self.scale.setValueConverter(self.__scaleConverter)
         self.time = time
         self.time.addListener(self, self.onTimeChanged)
         self.time.setValueConverter(self.__valueConverter)
         self.setMouseTracking(True)
         self.video_data = video_data
         self.parentProcessor = None
+        self.thumbnail_worker: ThumbnailWorker | None = None
+        self.thumbnails = ThumbnailCache()  # 時刻(ミリ秒)からサムネイル
+        self.thumbnail_width = THUMBNAIL_HEIGHT * 16 // 9  # 最後に受け取ったサムネイルの幅
+        self.thumbnail_request = None  # 最後に依頼した(先頭, 末尾, 間隔)
+        self.painted_generation = -1
+        self.undo_stack: list[tuple[list[dict], list[dict]]] = []
+        self.redo_stack: list[tuple[list[dict], list[dict]]] = []
 
     def onButtonStateChanged(self, pressed, button_depth):
         # 移動できるといい
@@ -253,10 +714,18 @@ class RectSelectWidget(QWidget):
         else:
             return value
 
+    def __scaleConverter(self, value):
+        # 縮小は動画全体が画面に収まるまで
+        min_scale = DEFAULT_SCALE
+        if self.parentProcessor and self.parentProcessor.videoRect().end > 0:
+            min_scale = min(min_scale, self.width() / self.parentProcessor.videoRect().end)
+        return min(max(min_scale, value), MAX_SCALE)
+
     def onTimeChanged(self, source, value):
 
         if not self.isInScreen(value):
-            self.x_offset.setValue(self, timeToPixel(value))
+            # 画面の左端に来るようにずらす
+            self.x_offset.setValue(self, -self.timeToPixel(value))
         if self.parentProcessor:
             self.parentProcessor.onSeekbarChanged(value)
         self.update()
@@ -265,9 +734,56 @@ class RectSelectWidget(QWidget):
         """
         指定された時間がスクリーン上にあるかどうかを判定する
         """
-        pix = self.absToRel(timeToPixel(time))
+        pix = self.absToRel(self.timeToPixel(time))
         return 0 <= pix <= self.width()
 
+    def zoom(self, factor: float, x: float):
+        """
+        画面上の座標xにある時刻が動かないように、拡大率をfactor倍にする
+        """
+        time = self.pixelToTime(self.relToAbs(x))
+        self.scale.setValue(self, self.scale.getValue() * factor)
+        self.x_offset.setValue(self, int(x) - self.timeToPixel(time))
+        self.update()
+
+    def centerOn(self, time: float):
+        """
+        指定された時間が画面の中央に来るようにずらす
+        """
+        self.x_offset.setValue(self, self.width() // 2 - self.timeToPixel(time))
+        self.update()
+
+    def visibleRange(self) -> tuple[float, float]:
+        """
+        :return: 画面内の(開始時刻, 終了時刻)
+        """
+        return self.pixelToTime(self.relToAbs(0)), self.pixelToTime(
+            self.relToAbs(self.width())
+        )
+
+    def wheelEvent(self, event):
+        delta = event.angleDelta()
+        if event.modifiers() & Qt.ShiftModifier or delta.x() != 0:
+            # 横方向のホイールかShift+ホイールで左右に動かす(1段で画面の幅の1/10)
+            steps = (delta.x() if delta.x() != 0 else delta.y()) / 120
+            self.x_offset.setValue(
+                self, self.x_offset.getValue() + int(steps * self.width() / 10)
+            )
+            self.update()
+        elif delta.y() != 0:
+            self.zoom(ZOOM_STEP ** (delta.y() / 120), event.position().x())
+        event.accept()
+
+    def event(self, event):
+        # トラックパッドのピンチ
+        if (
+            event.type() == QEvent.NativeGesture
+            and event.gestureType() == Qt.ZoomNativeGesture
+        ):
+            self.zoom(1 + event.value(), event.localPos().x())
+            return True
+        return super().event(event)
+
     def mousePressEvent(self, event):
         if self.parentProcessor:
             self.parentProcessor.onClick(event.pos(), event.button())
@@ -286,8 +802,8 @@ class RectSelectWidget(QWidget):
             parentRect = self.parentProcessor.videoRect()
             parentStartTime = parentRect.start
             parentEndTime = parentRect.end
-            parentStartPixel = self.absToRel(timeToPixel(parentStartTime))
-            parentEndPixel = self.absToRel(timeToPixel(parentEndTime))
+            parentStartPixel = self.absToRel(self.timeToPixel(parentStartTime))
+            parentEndPixel = self.absToRel(self.timeToPixel(parentEndTime))
             painter.fillRect(
                 parentStartPixel,
                 0,
@@ -295,30 +811,77 @@ class RectSelectWidget(QWidget):
                 self.height(),
                 Qt.yellow,
             )
+            self.__drawThumbnails(painter)
 
         painter.setBrush(Qt.red)
-        for x in range(0, self.size().width()):
-            if (x - self.x_offset.getValue()) % 10 == 0:
-                painter.drawLine(x, 0, x, self.height())
+        visibleStart, visibleEnd = self.visibleRange()
+        # 絶対座標で目盛りの間隔の倍数の位置に線を引く
+        step = tickSpacing(self.scale.getValue())
+        for i in range(math.ceil(visibleStart / step), math.floor(visibleEnd / step) + 1):
+            x = self.absToRel(self.timeToPixel(i * step))
+            painter.drawLine(x, 0, x, self.height())
         if self.parentProcessor:
-            for childProcessor in self.parentProcessor.childProcessors:
-                painter.setBrush(Qt.gray)
+            limit = self.width() // LOD_SPAN_PIXELS
+            if self.parentProcessor.countSpansIn(visibleStart, visibleEnd, limit) > limit:
+                # 領域が細かすぎるので密度の棒にまとめる
+                toTime = lambda x: self.pixelToTime(self.relToAbs(x))
+                for depth, color in [(1, QColor(128, 128, 128, 160)), (2, QColor(255, 0, 0, 160))]:
+                    coverage = self.parentProcessor.coverageIndex(depth)
+                    drawDensity(painter, coverage, color, toTime, 0, self.width(), self.height())
+                # 作成中や編集中の領域は密度に含まれないので、そのまま描く
+                editing = [
+                    p
+                    for p in self.parentProcessor.editingChildren()
+                    if p.videoRect().end >= visibleStart and p.videoRect().start <= visibleEnd
+                ]
+                self.__drawSpans(painter, editing, visibleStart, visibleEnd)
+            else:
+                self.__drawSpans(
+                    painter,
+                    self.parentProcessor.childrenIn(visibleStart, visibleEnd),
+                    visibleStart,
+                    visibleEnd,
+                )
+            if self.painted_generation != RectSelectProcessor.generation:
+                self.painted_generation = RectSelectProcessor.generation
+                self.spansChanged.emit()
+
+        time_bar = self.absToRel(self.timeToPixel(self.time.getValue()))
+
+        painter.fillRect(time_bar - 1, 0, 3, self.height(), Qt.blue)
+
+    def __drawSpans(
+        self,
+        painter: QPainter,
+        processors: list[RectSelectProcessor],
+        visibleStart: float,
+        visibleEnd: float,
+    ):
+        """
+        子の領域とその中で画面内の時間と重なる孫の領域を1つずつ描く
+        :param processors: 描く子の領域
+        """
+        # 下のサムネイルが見えるよう半透明で塗る
+        for childProcessor in processors:
+            painter.setBrush(QColor(128, 128, 128, 160))
+            childRect = childProcessor.videoRect()
+            startPixel = self.absToRel(self.timeToPixel(childRect.start))
+            endPixel = self.absToRel(self.timeToPixel(childRect.end))
+            width = endPixel - startPixel
+            painter.drawRect(startPixel, 0, width, self.height())
+            painter.setBrush(QColor(255, 0, 0, 160))
+            for childProcessor in childProcessor.childrenIn(visibleStart, visibleEnd):
                 childRect = childProcessor.videoRect()
-                startPixel = self.absToRel(timeToPixel(childRect.start))
-                endPixel = self.absToRel(timeToPixel(childRect.end))
+                startPixel = self.absToRel(self.timeToPixel(childRect.start))
+                endPixel = self.absToRel(self.timeToPixel(childRect.end))
                 width = endPixel - startPixel
                 painter.drawRect(startPixel, 0, width, self.height())
-                painter.setBrush(Qt.red)
-                for childProcessor in childProcessor.childProcessors:
-                    childRect = childProcessor.videoRect()
-                    startPixel = self.absToRel(timeToPixel(childRect.start))
-                    endPixel = self.absToRel(timeToPixel(childRect.end))
-                    width = endPixel - startPixel
-                    painter.drawRect(startPixel, 0, width, self.height())
 
-        time_bar = self.absToRel(timeToPixel(self.time.getValue()))
+    def pixelToTime(self, pixel: int) -> float:
+        return pixelToTime(pixel, self.scale.getValue())
 
-        painter.fillRect(time_bar - 1, 0, 3, self.height(), Qt.blue)
+    def timeToPixel(self, time: float) -> int:
+        return timeToPixel(time, self.scale.getValue())
 
     # 絶対座標から現在のオフセットを勘案した画面上の座標に変換
     def absToRel(self, x: int):
@@ -328,7 +891,61 @@ class RectSelectWidget(QWidget):
     def relToAbs(self, x: int):
         return x - self.x_offset.getValue()
 
-    def onVideoChanged(self, video_length: float | None):
+    def __drawThumbnails(self, painter: QPainter):
+        """
+        画面内のサムネイルを下端に並べ、足りないものを作業スレッドに依頼する
+        """
+        if self.thumbnail_worker == None:
+            return
+        video_length = self.parentProcessor.videoRect().end
+        strip_height = min(THUMBNAIL_HEIGHT, self.height())
+        image_scale = strip_height / THUMBNAIL_HEIGHT
+        spacing = thumbnailSpacing(self.scale.getValue(), self.thumbnail_width * image_scale)
+        first = max(0, math.floor(self.pixelToTime(self.relToAbs(0)) / spacing))
+        last_index = math.floor(video_length / spacing)
+        last = min(last_index, math.floor(self.pixelToTime(self.relToAbs(self.width())) / spacing))
+        top = self.height() - strip_height
+        for i in range(first, last + 1):
+            image = self.thumbnails.get(int(round(i * spacing * 1000)))
+            if image:
+                x = self.absToRel(self.timeToPixel(i * spacing))
+                target = QRectF(x, top, image.width() * image_scale, strip_height)
+                painter.drawImage(target, image)
+
+        if self.thumbnail_request != (first, last, spacing):
+            self.thumbnail_request = (first, last, spacing)
+            # 画面外は画面の近くだけを、近いものから
+            count = (last - first + 1) * THUMBNAIL_PREFETCH_SCREENS
+            offscreen = prefetchOrder(first, last, last_index, count)
+            self.thumbnail_worker.request(
+                self.__missingThumbnails(range(first, last + 1), spacing),
+                self.__missingThumbnails(offscreen, spacing),
+            )
+
+    def __missingThumbnails(self, indices, spacing) -> list[int]:
+        """
+        :return: 番号のうちメモリにないサムネイルの時刻(ミリ秒)
+        """
+        times = (int(round(i * spacing * 1000)) for i in indices)
+        return [ms for ms in times if ms not in self.thumbnails]
+
+    def __onThumbnailReady(self, ms, image: QImage):
+        self.thumbnails.put(ms, image)
+        self.thumbnail_width = image.width()
+        self.update()
+
+    def onVideoChanged(self, video_length: float | None, video_path=None):
+        """
+        :param video_path: サムネイルを作る動画のパス Noneならサムネイルを表示しない
+        """
+        if self.thumbnail_worker:
+            self.thumbnail_worker.stop()
+            self.thumbnail_worker = None
+        self.thumbnails.clear()
+        self.thumbnail_request = None
+        if video_length and video_path:
+            self.thumbnail_worker = ThumbnailWorker(video_path)
+            self.thumbnail_worker.thumbnailReady.connect(self.__onThumbnailReady)
         if video_length:
             self.parentProcessor = RectSelectProcessor(
                 0,
@@ -336,71 +953,124 @@ class RectSelectWidget(QWidget):
                 0,
                 self.update,
                 self.x_offset.getValue,
+                self.scale.getValue,
                 lambda value: self.time.setValue(self, value),
                 self.setCursor,
             )
-
+            self.parentProcessor.edit_listener = self.__onEdited
         else:
             self.parentProcessor = None
+        self.undo_stack = []
+        self.redo_stack = []
         self.update()
 
     def getExportObject(self) -> dict:
-        return toExportObject(self.parentProcessor)
-
-
-def mergeClipRect(
-    clipRects: list[RectSelectProcessor], ignores: list[RectSelectProcessor] = []
-) -> list[RectSelectProcessor]:
-    sortedList = sorted(clipRects, key=lambda a: a.videoRect().start)
-    sortedList = [a for a in sortedList if not a in ignores and a != None]
-    result = [a for a in ignores if a != None]
-    while len(sortedList) != 0:
-        clipRect = sortedList.pop(0)
-        start = clipRect.videoRect().start
-        end = clipRect.videoRect().end
-        childPrecessors = list(clipRect.childProcessors)
-        while True:
-            # endがある要素のstartより大きい->交わっている
-            # 交わる要素がなくなるまでループ
-            edit = False
-            for clipRect2 in sortedList:
-                if clipRect2.videoRect().start <= end:
-                    edit = True
-                    end = max(end, clipRect2.videoRect().end)
-                    sortedList.remove(clipRect2)
-                    childPrecessors += clipRect2.childProcessors
-                    break
-            if edit == False:
-                break
-        newProcessor = RectSelectProcessor(
-            start,
-            end,
-            clipRect.depth,
-            clipRect.update,
-            clipRect.xOffset,
-            clipRect.setTime,
-            clipRect.setCursor,
-        )
-        newProcessor.childProcessors = mergeClipRect(childPrecessors)
-        clipChild(newProcessor)
+        result = toExportObject(self.parentProcessor)
+        # 時刻の基準(フレーム番号/fps)を記録しておく
+        video_data = self.video_data.getValue()
+        if video_data:
+            result["fps"] = video_data.getFPS()
+        return result
 
-        result.append(newProcessor)
+    def loadChildren(self, children: IntervalSet):
+        """
+        読み込んだアノテーションで子の領域を置き換える(元に戻す対象にはしない)
+        :param children: buildChildrenでparentProcessorの子として作ったもの
+        """
+        if self.parentProcessor:
+            self.parentProcessor.replaceChildren(children)
+            self.update()
 
-    return result
+    def __onEdited(self, remove: list[dict], add: list[dict]):
+        self.undo_stack.append((remove, add))
+        self.redo_stack = []
+        self.edited.emit(remove, add)
+
+    def __canEdit(self) -> bool:
+        # ドラッグ中は編集中の領域が並びの外にあるので、元に戻さない
+        return self.parentProcessor != None and not self.parentProcessor.isPressed
+
+    def undo(self):
+        if self.undo_stack and self.__canEdit():
+            remove, add = self.undo_stack.pop()
+            self.parentProcessor.applyEdit(add, remove)
+            self.redo_stack.append((remove, add))
+            self.edited.emit(add, remove)
+
+    def redo(self):
+        if self.redo_stack and self.__canEdit():
+            remove, add = self.redo_stack.pop()
+            self.parentProcessor.applyEdit(remove, add)
+            self.undo_stack.append((remove, add))
+            self.edited.emit(remove, add)
 
 
-def clipChild(processor: RectSelectProcessor):
-    newChildren = []
-    parentRect = processor.videoRect()
-    for child in processor.childProcessors:
-        childRect = child.videoRect()
-        newStart = max(childRect.start, parentRect.start)
-        newEnd = min(childRect.end, parentRect.end)
-        if newStart < newEnd:
-            child.videoRect().start = newStart
-            child.videoRect().end = newEnd
-            newChildren.append(child)
-    processor.childProcessors = newChildren
+class TimelineOverview(QWidget):
+    """
+    動画全体を縮めて領域の密度を描き、タイムラインに見えている範囲を枠で示す
+    クリックかドラッグした位置をタイムラインの中央に表示する
+    """
+
+    def __init__(self, timeline: RectSelectWidget, parent=None):
+        super(TimelineOverview, self).__init__(parent)
+        self.timeline = timeline
+        self.setFixedHeight(OVERVIEW_HEIGHT)
+        repaint = lambda source, value: self.update()
+        timeline.time.addListener(self, repaint)
+        timeline.x_offset.addListener(self, repaint)
+        timeline.scale.addListener(self, repaint)
+        timeline.spansChanged.connect(self.update)
+
+    def __videoLength(self) -> float | None:
+        processor = self.timeline.parentProcessor
+        if processor == None or processor.videoRect().end <= 0:
+            return None
+        return processor.videoRect().end
+
+    def __timeToX(self, time: float) -> int:
+        return int(time * self.width() / self.__videoLength())
+
+    def paintEvent(self, event):
+        painter = QPainter(self)
+        painter.fillRect(self.rect(), Qt.black)
+        length = self.__videoLength()
+        if length == None:
+            return
+        painter.fillRect(0, 0, self.__timeToX(length), self.height(), Qt.yellow)
+        processor = self.timeline.parentProcessor
+        toTime = lambda x: x * length / self.width()
+        for depth, color in [(1, QColor(128, 128, 128)), (2, QColor(255, 0, 0))]:
+            drawDensity(
+                painter, processor.coverageIndex(depth), color, toTime, 0, self.width(), self.height(), 1
+            )
+        # 作成中や編集中の領域は密度に含まれないので、そのまま描く
+        for child in processor.editingChildren():
+            for depth, rect in [(1, child.videoRect())] + [
+                (2, p.videoRect()) for p in child.childProcessors
+            ]:
+                color = QColor(128, 128, 128) if depth == 1 else QColor(255, 0, 0)
+                left = self.__timeToX(rect.start)
+                painter.fillRect(left, 0, max(1, self.__timeToX(rect.end) - left), self.height(), color)
+        visibleStart, visibleEnd = self.timeline.visibleRange()
+        left = self.__timeToX(visibleStart)
+        painter.setPen(QPen(Qt.blue, 2))
+        painter.setBrush(Qt.NoBrush)
+        painter.drawRect(left, 1, max(2, self.__timeToX(visibleEnd) - left), self.height() - 2)
+        time_bar = self.__timeToX(self.timeline.time.getValue())
+        painter.fillRect(time_bar, 0, 1, self.height(), Qt.blue)
+
+    def __centerAt(self, x: int):
+        length = self.__videoLength()
+        if length != None:
+            self.timeline.centerOn(min(max(0, x), self.width()) * length / self.width())
+
+    def mousePressEvent(self, event):
+        if event.button() == Qt.LeftButton:
+            self.__centerAt(event.pos().x())
+
+    def mouseMoveEvent(self, event):
+        if event.buttons() & Qt.LeftButton:
+            self.__centerAt(event.pos().x())
 
 
 def toExportObject(processor: RectSelectProcessor) -> dict:
@@ -410,3 +1080,78 @@ def toExportObject(processor: RectSelectProcessor) -> dict:
     children = list(map(toExportObject, processor.childProcessors))
     result["children"] = children
     return result
+
+
+def fromExportObject(obj: dict, parent: RectSelectProcessor) -> RectSelectProcessor:
+    """
+    toExportObjectの形からparentの子の領域を作る
+    """
+    processor = RectSelectProcessor(
+        obj["start"],
+        obj["end"],
+        parent.depth + 1,
+        parent.update,
+        parent.xOffset,
+        parent.scale,
+        parent.setTime,
+        parent.setCursor,
+    )
+    processor.parent = parent
+    processor.replaceChildren(buildChildren(obj["children"], processor))
+    return processor
+
+
+def buildChildren(objs: list[dict], parent: RectSelectProcessor) -> IntervalSet:
+    """
+    toExportObjectの形の子の領域から、parentの子の並びをまとめて作る 別スレッドから呼んでもよい
+    保存したときに結合してあるので、通常は結合せずにそのまま並べる
+    """
+    rect = parent.videoRect()
+    bounds = (rect.start, rect.end) if parent.depth >= 1 else (None, None)
+    if not isNormalized(objs, *bounds):
+        # 以前の版で作成中に保存したものなどは、領域を作る前に辞書のまま結合する
+        objs = normalizeExportObjects(objs, *bounds)
+    return IntervalSet.fromSorted([fromExportObject(obj, parent) for obj in objs])
+
+
+def isNormalized(objs: list[dict], start: float | None = None, end: float | None = None) -> bool:
+    """
+    :return: 開始時刻の順に並び、重ならず接してもいなければTrue
+    :param start: 指定すれば、全ての領域が[start, end]に収まり長さがあることも調べる
+    """
+    previous_end = None
+    for obj in objs:
+        if obj["start"] > obj["end"] or (previous_end != None and obj["start"] <= previous_end):
+            return False
+        if start != None and not (start <= obj["start"] < obj["end"] <= end):
+            return False
+        previous_end = obj["end"]
+    return True
+
+
+def normalizeExportObjects(
+    objs: list[dict], start: float | None = None, end: float | None = None
+) -> list[dict]:
+    """
+    toExportObjectの形の領域を開始時刻の順に並べ、重なるか接するものを子ごと結合する
+    :param start: 指定すれば[start, end]に収め、長さのなくなったものを捨てる
+    """
+    merged = []
+    for obj in sorted(objs, key=lambda o: o["start"]):
+        if merged and obj["start"] <= merged[-1]["end"]:
+            last = merged[-1]
+            last["end"] = max(last["end"], obj["end"])
+            last["children"] += obj["children"]
+        else:
+            merged.append({"start": obj["start"], "end": obj["end"], "children": list(obj["children"])})
+    result = []
+    for obj in merged:
+        if start != None:
+            obj["start"] = max(obj["start"], start)
+            obj["end"] = min(obj["end"], end)
+            if obj["start"] >= obj["end"]:
+                continue
+        if not isNormalized(obj["children"], obj["start"], obj["end"]):
+            obj["children"] = normalizeExportObjects(obj["children"], obj["start"], obj["end"])
+        result.append(obj)
+    return result
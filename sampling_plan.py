@@ -0,0 +1,211 @@
+import json
+import math
+import time
+
+import cv2
+import numpy as np
+
+from extraction_metrics import ExtractionMetrics
+from frame_decoder import measureKeyframeInterval
+from label_index import Condition, LabelIndex
+
+
+class SamplingPlan:
+    """
+    抽出するフレームの一覧
+    フレーム番号、時刻、ラベル、連続した領域の番号を並列な配列で持つ
+    """
+
+    def __init__(
+        self,
+        frame_indices: np.ndarray,
+        timestamps: np.ndarray,
+        labels: np.ndarray,
+        segments: np.ndarray,
+        video_fps: float,
+        frame_count: int,
+        target_fps: float,
+        offset: int = 0,
+        keyframe_interval: int | None = None,
+    ):
+        """
+        :param offset: 分割した場合の、分割前の計画での先頭の位置
+        :param keyframe_interval: 動画のキーフレームの間隔(フレーム数) 不明ならNone
+            分割した計画にも引き継ぎ、ワーカーごとに調べ直さない
+        """
+        self.frame_indices = frame_indices
+        self.timestamps = timestamps
+        self.labels = labels
+        self.segments = segments
+        self.video_fps = video_fps
+        self.frame_count = frame_count
+        self.target_fps = target_fps
+        self.offset = offset
+        self.keyframe_interval = keyframe_interval
+
+    def __len__(self):
+        return len(self.frame_indices)
+
+    def subset(self, start: int, end: int) -> "SamplingPlan":
+        return SamplingPlan(
+            self.frame_indices[start:end],
+            self.timestamps[start:end],
+            self.labels[start:end],
+            self.segments[start:end],
+            self.video_fps,
+            self.frame_count,
+            self.target_fps,
+            self.offset + start,
+            self.keyframe_interval,
+        )
+
+    def select(self, mask) -> "SamplingPlan":
+        """
+        maskがTrueのフレームだけを取り出す
+        """
+        return SamplingPlan(
+            self.frame_indices[mask],
+            self.timestamps[mask],
+            self.labels[mask],
+            self.segments[mask],
+            self.video_fps,
+            self.frame_count,
+            self.target_fps,
+            keyframe_interval=self.keyframe_interval,
+        )
+
+    def split(self, count: int) -> list["SamplingPlan"]:
+        """
+        フレーム数がほぼ等しくなるように連続した部分に分割する
+        領域の番号は分割前のものをそのまま持つ
+        """
+        count = max(1, min(count, len(self)))
+        bounds = np.linspace(0, len(self), count + 1).astype(np.int64)
+        return [
+            self.subset(int(start), int(end))
+            for start, end in zip(bounds[:-1], bounds[1:])
+        ]
+
+    def summary(self) -> dict:
+        """
+        ジョブの見積もりに使う概要
+        """
+        return {
+            "video_fps": self.video_fps,
+            "frame_count": self.frame_count,
+            "target_fps": self.target_fps,
+            "keyframe_interval": self.keyframe_interval,
+            "planned_frames": len(self),
+            "safe_frames": int(np.count_nonzero(self.labels == Condition.SAFE.value)),
+            "danger_frames": int(
+                np.count_nonzero(self.labels == Condition.DANGER.value)
+            ),
+            "segments": int(len(np.unique(self.segments))),
+            "first_frame": int(self.frame_indices[0]) if len(self) else None,
+            "last_frame": int(self.frame_indices[-1]) if len(self) else None,
+        }
+
+    def dump(self, path: str):
+        """
+        概要と全フレームの一覧をJSONとして保存する
+        """
+        result = self.summary()
+        result["frames"] = [
+            [int(frame), float(timestamp), int(label), int(segment)]
+            for frame, timestamp, label, segment in zip(
+                self.frame_indices, self.timestamps, self.labels, self.segments
+            )
+        ]
+        with open(path, "w") as f:
+            json.dump(result, f)
+
+
+def buildSamplingPlan(
+    label_index: LabelIndex,
+    video_fps: float,
+    frame_count: int,
+    target_fps: float,
+    metrics: ExtractionMetrics | None = None,
+    keyframe_interval: int | None = None,
+) -> SamplingPlan:
+    """
+    有効な領域ごとに、開始時刻から1/target_fps秒おきにフレームを選ぶ
+    :param video_fps: 動画のfps(29.97のような小数のまま渡す)
+    :param target_fps: 抽出するfps(小数も可)
+    :param metrics: ラベル付けの時間を記録する先
+    :param keyframe_interval: 動画のキーフレームの間隔(フレーム数) 不明ならNone
+    """
+    # 古い形式のアノテーションは時刻の基準が違うので直す
+    label_index = label_index.forVideoFps(video_fps)
+    starts, ends = label_index.validIntervals()
+    # 旧実装と同じく、動画の先頭が有効な領域でなければ番号は1から始まる
+    segment_offset = 0 if len(starts) and starts[0] <= 0 else 1
+
+    frame_chunks = []
+    segment_chunks = []
+    for k, (start, end) in enumerate(zip(starts, ends)):
+        count = int(math.floor((end - start) * target_fps + 1e-9)) + 1
+        times = start + np.arange(count, dtype=np.float64) / target_fps
+        # 指定時刻以降で最初のフレーム(浮動小数の誤差は許容する)
+        frames = np.ceil(times * video_fps - 1e-6).astype(np.int64)
+        frames = frames[(frames >= 0) & (frames < frame_count)]
+        frame_chunks.append(frames)
+        segment_chunks.append(np.full(len(frames), k + segment_offset, dtype=np.int64))
+
+    if frame_chunks:
+        frame_indices = np.concatenate(frame_chunks)
+        segments = np.concatenate(segment_chunks)
+    else:
+        frame_indices = np.zeros(0, dtype=np.int64)
+        segments = np.zeros(0, dtype=np.int64)
+
+    # 目標fpsが動画のfpsより高い場合などに同じフレームが重複するので取り除く
+    keep = np.ones(len(frame_indices), dtype=bool)
+    keep[1:] = frame_indices[1:] > frame_indices[:-1]
+    frame_indices = frame_indices[keep]
+    segments = segments[keep]
+
+    timestamps = frame_indices / video_fps
+    start = time.perf_counter()
+    labels = label_index.labels(timestamps)
+    if metrics:
+        metrics.add("label", time.perf_counter() - start, len(timestamps))
+    keep = labels != Condition.INVALID.value
+    return SamplingPlan(
+        frame_indices[keep],
+        timestamps[keep],
+        labels[keep],
+        segments[keep],
+        video_fps,
+        frame_count,
+        target_fps,
+        keyframe_interval=keyframe_interval,
+    )
+
+
+def planVideo(
+    video_path,
+    label_index: LabelIndex,
+    target_fps: float,
+    metrics: ExtractionMetrics | None = None,
+) -> SamplingPlan:
+    """
+    動画のfpsとフレーム数を読み取り、キーフレームの間隔を調べて計画を作成する
+    """
+    if target_fps <= 0:
+        raise ValueError("fps must be positive")
+    video = cv2.VideoCapture(video_path)
+    # 29.97fpsなどを切り捨てないよう小数のまま使う
+    video_fps = video.get(cv2.CAP_PROP_FPS)
+    frame_count = int(video.get(cv2.CAP_PROP_FRAME_COUNT))
+    video.release()
+    if video_fps <= 0:
+        raise ValueError(f"failed to read video: {video_path}")
+    return buildSamplingPlan(
+        label_index,
+        video_fps,
+        frame_count,
+        target_fps,
+        metrics,
+        measureKeyframeInterval(video_path),
+    )
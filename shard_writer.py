@@ -0,0 +1,181 @@
+import io
+import json
+import os
+import tarfile
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from extraction_metrics import ExtractionMetrics
+from frame_transform import FrameTransform
+from image_writer import ImageEncoder
+from label_index import Condition
+
+
+def _paddedSize(size) -> int:
+    """
+    tar内でデータが占める大きさ(512バイト単位に切り上げる)
+    """
+    return -(-size // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+
+
+def _closedTarSize(offset) -> int:
+    """
+    offsetまで書き込んだtarを閉じたときのファイルの大きさ
+    閉じるときに終端の2ブロックが書かれ、RECORDSIZE単位に切り上げられる
+    """
+    size = offset + 2 * tarfile.BLOCKSIZE
+    return -(-size // tarfile.RECORDSIZE) * tarfile.RECORDSIZE
+
+
+class ShardWriter:
+    """
+    エンコードした画像とJSONのレコードを、サイズに上限のあるtarに順に書き込む
+    webdatasetと同じく <key>.<拡張子> と <key>.json が1つのサンプルになる
+    tarごとに <tarの名前>.idx.jsonl を作り、各サンプルの位置を記録する
+    """
+
+    def __init__(
+        self,
+        output_path,
+        key_prefix,
+        encoder: ImageEncoder | None = None,
+        max_shard_bytes=1 << 30,
+        threads=4,
+        queue_size=32,
+        shard_prefix="shard-",
+        transform: FrameTransform | None = None,
+        metrics: ExtractionMetrics | None = None,
+    ):
+        """
+        :param key_prefix: サンプルのキーの先頭(動画名など)
+        :param max_shard_bytes: 1つのtarの大きさの上限
+        :param queue_size: エンコード待ちにできるフレーム数の上限
+        :param shard_prefix: tarのファイル名の先頭 並列に書き込む場合は別々にする
+        :param transform: エンコードの前にエンコード用のスレッドで行う変換
+        :param metrics: 変換、エンコード、書き込みの時間を記録する先
+        """
+        self.output_path = output_path
+        # webdatasetではキーに"."を含められない
+        self.key_prefix = key_prefix.replace(".", "_")
+        self.encoder = encoder if encoder else ImageEncoder()
+        self.max_shard_bytes = max_shard_bytes
+        self.queue_size = max(1, queue_size)
+        self.shard_prefix = shard_prefix
+        self.transform = transform
+        self.metrics = metrics if metrics else ExtractionMetrics()
+        self.executor = ThreadPoolExecutor(max_workers=max(1, threads))
+        self.pending = deque()
+        self.shard_number = 0
+        self.tar: tarfile.TarFile | None = None
+        self.index_file = None
+        os.makedirs(output_path, exist_ok=True)
+
+    def shardPath(self, shard_number) -> str:
+        return os.path.join(
+            self.output_path, f"{self.shard_prefix}{shard_number:06d}.tar"
+        )
+
+    def __openShard(self):
+        path = self.shardPath(self.shard_number)
+        self.tar = tarfile.open(path, "w", format=tarfile.USTAR_FORMAT)
+        self.index_file = open(f"{path}.idx.jsonl", "w")
+        self.shard_number += 1
+
+    def __closeShard(self):
+        if self.tar:
+            self.tar.close()
+            self.index_file.close()
+            self.tar = None
+            self.index_file = None
+
+    def __addMember(self, name, data: bytes) -> list[int]:
+        """
+        :return: tar内でのデータの[位置, 大きさ]
+        """
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        info.mtime = int(time.time())
+        self.tar.addfile(info, io.BytesIO(data))
+        # addfileの後のoffsetは512バイト単位に切り上げられたデータの末尾
+        return [self.tar.offset - _paddedSize(len(data)), len(data)]
+
+    def __writeSample(self, key, image: bytes, record: dict):
+        record_data = json.dumps(record).encode("utf-8")
+        # 2つのヘッダーと、512バイト単位に切り上げたデータ
+        sample_size = (
+            2 * tarfile.BLOCKSIZE + _paddedSize(len(image)) + _paddedSize(len(record_data))
+        )
+        # 閉じたときの終端のブロックも含めて上限を超えるなら次のtarに書く
+        if self.tar and _closedTarSize(self.tar.offset + sample_size) > self.max_shard_bytes:
+            self.__closeShard()
+        if not self.tar:
+            self.__openShard()
+        image_entry = self.__addMember(key + self.encoder.extension(), image)
+        record_entry = self.__addMember(f"{key}.json", record_data)
+        index = {"key": key, "image": image_entry, "json": record_entry}
+        self.index_file.write(json.dumps(index) + "\n")
+
+    def __flush(self, limit):
+        while len(self.pending) > limit:
+            key, future, record = self.pending.popleft()
+            image = future.result()
+            with self.metrics.measure("write", len(image)):
+                self.__writeSample(key, image, record)
+
+    def __encode(self, frame) -> bytes:
+        if self.transform:
+            with self.metrics.measure("transform"):
+                frame = self.transform.apply(frame)
+        start = time.perf_counter()
+        data = self.encoder.encode(frame)
+        self.metrics.add("encode", time.perf_counter() - start, 1, len(data))
+        return data
+
+    def write(self, frame, frame_index, timestamp, condition: Condition, segment):
+        key = f"{self.key_prefix}_{frame_index:08d}"
+        record = {
+            "label": condition.name.lower(),
+            "condition": condition.value,
+            "timestamp": float(timestamp),
+            "frame_index": int(frame_index),
+            "segment": int(segment),
+        }
+        self.pending.append((key, self.executor.submit(self.__encode, frame), record))
+        # エンコード待ちが上限を超えたら古いものから書き込む(順番は保たれる)
+        self.__flush(self.queue_size)
+
+    def close(self):
+        try:
+            self.__flush(0)
+        finally:
+            self.executor.shutdown()
+            self.__closeShard()
+
+
+def loadShardIndex(shard_path) -> dict[str, dict]:
+    """
+    :return: キーからサンプルの位置への辞書
+    """
+    result = {}
+    with open(f"{shard_path}.idx.jsonl", "r") as f:
+        for line in f:
+            entry = json.loads(line)
+            result[entry["key"]] = entry
+    return result
+
+
+def readShardSample(shard_path, entry: dict) -> tuple[bytes, dict]:
+    """
+    tarを先頭から読まずに1つのサンプルを読み込む
+    :param entry: loadShardIndexで得たサンプルの位置
+    :return: (エンコードされた画像, レコード)
+    """
+    with open(shard_path, "rb") as f:
+        offset, size = entry["image"]
+        f.seek(offset)
+        image = f.read(size)
+        offset, size = entry["json"]
+        f.seek(offset)
+        record = json.loads(f.read(size))
+    return image, record
@@ -0,0 +1,216 @@
+import json
+import os
+import shutil
+import threading
+from collections import OrderedDict
+
+import cv2
+from PyQt5.QtCore import QObject, pyqtSignal
+from PyQt5.QtGui import QImage
+
+# サムネイルの高さ(px)
+THUMBNAIL_HEIGHT = 48
+# サムネイルの間隔の候補(秒) 拡大率に応じてサムネイルが重ならない最小のものを使う
+THUMBNAIL_STEPS = [0.5, 1, 2, 5, 10, 15, 30, 60, 120, 300, 600, 1200, 1800, 3600]
+# 画面外のサムネイルは、左右それぞれ画面に見えている数のこの倍まで先に作っておく
+THUMBNAIL_PREFETCH_SCREENS = 1
+# メモリに置いておくサムネイルの合計の大きさの上限(MB)
+THUMBNAIL_CACHE_MB = 32
+
+
+def thumbnailSpacing(pixels_per_second: float, thumbnail_width: int) -> float:
+    """
+    :return: サムネイルを置く間隔(秒)
+    """
+    for step in THUMBNAIL_STEPS:
+        if step * pixels_per_second >= thumbnail_width:
+            return step
+    return THUMBNAIL_STEPS[-1]
+
+
+def thumbnailDirectory(video_path) -> str:
+    """
+    サムネイルは動画と同じ場所の<動画名>.thumbsに保存する
+    """
+    return os.path.splitext(video_path)[0] + ".thumbs"
+
+
+def prefetchOrder(first: int, last: int, last_index: int, count: int) -> list[int]:
+    """
+    画面外のサムネイルの番号を画面に近いものから並べる
+    :param first, last: 画面内の最初と最後の番号
+    :param last_index: 動画の最後のサムネイルの番号
+    :param count: 左右それぞれいくつまで含めるか
+    """
+    result = []
+    for distance in range(1, count + 1):
+        if first - distance >= 0:
+            result.append(first - distance)
+        if last + distance <= last_index:
+            result.append(last + distance)
+    return result
+
+
+class ThumbnailCache:
+    """
+    サムネイルを時刻(ミリ秒)で引けるようにメモリに置いておく
+    合計の大きさがmax_bytesを超えたら最も長く使われていないものから捨てる
+    """
+
+    def __init__(self, max_mb=THUMBNAIL_CACHE_MB):
+        self.max_bytes = max_mb * 1024 * 1024
+        self.images: OrderedDict[int, QImage] = OrderedDict()
+        self.bytes = 0
+
+    def __len__(self):
+        return len(self.images)
+
+    def __contains__(self, ms):
+        return ms in self.images
+
+    def get(self, ms) -> QImage | None:
+        image = self.images.get(ms)
+        if image != None:
+            self.images.move_to_end(ms)
+        return image
+
+    def put(self, ms, image: QImage):
+        old = self.images.pop(ms, None)
+        if old != None:
+            self.bytes -= old.sizeInBytes()
+        self.images[ms] = image
+        self.bytes += image.sizeInBytes()
+        while self.bytes > self.max_bytes and len(self.images) > 1:
+            _, evicted = self.images.popitem(last=False)
+            self.bytes -= evicted.sizeInBytes()
+
+    def clear(self):
+        self.images.clear()
+        self.bytes = 0
+
+
+class ThumbnailDiskCache:
+    """
+    サムネイルを時刻(ミリ秒)ごとのJPEGとして保存する
+    動画の大きさか更新日時が変わっていたら作り直す
+    動画のフォルダーに書き込めない場合は保存しない
+    """
+
+    INFO_NAME = "info.json"
+
+    def __init__(self, video_path, height=THUMBNAIL_HEIGHT):
+        self.directory = thumbnailDirectory(video_path)
+        self.height = height
+        stat = os.stat(video_path)
+        info = {"size": stat.st_size, "mtime": stat.st_mtime, "height": height}
+        info_path = os.path.join(self.directory, self.INFO_NAME)
+        try:
+            with open(info_path, "r") as f:
+                valid = json.load(f) == info
+        except (FileNotFoundError, ValueError):
+            valid = False
+        if not valid:
+            shutil.rmtree(self.directory, ignore_errors=True)
+            try:
+                os.makedirs(self.directory, exist_ok=True)
+                with open(info_path, "w") as f:
+                    json.dump(info, f)
+            except OSError:
+                self.directory = None
+
+    def path(self, ms) -> str:
+        return os.path.join(self.directory, f"{ms:010d}.jpg")
+
+    def load(self, ms):
+        """
+        :return: BGRの画像 なければNone
+        """
+        if self.directory == None:
+            return None
+        path = self.path(ms)
+        if not os.path.exists(path):
+            return None
+        return cv2.imread(path)
+
+    def save(self, ms, image):
+        if self.directory != None:
+            cv2.imwrite(self.path(ms), image, [cv2.IMWRITE_JPEG_QUALITY, 80])
+
+
+class ThumbnailWorker(QObject):
+    """
+    別スレッドでサムネイルを作る 依頼された順(画面内を先)に処理する
+    キャプチャは再生用とは別に開く
+    """
+
+    # (時刻(ミリ秒), サムネイル)
+    thumbnailReady = pyqtSignal(int, QImage)
+
+    def __init__(self, video_path, height=THUMBNAIL_HEIGHT, parent=None):
+        super().__init__(parent)
+        self.video_path = video_path
+        self.height = height
+        self.disk_cache = ThumbnailDiskCache(video_path, height)
+        self.condition = threading.Condition()
+        self.pending: list[int] = []
+        self.stopped = False
+        self.thread = threading.Thread(target=self.__run, daemon=True)
+        self.thread.start()
+
+    def request(self, visible: list[int], offscreen: list[int]):
+        """
+        これまでの依頼を置き換える 作ったものは覚えていないので、持っていないものだけを依頼する
+        :param visible: 画面内のサムネイルの時刻(ミリ秒) 先に作る
+        :param offscreen: 画面外のサムネイルの時刻(ミリ秒) 近いものから並べておく
+        """
+        with self.condition:
+            self.pending = visible + offscreen
+            self.pending.reverse()  # 末尾から取り出す
+            self.condition.notify_all()
+
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
+        self.thread.join()
+
+    def __next(self) -> int | None:
+        with self.condition:
+            while not self.stopped:
+                if self.pending:
+                    return self.pending.pop()
+                self.condition.wait()
+            return None
+
+    def __decode(self, video: cv2.VideoCapture, fps, ms):
+        video.set(cv2.CAP_PROP_POS_FRAMES, int(round(ms / 1000 * fps)))
+        ret, frame = video.read()
+        if not ret:
+            return None
+        width = max(1, int(frame.shape[1] * self.height / frame.shape[0]))
+        return cv2.resize(frame, (width, self.height), interpolation=cv2.INTER_AREA)
+
+    def __run(self):
+        video = cv2.VideoCapture(self.video_path)
+        fps = video.get(cv2.CAP_PROP_FPS)
+        try:
+            while True:
+                ms = self.__next()
+                if ms == None:
+                    return
+                image = self.disk_cache.load(ms)
+                if image is None and fps > 0:
+                    image = self.__decode(video, fps, ms)
+                    if image is not None:
+                        self.disk_cache.save(ms, image)
+                if image is None:
+                    continue
+                rgb = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+                height, width = rgb.shape[:2]
+                # 画素をコピーしたQImageを渡す(rgbはこの後解放される)
+                qimage = QImage(
+                    rgb.data, width, height, width * 3, QImage.Format_RGB888
+                ).copy()
+                self.thumbnailReady.emit(ms, qimage)
+        finally:
+            video.release()
@@ -1,6 +1,10 @@
-def pixelToTime(pixel: int) -> float:
-    return pixel / 10
+# 1秒あたりのピクセル数の既定値
+DEFAULT_SCALE = 10
 
 
-def timeToPixel(time: float) -> int:
-    return int(time * 10)
+def pixelToTime(pixel: int, scale: float = DEFAULT_SCALE) -> float:
+    return pixel / scale
+
+
+def timeToPixel(time: float, scale: float = DEFAULT_SCALE) -> int:
+    return int(time * scale)
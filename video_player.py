@@ -9,16 +9,44 @@ from PyQt5.QtWidgets import (
     QPushButton,
     QStyle,
     QSlider,
+    QLabel,
+    QShortcut,
 )
-from PyQt5.QtGui import QImage, QPainter
-from PyQt5.QtCore import QTimer, Qt, QRect, QUrl, QSize
+from PyQt5.QtGui import QImage, QPainter, QKeySequence, QPixmap
+from PyQt5.QtCore import QTimer, Qt, QUrl, QSize, pyqtSignal
 from gui_property import GUIProperty
+from playback_decoder import (
+    DecodedFrame,
+    FrameCache,
+    PlaybackDecoder,
+    PresentationClock,
+)
 
 
 class ImageRenderer(QWidget):
+    """
+    画像を縦横比を保って中央に表示する
+    画像は表示する大きさにしたQPixmapにして、画像か大きさが変わるまで使い回す
+    """
+
+    # 大きさが変わった(デコードする大きさを合わせるのに使う)
+    resized = pyqtSignal()
+
     def __init__(self, parent=None):
         super().__init__(parent)
         self.image: QImage | None = None
+        self.pixmap: QPixmap | None = None
+
+    def displaySize(self) -> tuple[int, int]:
+        """
+        :return: 表示領域の大きさ(デバイスピクセル)
+        """
+        ratio = self.devicePixelRatioF()
+        return int(self.width() * ratio), int(self.height() * ratio)
+
+    def resizeEvent(self, event):
+        super().resizeEvent(event)
+        self.resized.emit()
 
     def paintEvent(self, event):
         painter = QPainter(self)
@@ -34,14 +62,29 @@ class ImageRenderer(QWidget):
             targetH = int(ratio * ih)
             aleft = int((w - targetW) / 2)
             atop = int((h - targetH) / 2)
-            targetRect = QRect(aleft, atop, targetW, targetH)
-            sourceRect = QRect(0, 0, iw, ih)
-            painter.drawImage(targetRect, self.image, sourceRect)
+            pixmap = self.__scaledPixmap(targetW, targetH)
+            painter.drawPixmap(aleft, atop, pixmap)
 
         painter.end()
 
+    def __scaledPixmap(self, width, height) -> QPixmap:
+        """
+        表示する大きさ(論理ピクセル)のQPixmap 前回と同じ大きさならそのまま使う
+        """
+        ratio = self.devicePixelRatioF()
+        size = QSize(int(width * ratio), int(height * ratio))
+        if self.pixmap == None or self.pixmap.size() != size:
+            image = self.image
+            if image.size() != size:
+                # デコード側で縮小済みなら通らない(リサイズ直後など)
+                image = image.scaled(size, Qt.IgnoreAspectRatio, Qt.SmoothTransformation)
+            self.pixmap = QPixmap.fromImage(image)
+            self.pixmap.setDevicePixelRatio(ratio)
+        return self.pixmap
+
     def setImage(self, image: QImage | None):
         self.image = image
+        self.pixmap = None
         self.update()
 
 
@@ -50,7 +93,7 @@ class VideoData:
         self.fps = fps
         self.frame_count = frame_count
 
-    def getFPS(self) -> int | None:
+    def getFPS(self) -> float | None:
         return self.fps
 
     def getFrameCount(self) -> int | None:
@@ -64,17 +107,22 @@ class VideoData:
 
 
 class VideoPlayer(QWidget):
+    # 選べる再生速度(倍) 2倍以上では表示するフレームだけをデコードする
+    PLAY_SPEEDS = [1, 2, 3, 4, 5, 10, 20, 30, 60]
+
     def __init__(
         self,
         is_playing: GUIProperty,
         time: GUIProperty,
         video_data: GUIProperty,
         parent=None,
+        cache_mb=512,
     ):
         """
         :param time: 動画の時間(float)
         :param video_data: 動画の情報 VideoData|None型
         :param video_length: ビデオの再生時間 float|None
+        :param cache_mb: デコードしたフレームを覚えておく量(MB)
 
         """
         super(VideoPlayer, self).__init__(parent)
@@ -83,7 +131,11 @@ class VideoPlayer(QWidget):
         self.time.addListener(self, self.onTimeChange)
         self.is_playing = is_playing
         self.video: cv2.VideoCapture | None = None
+        self.decoder: PlaybackDecoder | None = None
+        self.clock = PresentationClock()
+        self.cache = FrameCache(cache_mb)
         self.timer = QTimer(self)
+        self.timer.setTimerType(Qt.PreciseTimer)
         self.timer.timeout.connect(self.__onInterval)
         self.curret_frame = 0
         self.video_data = video_data
@@ -91,6 +143,12 @@ class VideoPlayer(QWidget):
 
     def _initUI(self):
         self.image_renderer = ImageRenderer()
+        self.image_renderer.resized.connect(self.__onRendererResized)
+        # リサイズ中に何度もデコードし直さないよう、止まってから表示中のフレームを作り直す
+        self.resize_timer = QTimer(self)
+        self.resize_timer.setSingleShot(True)
+        self.resize_timer.setInterval(150)
+        self.resize_timer.timeout.connect(self.__redecodeCurrentFrame)
         bottom_widget = QWidget()
         bottom_widget.setMaximumHeight(25)
         bottom_widget_layout = QHBoxLayout(bottom_widget)
@@ -104,13 +162,38 @@ class VideoPlayer(QWidget):
         self.playButton.setIcon(self.style().standardIcon(QStyle.SP_MediaPlay))
         self.playButton.clicked.connect(self.flipPlayStatus)
 
+        self.stepBackButton = QPushButton()
+        self.stepBackButton.setEnabled(False)
+        self.stepBackButton.setFixedHeight(24)
+        self.stepBackButton.setIconSize(btnSize)
+        self.stepBackButton.setIcon(self.style().standardIcon(QStyle.SP_MediaSkipBackward))
+        self.stepBackButton.setToolTip("1フレーム戻る(,)")
+        self.stepBackButton.clicked.connect(lambda: self.stepFrame(-1))
+        QShortcut(QKeySequence(","), self, lambda: self.stepFrame(-1))
+
+        self.stepForwardButton = QPushButton()
+        self.stepForwardButton.setEnabled(False)
+        self.stepForwardButton.setFixedHeight(24)
+        self.stepForwardButton.setIconSize(btnSize)
+        self.stepForwardButton.setIcon(self.style().standardIcon(QStyle.SP_MediaSkipForward))
+        self.stepForwardButton.setToolTip("1フレーム進む(.)")
+        self.stepForwardButton.clicked.connect(lambda: self.stepFrame(1))
+        QShortcut(QKeySequence("."), self, lambda: self.stepFrame(1))
+
         slider = QSlider(Qt.Orientation.Horizontal)
 
-        slider.setMinimum(1)
-        slider.setMaximum(5)
-        slider.valueChanged.connect(self.setPlaySpeed)
+        slider.setMinimum(0)
+        slider.setMaximum(len(self.PLAY_SPEEDS) - 1)
+        slider.valueChanged.connect(
+            lambda index: self.setPlaySpeed(self.PLAY_SPEEDS[index])
+        )
+        self.speedLabel = QLabel(f"x{self.playSpeed}")
+        self.speedLabel.setFixedWidth(30)
+        bottom_widget_layout.addWidget(self.stepBackButton)
         bottom_widget_layout.addWidget(self.playButton)
+        bottom_widget_layout.addWidget(self.stepForwardButton)
         bottom_widget_layout.addWidget(slider)
+        bottom_widget_layout.addWidget(self.speedLabel)
 
         layout = QVBoxLayout()
         layout.addWidget(self.image_renderer)
@@ -119,11 +202,17 @@ class VideoPlayer(QWidget):
 
     def setPlaySpeed(self, speed):
         self.playSpeed = speed
+        self.speedLabel.setText(f"x{speed}")
+        if self.isPlaying():
+            # 現在表示しているフレームから新しい速度で数え直す
+            self.clock.start(self.curret_frame, self.video_fps, self.playSpeed)
 
     def onTimeChange(self, source, value: float):
         if source != self:
             newTime = min(self.video_data.getValue().getVideoLength(), value)
-            self.__setCurrentFrame(int(newTime * self.video_data.getValue().getFPS()))
+            # 時刻はフレーム番号/fpsなので、丸め誤差で1つ前のフレームにならないようにする
+            fps = self.video_data.getValue().getFPS()
+            self.__setCurrentFrame(int(newTime * fps + 1e-6))
 
     def playVideo(self):
         if (
@@ -132,6 +221,7 @@ class VideoPlayer(QWidget):
             and self.curret_frame < self.video_data.getValue().getFrameCount()
         ):
             self.is_playing.setValue(self, True)
+            self.clock.start(self.curret_frame, self.video_fps, self.playSpeed)
             self.timer.setInterval(int(1000 / self.video_data.getValue().getFPS()))
             self.timer.start()
             self.playButton.setIcon(self.style().standardIcon(QStyle.SP_MediaPause))
@@ -139,6 +229,7 @@ class VideoPlayer(QWidget):
     def stopVideo(self):
         if self.isPlaying():
             self.timer.stop()
+            self.clock.stop()
             self.is_playing.setValue(self, False)
             self.playButton.setIcon(self.style().standardIcon(QStyle.SP_MediaPlay))
 
@@ -151,77 +242,146 @@ class VideoPlayer(QWidget):
     def isPlaying(self) -> bool:
         return self.is_playing.getValue()
 
-    def setVideo(self, video: cv2.VideoCapture) -> float | None:
+    def setVideo(
+        self,
+        video: cv2.VideoCapture,
+        source_data: VideoData | None = None,
+        start_time: float = 0,
+        video_path=None,
+    ) -> float | None:
         """
+        :param source_data: videoがプロキシの場合の元の動画のfpsとフレーム数
+        時刻とフレーム番号の変換は元の動画の値で行う
+        :param start_time: 表示を始める時刻(秒)
+        :param video_path: videoのパス キーフレームの間隔を調べるのに使う
         :return: 動画の長さ(秒)
         """
         self.stopVideo()
+        if self.decoder:
+            self.decoder.stop()
+            self.decoder = None
         self.video = video
         if video:
             self.video_width = int(video.get(cv2.CAP_PROP_FRAME_WIDTH))
             self.video_height = int(video.get(cv2.CAP_PROP_FRAME_HEIGHT))
-            fps = int(video.get(cv2.CAP_PROP_FPS))
-            frame_count = int(video.get(cv2.CAP_PROP_FRAME_COUNT))
-            self.video_data.setValue(self, VideoData(fps, frame_count))
-            self.time.setValue(None, 0)
+            if source_data:
+                self.video_fps = source_data.getFPS()
+                frame_count = source_data.getFrameCount()
+            else:
+                # 29.97fpsなどを切り捨てると抽出時(ImageExtractor)と時刻がずれるので小数のまま使う
+                self.video_fps = video.get(cv2.CAP_PROP_FPS)
+                frame_count = int(video.get(cv2.CAP_PROP_FRAME_COUNT))
+            # 以降キャプチャはデコード用のスレッドだけが触る
+            self.cache.clear()
+            self.decoder = PlaybackDecoder(
+                video, clock=self.clock, cache=self.cache, video_path=video_path
+            )
+            self.decoder.setTargetSize(self.image_renderer.displaySize())
+            self.decoder.frameDecoded.connect(self.__onFrameDecoded)
+            self.decoder.start()
+            self.video_data.setValue(self, VideoData(self.video_fps, frame_count))
+            # 前の動画と同じ時刻でも、新しい動画の位置を合わせるため通知する
+            self.time.setValue(None, start_time, force=True)
             self.playButton.setEnabled(True)
+            self.stepBackButton.setEnabled(True)
+            self.stepForwardButton.setEnabled(True)
             return self.video_data.getValue().getVideoLength()
         else:
             self.playButton.setEnabled(False)
+            self.stepBackButton.setEnabled(False)
+            self.stepForwardButton.setEnabled(False)
             self.video_data.setValue(self, None)
             return None
 
     def getCurrentTime(self):
         return self.curret_frame / self.video_data.getValue().getFPS()
 
-    def __incrementCurrentFrame(self):
-        for _ in range(0, self.playSpeed - 1):
-            self.curret_frame += 1
-            self.updateImage(True)
-        self.curret_frame += 1
-        self.time.setValue(self, self.getCurrentTime())
-        isEnd = self.updateImage()
-        if isEnd:
-            self.stopVideo()
+    def stepFrame(self, delta: int):
+        """
+        停止してdeltaフレーム移動する 前後のフレームは再生やシークで覚えていればすぐ表示される
+        """
+        if self.decoder == None:
+            return
+        self.stopVideo()
+        frame_count = self.video_data.getValue().getFrameCount()
+        frame = min(max(0, self.curret_frame + delta), max(0, frame_count - 1))
+        if frame == self.curret_frame:
+            return
+        decode_from = None
+        if delta < 0 and self.cache.peek(frame) == None:
+            # 続けて戻る場合に備え、バッファに収まるだけ手前からデコードしてキャッシュに入れる
+            decode_from = max(0, frame - (self.decoder.buffer_size - 1))
+        self.__setCurrentFrame(frame, decode_from)
+
+    def cacheStats(self) -> dict:
+        """
+        :return: フレームのキャッシュの枚数、大きさ(MB)、ヒット数、ミス数、ヒット率
+        """
+        return self.cache.stats()
 
-    def __setCurrentFrame(self, frame):
+    def __setCurrentFrame(self, frame, decode_from: int | None = None):
+        """
+        :param decode_from: frameより手前からデコードを始める場合の位置
+        """
         self.curret_frame = frame
         self.time.setValue(self, self.getCurrentTime())
-        if self.video:
-            self.video.set(cv2.CAP_PROP_POS_FRAMES, self.curret_frame)
-            isEnd = self.updateImage()
-            if isEnd:
-                self.stopVideo()
+        if self.decoder:
+            cached = self.cache.peek(self.curret_frame)
+            if cached and not self.isPlaying():
+                self.__present(cached)
+            # それ以外の表示はデコードが終わった時点(__onFrameDecodedか次のタイマー)で行う
+            self.decoder.seek(self.curret_frame if decode_from == None else decode_from)
+            if self.isPlaying():
+                self.clock.start(self.curret_frame, self.video_fps, self.playSpeed)
+        else:
+            self.image_renderer.setImage(None)
 
     def __getCurretnFrame(self):
         return self.curret_frame
 
-    def __onInterval(self):
-        self.__incrementCurrentFrame()
-
-    def updateImage(self, only_increment_frame=False) -> bool:
-        """
-        :return: 終わったらtrue それ以外(videoがない場合も含む)はfalse
-        """
-        if self.video:
-            ret, frame = self.video.read()
-            if ret and not only_increment_frame:
-                rgb = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB).data
-                image = QImage(
-                    rgb,
-                    self.video_width,
-                    self.video_height,
-                    self.video_width * 3,
-                    QImage.Format_RGB888,
-                )
-                self.image_renderer.setImage(image)
-                return False
-            else:
-                self.image_renderer.setImage(None)
-                return True
-        else:
+    def __onFrameDecoded(self, frame_index):
+        """
+        停止中にフレームがデコードされた 表示しているフレームならここで表示する
+        """
+        if self.isPlaying() or self.decoder == None:
+            return
+        if frame_index < 0:
             self.image_renderer.setImage(None)
-            return False
+            return
+        # 先読みを進められるよう、表示位置までのフレームはバッファから出しておく(キャッシュには残る)
+        decoded = self.decoder.take(self.curret_frame)
+        if decoded and decoded.frame_index == self.curret_frame:
+            self.__present(decoded)
+
+    def __onInterval(self):
+        """
+        時計が示すフレームを表示する デコードが間に合っていなければ前のフレームのまま待つ
+        """
+        target = self.clock.frameAt()
+        decoded = self.decoder.take(target)
+        if decoded:
+            self.curret_frame = decoded.frame_index
+            self.time.setValue(self, self.getCurrentTime())
+            self.__present(decoded)
+        elif self.decoder.isEnded():
+            self.stopVideo()
+
+    def __onRendererResized(self):
+        if self.decoder:
+            self.decoder.setTargetSize(self.image_renderer.displaySize())
+            self.resize_timer.start()
+
+    def __redecodeCurrentFrame(self):
+        """
+        停止中なら表示中のフレームを新しい大きさでデコードし直す(再生中は次のフレームから変わる)
+        """
+        if self.decoder and not self.isPlaying():
+            self.decoder.seek(self.curret_frame)
+
+    def __present(self, decoded: DecodedFrame):
+        # imageは画素を参照しているだけなので、表示している間は元の配列も保持する
+        self.displayed_frame = decoded
+        self.image_renderer.setImage(decoded.image)
 
 
 if __name__ == "__main__":